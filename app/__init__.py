@@ -2,24 +2,19 @@ import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi
-)
-from linebot.v3.webhook import WebhookHandler
 
-# Create LINE API client and handler here to avoid circular import
-configuration = Configuration(access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
-api_client = ApiClient(configuration)
-line_bot_api = MessagingApi(api_client)
-handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
+# Create LINE API client and handler here to avoid circular import.
+# Both are built on first use; see app/line_client.py
+from .line_client import line_bot_api, handler, warm_up_line_clients
+from .startup import StartupTimer, schema_fingerprint
 
 db = SQLAlchemy()
 
 def create_app():
     """Flask application factory."""
-    load_dotenv()
+    timer = StartupTimer()
+    with timer.phase('load_dotenv'):
+        load_dotenv()
 
     app = Flask(__name__, instance_relative_config=True)
     
@@ -43,28 +38,72 @@ def create_app():
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
     )
 
-    db.init_app(app)
+    with timer.phase('db.init_app'):
+        db.init_app(app)
 
     with app.app_context():
         # Register blueprints and commands
-        from . import bot
-        app.register_blueprint(bot.bp)
-        from . import data
-        data.register_cli_command(app)
+        with timer.phase('blueprints and commands'):
+            from . import bot
+            app.register_blueprint(bot.bp)
+            from . import calendar_feed
+            app.register_blueprint(calendar_feed.bp)
+            from . import data
+            data.register_cli_command(app)
+            from . import startup
+            startup.register_cli_command(app)
+            from . import bench
+            bench.register_cli_command(app)
+            from . import simulate
+            simulate.register_cli_command(app)
+            from . import rich_menu
+            rich_menu.register_cli_command(app)
+            from .webhook_queue import init_webhook_queue
+            init_webhook_queue(app, bot.process_webhook)
 
         # --- Database Initialization ---
         # This logic runs only if the 'users' table doesn't exist,
         # preventing data wipes on server restarts (e.g., Render sleep).
-        from sqlalchemy import inspect
-        inspector = inspect(db.engine)
-        if not inspector.has_table("users"):
-            print("--- 'users' table not found. Initializing database... ---")
-            db.create_all()
-            
-            from .data import load_schedule_data
-            load_schedule_data()
-            print("--- Database initialized. ---")
-        else:
-            print("--- Database already initialized. Skipping. ---")
+        # A schema_versions row for the current model schema skips the rest of
+        # the check once this database is known to be up to date.
+        with timer.phase('schema check'):
+            from .models import record_schema_version, schema_is_current
+            fingerprint = schema_fingerprint(db.metadata)
+            if schema_is_current(fingerprint):
+                print("--- Database schema already verified. Skipping. ---")
+            else:
+                from sqlalchemy import inspect
+                existing_tables = set(inspect(db.engine).get_table_names())
+                if "users" not in existing_tables:
+                    print("--- 'users' table not found. Initializing database... ---")
+                    db.create_all()
+                    
+                    from .data import load_schedule_data
+                    load_schedule_data()
+                    print("--- Database initialized. ---")
+                else:
+                    # Creates any tables added since the first deploy (e.g. collection_days)
+                    if not set(db.metadata.tables) <= existing_tables:
+                        db.create_all()
+                    # Adds columns and indexes added since then (e.g. municipality)
+                    from .models import upgrade_schema
+                    upgrade_schema()
+                    # Fills the calendar of databases created before collection_days
+                    from .collection_days import ensure_collection_days
+                    ensure_collection_days()
+                    print("--- Database already initialized. Skipping. ---")
+                record_schema_version(fingerprint)
+
+    app.config['STARTUP_TIMINGS'] = timer.phases
+
+    # In-process scheduler, safe to enable in every worker: one elected leader runs the jobs.
+    # Do not combine with gunicorn --preload, whose workers would not inherit its threads.
+    if os.getenv('IN_PROCESS_SCHEDULER', '0') == '1':
+        from .scheduler import start_scheduler
+        start_scheduler(app)
+
+    # Import the LINE SDK off the request path unless disabled
+    if os.getenv('LINE_SDK_WARMUP', '1') != '0':
+        warm_up_line_clients()
 
     return app
@@ -0,0 +1,228 @@
+"""
+In-memory index of schedule area names for the 登録 command.
+
+Names like "東大井 1-4丁目" or "大井 1・2・4丁目" are parsed once into
+(town base name, chome number) keys, so resolving user input such as
+"東大井２丁目" is a normalisation pass plus a couple of dict lookups.
+There is one index per municipality, built from that ward's rows only.
+The process that reloads schedules drops its indexes straight away; every
+other process notices the new dataset version within AREA_INDEX_TTL.
+"""
+import difflib
+import re
+import threading
+import time
+import unicodedata
+
+from .models import db, Schedule, dataset_version
+
+# Maximum number of candidates offered back to the user
+MAX_CANDIDATES = 13 # LINE allows up to 13 quick reply items
+# Seconds between checks of the dataset version, as a backstop for reloads done by another process
+AREA_INDEX_TTL = 60
+
+_ADDRESS_PREFIX_ENDINGS = '都道府県市区町村'
+_KANJI_DIGITS = {'一': 1, '二': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_KANJI_NUMBER_RE = re.compile(r'[一二三四五六七八九十]+(?=丁|ちょうめ)')
+_NAME_RE = re.compile(r'^(\S+?)\s*([\d・\-]+)丁目\s*(.*)$')
+_INPUT_RE = re.compile(r'^(\D+?)(\d+)(?:丁目|丁|ちょうめ)?(.*)$')
+
+def _kanji_to_int(text):
+    """Converts kanji numerals up to 99 (e.g. '二', '十二') to an int."""
+    if '十' not in text:
+        return _KANJI_DIGITS.get(text, 0)
+    tens, _, ones = text.partition('十')
+    return _KANJI_DIGITS.get(tens, 1) * 10 + _KANJI_DIGITS.get(ones, 0)
+
+def normalize(text):
+    """Normalises full-width characters, kanji chome numbers and whitespace."""
+    text = unicodedata.normalize('NFKC', text)
+    text = _KANJI_NUMBER_RE.sub(lambda m: str(_kanji_to_int(m.group(0))), text)
+    text = text.replace('‐', '-').replace('−', '-')
+    return ''.join(text.split())
+
+def _parse_chome_spec(spec):
+    """'1-4' -> {1, 2, 3, 4}, '1・2・4' -> {1, 2, 4}, '5' -> {5}"""
+    numbers = set()
+    for part in spec.split('・'):
+        if '-' in part:
+            start, _, end = part.partition('-')
+            numbers.update(range(int(start), int(end) + 1))
+        elif part:
+            numbers.add(int(part))
+    return numbers
+
+class AreaIndex:
+    """Maps normalised user input to schedule names."""
+
+    def __init__(self, names):
+        self.exact = {} # Key: normalised full name, Value: schedule name
+        self.by_chome = {} # Key: (base, chome), Value: list of schedule names
+        self.by_base = {} # Key: base, Value: list of (sorted chome numbers, schedule name)
+        for name in names:
+            self.exact[normalize(name)] = name
+            match = _NAME_RE.match(unicodedata.normalize('NFKC', name))
+            if not match:
+                continue
+            base = normalize(match.group(1))
+            try:
+                chome_numbers = _parse_chome_spec(match.group(2))
+            except ValueError:
+                continue
+            for chome in chome_numbers:
+                self.by_chome.setdefault((base, chome), []).append(name)
+            self.by_base.setdefault(base, []).append((sorted(chome_numbers), name))
+
+    def lookup(self, text):
+        """
+        Resolves user input to a schedule.
+        Returns (schedule_name, candidates): schedule_name is set when the input
+        matches exactly one area, otherwise candidates lists the closest areas.
+        """
+        key = normalize(text)
+        if key in self.exact:
+            return self.exact[key], []
+
+        match = _INPUT_RE.match(key)
+        base, chome = (match.group(1), int(match.group(2))) if match else (key, None)
+        base, confident = self._resolve_base(base)
+        if base is None:
+            return None, []
+
+        names = self.by_chome.get((base, chome), [])
+        if len(names) == 1 and confident:
+            return names[0], []
+        if names:
+            return None, names[:MAX_CANDIDATES]
+
+        # Same town, other chome: nearest chome first
+        def distance(entry):
+            numbers, _ = entry
+            if chome is None:
+                return numbers[0]
+            return min(abs(n - chome) for n in numbers)
+        ranked = sorted(self.by_base[base], key=distance)
+        return None, [name for _, name in ranked[:MAX_CANDIDATES]]
+
+    def _resolve_base(self, base):
+        """
+        Finds the indexed town name for base, tolerating prefixes like '品川区' and typos.
+        Returns (base, confident); near misses are only offered as candidates.
+        """
+        if base in self.by_base:
+            return base, True
+        for i in range(1, len(base)):
+            if base[i:] in self.by_base:
+                # '品川区東大井' is safe to resolve, 'ひがし大井' -> '大井' is not
+                return base[i:], base[i - 1] in _ADDRESS_PREFIX_ENDINGS
+        close = difflib.get_close_matches(base, self.by_base, n=1, cutoff=0.6)
+        return (close[0], False) if close else (None, False)
+
+_indexes = {} # Key: municipality, Value: AreaIndex
+_municipalities = None # Municipality names, longest first
+_dataset_version = None # dataset_version() the cached indexes were built from
+_checked_at = 0.0 # time.monotonic() of the last dataset version check
+_index_lock = threading.Lock()
+
+def _check_dataset_version():
+    """Drops the cached indexes if the schedules were reloaded since, checking every AREA_INDEX_TTL seconds."""
+    global _municipalities, _dataset_version, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < AREA_INDEX_TTL:
+        return
+    version = dataset_version()
+    with _index_lock:
+        _checked_at = now
+        if version != _dataset_version:
+            _indexes.clear()
+            _municipalities = None
+            _dataset_version = version
+
+def get_municipalities():
+    """Returns the loaded municipality names, longest first, cached per process."""
+    global _municipalities
+    _check_dataset_version()
+    municipalities = _municipalities
+    if municipalities is None:
+        with _index_lock:
+            if _municipalities is None:
+                names = db.session.scalars(db.select(Schedule.municipality).distinct()).all()
+                _municipalities = sorted(names, key=len, reverse=True)
+            municipalities = _municipalities
+    return municipalities
+
+def get_area_index(municipality):
+    """Returns the AreaIndex of one municipality, building it from its rows on first use."""
+    _check_dataset_version()
+    index = _indexes.get(municipality)
+    if index is None:
+        with _index_lock:
+            index = _indexes.get(municipality)
+            if index is None:
+                index = AreaIndex(db.session.scalars(
+                    db.select(Schedule.name).where(Schedule.municipality == municipality)
+                ))
+                _indexes[municipality] = index
+    return index
+
+def split_municipality(text):
+    """
+    Splits a leading municipality name off user input.
+    Returns (municipality, rest), or (None, text) if the input names none.
+    """
+    key = normalize(text)
+    for municipality in get_municipalities():
+        prefix = normalize(municipality)
+        if key.startswith(prefix) and len(key) > len(prefix):
+            return municipality, key[len(prefix):]
+    return None, text
+
+def _confident_matches(text, municipalities):
+    """(municipality, schedule_name) for every ward whose index resolves text outright."""
+    matches = []
+    for municipality in municipalities:
+        schedule_name, _ = get_area_index(municipality).lookup(text)
+        if schedule_name is not None:
+            matches.append((municipality, schedule_name))
+    return matches
+
+def lookup_area(text, default_municipality=None):
+    """
+    Resolves 登録 input to (municipality, schedule_name, candidates), where
+    candidates is a list of (municipality, schedule_name).
+    The ward is taken from a leading municipality name, else default_municipality
+    (e.g. the user's current ward), else the only loaded ward, and that ward's
+    index is searched including near misses. Input that names no ward is also
+    checked against every ward for a confident match only, so its cost stays a
+    few dict lookups per ward.
+    """
+    municipality, rest = split_municipality(text)
+    named = municipality is not None
+    municipalities = get_municipalities()
+    if not named:
+        if default_municipality in municipalities:
+            municipality = default_municipality
+        elif len(municipalities) == 1:
+            municipality = municipalities[0]
+
+    if municipality is not None:
+        schedule_name, names = get_area_index(municipality).lookup(rest)
+        if schedule_name is None and not named and len(municipalities) > 1:
+            # The user may be moving to another ward without naming it
+            matches = _confident_matches(rest, municipalities)
+            if len(matches) == 1:
+                return matches[0][0], matches[0][1], []
+        return municipality, schedule_name, [(municipality, name) for name in names]
+
+    matches = _confident_matches(rest, municipalities)
+    if len(matches) == 1:
+        return matches[0][0], matches[0][1], []
+    return None, None, matches[:MAX_CANDIDATES]
+
+def invalidate_area_index():
+    """Drops the cached indexes so the next lookup rebuilds them from the current dataset version."""
+    global _municipalities, _checked_at
+    with _index_lock:
+        _indexes.clear()
+        _municipalities = None
+        _checked_at = 0.0
@@ -0,0 +1,383 @@
+"""
+Offline benchmark suite, run with `flask bench`.
+
+Builds a throwaway SQLite database, fills it with synthetic users spread over
+the real data/schedules areas, and points the LINE client at a local
+LineStubServer with configurable latency and 429 responses. Nothing leaves
+the machine. Results are written as JSON so runs can be compared across commits.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import click
+from sqlalchemy import delete, func, insert, select
+
+BENCH_CHANNEL_SECRET = 'bench-secret'
+# Users inserted per statement when building a population
+USER_INSERT_BATCH = 10000
+# Webhook bodies sent per command type when measuring /callback
+CALLBACK_COMMANDS = {
+    'register': '登録 {area}',
+    'garbage_type': '燃やすごみ',
+    'menu': 'メニュー',
+    'rules': 'ゴミのルール',
+}
+
+# --- Helpers ---
+
+def percentiles(samples_ms):
+    """p50/p90/p99/max of a list of millisecond samples."""
+    ordered = sorted(samples_ms)
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+    return {
+        'n': len(ordered),
+        'mean': round(statistics.fmean(ordered), 3),
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': round(ordered[-1], 3),
+    }
+
+def _elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@contextmanager
+def _patched_env(values):
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def _webhook_body(user_id, text=None):
+    """A signed-ready webhook body with one text message (or follow event if text is None)."""
+    event = {
+        'type': 'follow' if text is None else 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': 'bench',
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': 'bench-reply-token',
+    }
+    if text is None:
+        event['follow'] = {'isUnblocked': False}
+    else:
+        event['message'] = {'type': 'text', 'id': '1', 'quoteToken': 'q', 'text': text}
+    return json.dumps({'destination': 'bench', 'events': [event]}, ensure_ascii=False)
+
+def _sign(body):
+    digest = hmac.new(BENCH_CHANNEL_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+# --- Benchmarks ---
+
+def bench_load_schedule_data():
+    """Times a fresh load, an unchanged (hash skip) load, and a forced reload."""
+    from .data import load_schedule_data
+    from .models import db, CollectionDay, DatasetVersion, Schedule
+
+    db.session.execute(delete(CollectionDay))
+    db.session.execute(delete(Schedule))
+    db.session.execute(delete(DatasetVersion))
+    db.session.commit()
+
+    results = {}
+    for name, force in (('fresh', False), ('unchanged', False), ('forced', True)):
+        start = time.perf_counter()
+        load_schedule_data(force=force)
+        results[name + '_ms'] = _elapsed_ms(start)
+    return results
+
+def bench_area_lookup(area_names, rounds):
+    """Times building the area index and resolving typical 登録 inputs."""
+    from .area_index import AreaIndex
+
+    start = time.perf_counter()
+    index = AreaIndex(area_names)
+    build_ms = _elapsed_ms(start)
+
+    rng = random.Random(0)
+    inputs = {
+        'exact': list(area_names),
+        'unspaced': [name.replace(' ', '') for name in area_names],
+        'chome_only': [name.split(' ')[0] for name in area_names],
+        'typo': [name[:-1] + '目' if len(name) > 2 else name for name in area_names],
+        'unknown': ['存在しない町', 'テスト', '東京都品川区', '1丁目'],
+    }
+    results = {'areas': len(area_names), 'build_ms': build_ms}
+    for kind, texts in inputs.items():
+        samples = [rng.choice(texts) for _ in range(rounds)]
+        start = time.perf_counter()
+        for text in samples:
+            index.lookup(text)
+        results[kind + '_us_per_lookup'] = round((time.perf_counter() - start) * 1e6 / rounds, 3)
+    return results
+
+def bench_callback(app, area_names, requests_per_command):
+    """/callback latency percentiles per command type, through the test client."""
+    client = app.test_client()
+    rng = random.Random(1)
+    commands = dict(CALLBACK_COMMANDS, follow=None)
+    results = {}
+    for kind, template in commands.items():
+        samples = []
+        # One unmeasured request per type, so SDK imports and caches are warm
+        for i in range(-1, requests_per_command):
+            user_id = f"Ubench{i % 100:026x}"
+            text = template.format(area=rng.choice(area_names)) if template else None
+            body = _webhook_body(user_id, text)
+            start = time.perf_counter()
+            response = client.post(
+                '/callback', data=body.encode('utf-8'),
+                headers={'X-Line-Signature': _sign(body), 'Content-Type': 'application/json'},
+            )
+            if i >= 0:
+                samples.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise click.ClickException(f"/callback returned {response.status_code} for {kind}")
+        results[kind] = percentiles(samples)
+    return results
+
+def bench_event_decoding(rounds):
+    """
+    CPU time per webhook body spent verifying and decoding it: the SDK
+    WebhookParser against the fast path in app/fast_events.py.
+    """
+    from linebot.v3.webhook import WebhookParser
+    from .fast_events import decode_events, valid_signature
+
+    parser = WebhookParser(BENCH_CHANNEL_SECRET)
+    bodies = {
+        'text': _webhook_body(f"Ubench{0:026x}", 'メニュー'),
+        'follow': _webhook_body(f"Ubench{0:026x}"),
+    }
+    results = {}
+    for kind, body in bodies.items():
+        signature = _sign(body)
+        start = time.process_time()
+        for _ in range(rounds):
+            parser.parse(body, signature)
+        sdk_us = (time.process_time() - start) * 1e6 / rounds
+        start = time.process_time()
+        for _ in range(rounds):
+            if valid_signature(body, signature, BENCH_CHANNEL_SECRET):
+                decode_events(body)
+        fast_us = (time.process_time() - start) * 1e6 / rounds
+        results[kind] = {
+            'sdk_cpu_us': round(sdk_us, 2),
+            'fast_cpu_us': round(fast_us, 2),
+            'saved_cpu_us': round(sdk_us - fast_us, 2),
+        }
+    return results
+
+def _populate_users(count, areas):
+    """Replaces all users with `count` synthetic users spread over the (municipality, area) pairs."""
+    from .models import db, DispatchShard, NotificationOutbox, User
+    from .user_cache import user_cache
+
+    db.session.execute(delete(NotificationOutbox))
+    db.session.execute(delete(DispatchShard))
+    db.session.execute(delete(User))
+    db.session.commit()
+    rng = random.Random(count)
+    for offset in range(0, count, USER_INSERT_BATCH):
+        db.session.execute(insert(User), [
+            dict(zip(('municipality', 'area_name'), rng.choice(areas)), line_user_id=f"U{i:032x}")
+            for i in range(offset, min(count, offset + USER_INSERT_BATCH))
+        ])
+    db.session.commit()
+    user_cache.invalidate()
+
+def _busiest_date(start, days=7):
+    """The date in the next `days` days on which the most areas have a collection."""
+    from .models import db, CollectionDay
+
+    dates = [start + timedelta(days=offset) for offset in range(1, days + 1)]
+    counts = dict(db.session.execute(
+        select(CollectionDay.date, func.count(func.distinct(CollectionDay.area_name)))
+        .where(CollectionDay.date.in_(dates))
+        .group_by(CollectionDay.date)
+    ).all())
+    return max(dates, key=lambda d: counts.get(d, 0))
+
+def bench_notification_job(app, stub, populations, areas):
+    """daily_notification_job wall time and peak Python memory for each population."""
+    from .models import db, DispatchShard, NotificationOutbox
+    from .rules import JST
+    from .scheduler import daily_notification_job
+
+    results = []
+    target_date = _busiest_date(datetime.now(JST).date())
+    for count in populations:
+        print(f"Building {count} synthetic users...")
+        start = time.perf_counter()
+        _populate_users(count, areas)
+        populate_ms = _elapsed_ms(start)
+
+        # First run: wall time, untraced
+        sends_before = dict(stub.counts)
+        start = time.perf_counter()
+        daily_notification_job(app, target_date)
+        wall_ms = _elapsed_ms(start)
+        sends = {path: n - sends_before.get(path, 0) for path, n in stub.counts.items()}
+        delivered = db.session.query(NotificationOutbox).filter_by(date=target_date, status='sent').count()
+
+        # Second run from an empty outbox under tracemalloc: peak memory
+        db.session.execute(delete(NotificationOutbox))
+        db.session.execute(delete(DispatchShard))
+        db.session.commit()
+        tracemalloc.start()
+        try:
+            daily_notification_job(app, target_date)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        results.append({
+            'users': count,
+            'target_date': target_date.isoformat(),
+            'populate_ms': populate_ms,
+            'wall_ms': wall_ms,
+            'users_per_second': round(delivered / (wall_ms / 1000), 1) if wall_ms else None,
+            'delivered': delivered,
+            'stub_requests': sends,
+            'peak_traced_mb': round(peak / 2**20, 2),
+        })
+    return results
+
+def run_benchmarks(populations, latency_ms=0, rate_limit_every=0, retry_after=0,
+                   callback_requests=200, lookup_rounds=20000, decode_rounds=5000):
+    """Runs every benchmark against a temporary database and stub. Returns the results dict."""
+    from . import create_app
+    from .line_client import reset_line_clients
+    from .line_stub import LineStubServer
+    from .models import db, Schedule
+    from .area_index import invalidate_area_index
+    from .user_cache import user_cache
+
+    stub = LineStubServer(
+        ('127.0.0.1', 0),
+        latency=latency_ms / 1000,
+        rate_limit_every=rate_limit_every,
+        retry_after=retry_after,
+        record_bodies=False,
+    ).start()
+    workdir = tempfile.mkdtemp(prefix='gomi-bench-')
+    env = {
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}",
+        'LINE_API_HOST': stub.url,
+        'LINE_CHANNEL_SECRET': BENCH_CHANNEL_SECRET,
+        'LINE_CHANNEL_ACCESS_TOKEN': 'bench-token',
+        'WEBHOOK_MODE': 'sync',
+        'LINE_SDK_WARMUP': '0',
+    }
+    results = {
+        'commit': _git_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'params': {
+            'populations': populations,
+            'latency_ms': latency_ms,
+            'rate_limit_every': rate_limit_every,
+            'retry_after': retry_after,
+            'callback_requests': callback_requests,
+            'lookup_rounds': lookup_rounds,
+            'decode_rounds': decode_rounds,
+            'line_max_concurrency': int(os.getenv('LINE_MAX_CONCURRENCY', '8')),
+            'dispatch_mode': os.getenv('NOTIFICATION_DISPATCH_MODE', 'multicast'),
+        },
+    }
+    try:
+        with _patched_env(env):
+            reset_line_clients()
+            invalidate_area_index()
+            user_cache.invalidate()
+            bench_app = create_app()
+            with bench_app.app_context():
+                print("Benchmarking load_schedule_data...")
+                results['load_schedule_data'] = bench_load_schedule_data()
+                areas = db.session.query(Schedule.municipality, Schedule.name).all()
+                area_names = [name for _, name in areas]
+                print("Benchmarking area lookup...")
+                results['area_lookup'] = bench_area_lookup(area_names, lookup_rounds)
+                print("Benchmarking webhook event decoding...")
+                results['event_decoding'] = bench_event_decoding(decode_rounds)
+                print("Benchmarking /callback...")
+                results['callback_ms'] = bench_callback(bench_app, area_names, callback_requests)
+                results['notification_job'] = bench_notification_job(bench_app, stub, populations, areas)
+                db.session.remove()
+                db.engine.dispose()
+    finally:
+        stub.shutdown()
+        stub.server_close()
+        reset_line_clients()
+        invalidate_area_index()
+        user_cache.invalidate()
+    results['stub_requests'] = dict(stub.counts)
+    results['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return results
+
+def register_cli_command(app):
+    @app.cli.command('bench')
+    @click.option('--users', default='1000', help='Comma-separated user population sizes, e.g. 1000,100000,1000000.')
+    @click.option('--latency-ms', type=float, default=0, help='Latency of the stub LINE API.')
+    @click.option('--rate-limit-every', type=int, default=0, help='Stub answers every Nth push/multicast with 429.')
+    @click.option('--retry-after', type=int, default=0, help='Retry-After seconds sent with the stub 429s.')
+    @click.option('--requests', 'callback_requests', type=int, default=200, help='/callback requests per command type.')
+    @click.option('--output', default='bench_results.json', help='Where to write the JSON results.')
+    def bench_command(users, latency_ms, rate_limit_every, retry_after, callback_requests, output):
+        """Runs the offline benchmark suite against a throwaway database and a stub LINE API."""
+        populations = [int(n) for n in users.split(',') if n.strip()]
+        results = run_benchmarks(
+            populations,
+            latency_ms=latency_ms,
+            rate_limit_every=rate_limit_every,
+            retry_after=retry_after,
+            callback_requests=callback_requests,
+        )
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+        print(f"load_schedule_data: {results['load_schedule_data']}")
+        print(f"area lookup: {results['area_lookup']}")
+        for kind, stats in results['event_decoding'].items():
+            print(
+                f"decode {kind:<6} SDK {stats['sdk_cpu_us']:>8.1f} us  fast path {stats['fast_cpu_us']:>6.1f} us  "
+                f"saved {stats['saved_cpu_us']:>8.1f} us CPU per request"
+            )
+        for kind, stats in results['callback_ms'].items():
+            print(f"/callback {kind:<13} p50 {stats['p50']:>8.2f} ms  p99 {stats['p99']:>8.2f} ms")
+        for run in results['notification_job']:
+            print(
+                f"notification job {run['users']:>9} users: {run['wall_ms'] / 1000:8.2f} s, "
+                f"peak {run['peak_traced_mb']:.1f} MB traced, {run['delivered']} delivered"
+            )
+        print(f"Results written to {output}.")
@@ -1,122 +1,238 @@
 import os
-import re
 import threading
-from flask import Blueprint, request, abort, current_app
-
-# linebot imports are now mostly handled in app/__init__.py
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    ReplyMessageRequest,
-    TextMessage,
-    QuickReply,
-    QuickReplyItem,
-    MessageAction
-)
-from linebot.v3.webhooks import (
-    MessageEvent,
-    TextMessageContent,
-    FollowEvent
-)
-
-from .models import db, User, Schedule
-from .scheduler import daily_notification_job
-# Import the centrally created api clients from the app package
-from app import line_bot_api, handler
+from datetime import datetime, timezone
+from flask import Blueprint, Response, request, abort, current_app, jsonify
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, User
+from .area_index import get_municipalities, invalidate_area_index, lookup_area
+from .scheduler import format_notify_time, notification_bucket_job, parse_notify_time, JST
+from .rules import GARBAGE_TYPES, WEEKDAYS
+from .user_cache import get_cached_user, user_cache
+from .calendar_feed import feed_cache
+from .collection_days import next_collection_dates
+from .shards import latest_run_summary
+from .leader import leader_status
+# Import the centrally created webhook handler from the app package.
+# It is a lazy proxy: linebot itself is only imported on first use.
+from app import handler
+from .line_client import load_line_sdk
+from .fast_events import decode_events, fast_path_enabled, valid_signature
+# Replies go through the pooled, rate-limited transport shared with the nightly job
+from .line_transport import get_transport
+from .metrics import DB_QUERY_SECONDS, WEBHOOK_EVENTS, WEBHOOK_STAGE_SECONDS, render_metrics
 
 bp = Blueprint('bot', __name__)
 
 
-# --- New endpoint to be triggered by external cron job ---
-@bp.route('/trigger/<secret_key>', methods=['POST'])
-def trigger_scheduler(secret_key):
+def check_secret_key(secret_key):
+    """Aborts with 403 unless secret_key matches CRON_SECRET_KEY."""
     cron_secret = os.getenv('CRON_SECRET_KEY')
     if not cron_secret or secret_key != cron_secret:
         print(f"Invalid secret key received.")
         abort(403)
+
+# --- New endpoint to be triggered by external cron job ---
+# Call it every NOTIFY_BUCKET_MINUTES (15) minutes; each call sends to the users whose time has come,
+# including those in earlier buckets a missed call skipped. A once-a-day cron never reaches later buckets.
+@bp.route('/trigger/<secret_key>', methods=['POST'])
+def trigger_scheduler(secret_key):
+    check_secret_key(secret_key)
     
     app = current_app._get_current_object()
     
     # Run the job in a background thread so the HTTP request can return immediately
-    thread = threading.Thread(target=daily_notification_job, args=(app,))
+    thread = threading.Thread(target=notification_bucket_job, args=(app,))
     thread.start()
     
     print("Scheduler job triggered by cron.")
     return "Scheduler triggered."
 
-# --- Helper Functions for Area Parsing ---
-
-def parse_user_area(text):
-    """Parses user input like '東大井2丁目' into a base name and number."""
-    text = text.translate(str.maketrans('０１２３４５６７８９', '0123456789'))
-    match = re.match(r'(.+?)(\d+)丁目.*', text)
-    if match:
-        return match.group(1), int(match.group(2))
-    return text, None
-
-def is_number_in_range(num, schedule_name):
-    """Checks if a number is within the range specified by a schedule name."""
-    if num is None:
-        return False
-    schedule_name = schedule_name.translate(str.maketrans('０１２３４５６７８９', '0123456789'))
-    match = re.search(r'(\d+)-(\d+)丁目', schedule_name)
-    if match:
-        start, end = int(match.group(1)), int(match.group(2))
-        return start <= num <= end
-    match = re.findall(r'(\d+)・', schedule_name)
-    if match:
-        nums = [int(n) for n in match]
-        last_num_match = re.search(r'・(\d+)丁目', schedule_name)
-        if last_num_match:
-            nums.append(int(last_num_match.group(1)))
-        return num in nums
-    match = re.search(r'(\d+)丁目', schedule_name)
-    if match:
-        if '-' not in schedule_name and '・' not in schedule_name:
-            return num == int(match.group(1))
-    return False
+# --- Operator endpoint with in-process runtime statistics ---
+@bp.route('/stats/<secret_key>', methods=['GET'])
+def runtime_stats(secret_key):
+    check_secret_key(secret_key)
+    webhook_queue = current_app.extensions.get('webhook_queue')
+    return jsonify({
+        'user_cache': user_cache.stats(),
+        'calendar_feeds': feed_cache.stats(),
+        'dispatch': latest_run_summary(),
+        'scheduler': leader_status(current_app.extensions.get('scheduler_leader')),
+        'webhook_queue': webhook_queue.stats() if webhook_queue else None,
+    })
+
+# --- Prometheus scrape endpoint (set the scrape job's metrics_path to /metrics/<CRON_SECRET_KEY>) ---
+@bp.route('/metrics/<secret_key>', methods=['GET'])
+def metrics(secret_key):
+    check_secret_key(secret_key)
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+# --- Helper Functions ---
+
+# Key: garbage type label, Value: Schedule column
+GARBAGE_COLUMNS = {label: column for column, label in GARBAGE_TYPES}
+
+def format_date(date_obj):
+    """Formats a date like '10/20(月)'."""
+    return f"{date_obj.month}/{date_obj.day}({WEEKDAYS[date_obj.weekday()]})"
 
 # --- LINE Bot Webhook Handlers ---
 
 @bp.route("/callback", methods=['POST'])
 def callback():
+    load_line_sdk()
+
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+
+    # The handler itself skips this check, so it happens exactly once, here
+    with WEBHOOK_STAGE_SECONDS.labels('signature').time():
+        valid = valid_signature(body, signature)
+    if not valid:
         abort(400)
+
+    # Async mode: queue and acknowledge; workers do the rest
+    webhook_queue = current_app.extensions.get('webhook_queue')
+    if webhook_queue is not None:
+        webhook_queue.submit(body, signature)
+        return 'OK'
+
+    with WEBHOOK_STAGE_SECONDS.labels('handle').time():
+        process_webhook(body, signature)
     return 'OK'
 
-@handler.add(MessageEvent, message=TextMessageContent)
+def process_webhook(body, signature):
+    """
+    Runs the handlers for a verified payload. Text messages and follows are
+    decoded by the fast path; anything else goes through the SDK handler.
+    """
+    events = None
+    if fast_path_enabled():
+        with WEBHOOK_STAGE_SECONDS.labels('parse').time():
+            events = decode_events(body)
+    if events is None:
+        handler.handle(body, signature)
+        return
+    for event in events:
+        if event.type == 'message':
+            reply_to_text(event.user_id, event.text, event.reply_token)
+        else:
+            send_welcome(event.reply_token)
+
+def register_handlers(webhook_handler):
+    """Registers the event handlers; called when the SDK handler is first built."""
+    from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent
+
+    webhook_handler.add(MessageEvent, message=TextMessageContent)(handle_message)
+    webhook_handler.add(FollowEvent)(handle_follow)
+
 def handle_message(event):
-    text = event.message.text.strip()
-    user_id = event.source.user_id
+    reply_to_text(event.source.user_id, event.message.text, event.reply_token)
+
+def reply_to_text(user_id, text, reply_token):
+    """Answers a text message; shared by the SDK handler and the fast path."""
+    from linebot.v3.messaging import (
+        ReplyMessageRequest,
+        TextMessage,
+        QuickReply,
+        QuickReplyItem,
+        MessageAction
+    )
+
+    WEBHOOK_EVENTS.labels('message').inc()
+    text = text.strip()
     reply_text = ""
     quick_reply = None
 
     try:
-        user = db.session.query(User).filter_by(line_user_id=user_id).first()
-
+        # Only the branches that need the user look it up
         if text.startswith('登録'):
             user_input_area = text.split(maxsplit=1)[1].strip()
-            schedule = db.session.query(Schedule).filter_by(name=user_input_area).first()
-            if not schedule:
-                base_name, num = parse_user_area(user_input_area)
-                potential_schedules = db.session.query(Schedule).filter(Schedule.name.like(f"%{base_name}%")).all()
-                found_schedules = [s for s in potential_schedules if is_number_in_range(num, s.name)]
-                if len(found_schedules) == 1:
-                    schedule = found_schedules[0]
-            
-            if schedule:
-                if not user:
-                    user = User(line_user_id=user_id)
-                user.area_name = schedule.name
-                db.session.add(user)
-                db.session.commit()
-                reply_text = f"「{schedule.name}」を登録しました。\n毎晩20時にお知らせします。"
+            # Input without a ward name is looked up in the user's current ward first
+            with DB_QUERY_SECONDS.labels('user_lookup').time():
+                current = get_cached_user(user_id)
+            municipality, schedule_name, candidates = lookup_area(
+                user_input_area, current.municipality if current else None
+            )
+            multiple_wards = len(get_municipalities()) > 1
+
+            if schedule_name:
+                with DB_QUERY_SECONDS.labels('register').time():
+                    user = db.session.query(User).filter_by(line_user_id=user_id).first()
+                    if not user:
+                        user = User(line_user_id=user_id)
+                    user.municipality = municipality
+                    user.area_name = schedule_name
+                    # Other processes drop their cached entry for this user when they see it
+                    changed_at = datetime.now(timezone.utc).replace(tzinfo=None)
+                    user.area_changed_at = changed_at
+                    notify_time = format_notify_time(user.notify_minute)
+                    db.session.add(user)
+                    try:
+                        db.session.commit()
+                        registered = True
+                    except IntegrityError:
+                        # Either another worker registered this user concurrently, or a reload in
+                        # another process removed the area since this one built its index and the
+                        # users -> schedules foreign key rejected it
+                        db.session.rollback()
+                        try:
+                            registered = db.session.query(User).filter_by(line_user_id=user_id).update(
+                                {'municipality': municipality, 'area_name': schedule_name,
+                                 'area_changed_at': changed_at}
+                            ) > 0
+                            db.session.commit()
+                        except IntegrityError:
+                            db.session.rollback()
+                            registered = False
+                user_cache.invalidate(user_id)
+                display_name = f"{municipality} {schedule_name}" if multiple_wards else schedule_name
+                if registered:
+                    reply_text = (
+                        f"「{display_name}」を登録しました。\n収集日の前日{notify_time}にお知らせします。\n"
+                        "時刻は「通知 19:00」のように送信すると変更できます。"
+                    )
+                else:
+                    invalidate_area_index()
+                    reply_text = (
+                        f"「{display_name}」は現在登録できません。\n"
+                        "お手数ですが、もう一度「登録 〇〇」と送信してください。"
+                    )
+            elif candidates:
+                reply_text = f"「{user_input_area}」に近い地域が見つかりました。\n該当する地域を選んでください。"
+                quick_reply = QuickReply(items=[
+                    QuickReplyItem(action=MessageAction(
+                        label=(f"{ward} {name}" if multiple_wards else name)[:20],
+                        text=f"登録 {ward} {name}" if multiple_wards else f"登録 {name}",
+                    ))
+                    for ward, name in candidates
+                ])
+            elif multiple_wards and municipality is None:
+                reply_text = (
+                    f"「{user_input_area}」に一致する地域が見つかりませんでした。\n"
+                    "市区町村名から送信してください。\n例：登録 品川区 大井1丁目"
+                )
             else:
                 reply_text = f"「{user_input_area}」に一致する地域が見つかりませんでした。"
 
+        elif text.startswith('通知'):
+            notify_minute = parse_notify_time(text[len('通知'):])
+            with DB_QUERY_SECONDS.labels('register').time():
+                user = db.session.query(User).filter_by(line_user_id=user_id).first()
+                if user and notify_minute is not None:
+                    user.notify_minute = notify_minute
+                    db.session.commit()
+            if not user:
+                reply_text = "地域が登録されていません。\n「登録 〇〇」と送信して、お住まいの地域を登録してください。"
+            elif notify_minute is not None:
+                reply_text = f"通知時刻を{format_notify_time(notify_minute)}に変更しました。\n収集日の前日のこの時刻にお知らせします。"
+            else:
+                reply_text = (
+                    f"現在の通知時刻は{format_notify_time(user.notify_minute)}です。\n"
+                    "変更するには「通知 19:00」のように送信してください（15分単位）。"
+                )
+
         elif text in ["メニュー", "確認", "ごみの日", "収集日を確認"]:
             reply_text = "どのごみの日を確認しますか？"
             quick_reply = QuickReply(items=[
@@ -126,13 +242,17 @@ def handle_message(event):
             ])
 
         elif text in ["燃やすごみ", "資源", "陶器・ガラス・金属ごみ"]:
-            if user and user.schedule:
-                if text == "燃やすごみ":
-                    reply_text = f"【燃やすごみ】\n収集日は「{user.schedule.burnable}」です。"
-                elif text == "資源":
-                    reply_text = f"【資源】\n収集日は「{user.schedule.resources}」です。"
-                elif text == "陶器・ガラス・金属ごみ":
-                    reply_text = f"【陶器・ガラス・金属ごみ】\n収集日は「{user.schedule.ceramic_glass_metal}」です。"
+            with DB_QUERY_SECONDS.labels('user_lookup').time():
+                cached_user = get_cached_user(user_id)
+            if cached_user:
+                column = GARBAGE_COLUMNS[text]
+                with DB_QUERY_SECONDS.labels('collection_days').time():
+                    next_dates = next_collection_dates(
+                        cached_user.municipality, cached_user.area_name, column, datetime.now(JST).date(), 3
+                    )
+                reply_text = f"【{text}】\n収集日は「{getattr(cached_user, column)}」です。"
+                if next_dates:
+                    reply_text += f"\n次回: {'、'.join(format_date(d) for d in next_dates)}"
             else:
                 reply_text = "地域が登録されていません。\n「登録 〇〇」と送信して、お住まいの地域を登録してください。"
 
@@ -159,16 +279,22 @@ def handle_message(event):
         current_app.logger.error(f"Error handling message: {e}")
         reply_text = "エラーが発生しました。もう一度お試しください。"
 
-    line_bot_api.reply_message(
+    get_transport().reply(
         ReplyMessageRequest(
-            reply_token=event.reply_token,
+            reply_token=reply_token,
             messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
         )
     )
 
-@handler.add(FollowEvent)
 def handle_follow(event):
     """Handles the event when a user adds the bot as a friend."""
+    send_welcome(event.reply_token)
+
+def send_welcome(reply_token):
+    from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+
+    WEBHOOK_EVENTS.labels('follow').inc()
+
     pdf_url = "https://raw.githubusercontent.com/shuoh-yama/gomi-bot/main/data/sigengomi2024.pdf"
     welcome_message = (
         "友だち追加ありがとうございます！\n\n"
@@ -178,9 +304,9 @@ def handle_follow(event):
         "登録後は「メニュー」と入力すると、収集日を確認できます。\n\n"
         f"ゴミ出しの全体スケジュールはこちらのPDFから確認できます：\n{pdf_url}"
     )
-    line_bot_api.reply_message(
+    get_transport().reply(
         ReplyMessageRequest(
-            reply_token=event.reply_token,
+            reply_token=reply_token,
             messages=[TextMessage(text=welcome_message)]
         )
     )
@@ -0,0 +1,195 @@
+"""
+Read-only calendar feeds per area.
+
+/calendar/<municipality>/<area>.ics and .json list the coming collection
+dates from the materialized calendar, so a calendar app can subscribe instead
+of asking the bot. Rendered feeds are cached in-process and invalidated when
+schedule data is reloaded; responses carry a strong ETag and Cache-Control so
+clients and proxies revalidate with a cheap 304.
+"""
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import Blueprint, Response, abort, request
+from sqlalchemy import select
+
+from .models import db, CollectionDay, DEFAULT_MUNICIPALITY, Schedule
+from .rules import GARBAGE_TYPES, JST
+
+bp = Blueprint('calendar', __name__)
+
+# Days ahead of today listed in a feed
+FEED_DAYS = 180
+# Seconds clients and proxies may reuse a feed without revalidating
+FEED_MAX_AGE = 3600
+# Seconds a rendered feed stays cached, as a backstop for reloads done by another process
+FEED_CACHE_TTL = 600
+
+FEED_FORMATS = {
+    'ics': 'text/calendar; charset=utf-8',
+    'json': 'application/json; charset=utf-8',
+}
+
+# --- Rendering ---
+
+def _ics_escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _ics_fold(line):
+    """Folds a content line at 75 octets, as RFC 5545 requires."""
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line
+    parts = []
+    while data:
+        limit = 75 if not parts else 74 # Continuation lines start with a space
+        cut = min(limit, len(data))
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80: # Don't split a UTF-8 sequence
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+    return '\r\n '.join(parts)
+
+def render_ics(schedule, collections, today):
+    """An iCalendar feed with one all-day event per collection."""
+    uid_prefix = hashlib.sha1(f"{schedule.municipality}/{schedule.name}".encode('utf-8')).hexdigest()[:12]
+    stamp = today.strftime('%Y%m%dT000000Z')
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//gomi-bot//collection calendar//JA',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f"X-WR-CALNAME:{_ics_escape(f'ゴミ収集日 {schedule.municipality} {schedule.name}')}",
+        'X-WR-TIMEZONE:Asia/Tokyo',
+        'REFRESH-INTERVAL;VALUE=DURATION:P1D',
+        'X-PUBLISHED-TTL:P1D',
+    ]
+    for date_obj, label, column in collections:
+        lines += [
+            'BEGIN:VEVENT',
+            f"UID:{date_obj:%Y%m%d}-{column}-{uid_prefix}@gomi-bot",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART;VALUE=DATE:{date_obj:%Y%m%d}",
+            f"DTEND;VALUE=DATE:{date_obj + timedelta(days=1):%Y%m%d}",
+            f"SUMMARY:{_ics_escape(label)}",
+            'TRANSP:TRANSPARENT',
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return ''.join(_ics_fold(line) + '\r\n' for line in lines)
+
+def render_json(schedule, collections, today):
+    """A JSON feed with the rule strings and the collections grouped by date."""
+    by_date = {}
+    for date_obj, label, _ in collections:
+        by_date.setdefault(date_obj.isoformat(), []).append(label)
+    return json.dumps({
+        'municipality': schedule.municipality,
+        'area': schedule.name,
+        'generated_for': today.isoformat(),
+        'rules': {label: getattr(schedule, column) for column, label in GARBAGE_TYPES},
+        'collections': [{'date': d, 'types': types} for d, types in by_date.items()],
+    }, ensure_ascii=False)
+
+def build_feed(municipality, area_name, fmt, today):
+    """Renders a feed; returns None if the area does not exist."""
+    schedule = db.session.execute(
+        select(Schedule).where(Schedule.municipality == municipality, Schedule.name == area_name)
+    ).scalar_one_or_none()
+    if schedule is None:
+        return None
+    labels = dict(GARBAGE_TYPES)
+    order = {column: i for i, (column, _) in enumerate(GARBAGE_TYPES)}
+    rows = db.session.execute(
+        select(CollectionDay.date, CollectionDay.garbage_type)
+        .where(
+            CollectionDay.municipality == municipality,
+            CollectionDay.area_name == area_name,
+            CollectionDay.date >= today,
+            CollectionDay.date < today + timedelta(days=FEED_DAYS),
+        )
+    ).all()
+    collections = [
+        (date_obj, labels[column], column)
+        for date_obj, column in sorted(rows, key=lambda row: (row[0], order[row[1]]))
+    ]
+    render = render_ics if fmt == 'ics' else render_json
+    return render(schedule, collections, today)
+
+# --- Cache ---
+
+class FeedCache:
+    """Rendered feeds keyed by (municipality, area, format, day), each with its strong ETag."""
+
+    def __init__(self, ttl=FEED_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {} # Key: (municipality, area_name, fmt, date), Value: (body bytes, etag, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, municipality, area_name, fmt, today):
+        """Returns (body, etag), rendering on a miss, or None for an unknown area."""
+        key = (municipality, area_name, fmt, today)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > now:
+                self.hits += 1
+                return entry[0], entry[1]
+            self.misses += 1
+
+        text = build_feed(municipality, area_name, fmt, today)
+        if text is None:
+            return None
+        body = text.encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        with self._lock:
+            # Entries for earlier days are never read again
+            for stale in [k for k in self._entries if k[3] != today]:
+                del self._entries[stale]
+            self._entries[key] = (body, etag, now + self.ttl)
+        return body, etag
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+feed_cache = FeedCache()
+
+def invalidate_calendar_feeds():
+    """Drops every rendered feed; call after schedule data changes."""
+    feed_cache.invalidate()
+
+# --- Endpoint ---
+
+@bp.route('/calendar/<municipality>/<area_name>.<fmt>', methods=['GET'])
+def calendar_feed(municipality, area_name, fmt):
+    if fmt not in FEED_FORMATS:
+        abort(404)
+    today = datetime.now(JST).date()
+    feed = feed_cache.get(municipality, area_name, fmt, today)
+    if feed is None:
+        abort(404)
+    body, etag = feed
+
+    response = Response(body, content_type=FEED_FORMATS[fmt])
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = FEED_MAX_AGE
+    return response.make_conditional(request)
+
+# Feeds subscribed before multi-municipality support have no ward in the URL.
+# A separate view rather than route defaults, which would redirect the
+# canonical DEFAULT_MUNICIPALITY URL to this one.
+@bp.route('/calendar/<area_name>.<fmt>', methods=['GET'])
+def legacy_calendar_feed(area_name, fmt):
+    return calendar_feed(DEFAULT_MUNICIPALITY, area_name, fmt)
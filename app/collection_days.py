@@ -0,0 +1,123 @@
+"""
+Materialized collection calendar.
+
+The collection_days table holds one row per (date, municipality, area,
+garbage type) for a rolling horizon, generated from the compiled schedule
+rules. "Which areas of a municipality are collected on D" and "when is the
+next collection" become index lookups.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, CollectionDay, Schedule
+from .rules import GARBAGE_TYPES, JST
+
+# Number of days ahead of today kept in the calendar
+CALENDAR_HORIZON_DAYS = 400
+
+def _generate_rows(schedules, start, end):
+    """Yields collection_days rows for the given schedules between start and end (inclusive)."""
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    for schedule in schedules:
+        for column, _ in GARBAGE_TYPES:
+            rule = schedule.rule_for(column)
+            for day in days:
+                if rule.fires_on(day):
+                    yield {
+                        'date': day,
+                        'municipality': schedule.municipality,
+                        'area_name': schedule.name,
+                        'garbage_type': column,
+                    }
+
+def regenerate_collection_days(area_names=None, today=None, horizon=CALENDAR_HORIZON_DAYS, municipality=None):
+    """
+    Rebuilds the calendar rows from today onwards for the given areas
+    (all areas when area_names is None), optionally within one municipality.
+    Does not commit.
+    """
+    today = today or datetime.now(JST).date()
+    end = today + timedelta(days=horizon)
+
+    query = db.session.query(Schedule)
+    delete_stmt = delete(CollectionDay).where(CollectionDay.date >= today)
+    if municipality is not None:
+        query = query.filter(Schedule.municipality == municipality)
+        delete_stmt = delete_stmt.where(CollectionDay.municipality == municipality)
+    if area_names is not None:
+        area_names = list(area_names)
+        if not area_names:
+            return 0
+        query = query.filter(Schedule.name.in_(area_names))
+        delete_stmt = delete_stmt.where(CollectionDay.area_name.in_(area_names))
+
+    db.session.execute(delete_stmt)
+    rows = list(_generate_rows(query.all(), today, end))
+    if rows:
+        db.session.execute(insert(CollectionDay), rows)
+    return len(rows)
+
+def extend_collection_days(today=None, horizon=CALENDAR_HORIZON_DAYS):
+    """
+    Rolls the calendar forward so it covers today + horizon days and drops
+    past rows. Cheap when the calendar is already up to date. Commits.
+    """
+    today = today or datetime.now(JST).date()
+    end = today + timedelta(days=horizon)
+
+    last_date = db.session.scalar(select(func.max(CollectionDay.date)))
+    if last_date is None or last_date < today:
+        added = regenerate_collection_days(today=today, horizon=horizon)
+    elif last_date < end:
+        rows = list(_generate_rows(db.session.query(Schedule).all(), last_date + timedelta(days=1), end))
+        if rows:
+            db.session.execute(insert(CollectionDay), rows)
+        added = len(rows)
+    else:
+        added = 0
+
+    db.session.execute(delete(CollectionDay).where(CollectionDay.date < today))
+    db.session.commit()
+    return added
+
+def ensure_collection_days(today=None, horizon=CALENDAR_HORIZON_DAYS):
+    """
+    Fills the calendar up to the horizon at startup, so replies and the first
+    run of an upgraded database do not read an empty table. Several workers
+    may start at once; if another one fills it first, its rows are kept.
+    """
+    try:
+        added = extend_collection_days(today, horizon)
+    except IntegrityError:
+        db.session.rollback()
+        return 0
+    if added:
+        print(f"--- Added {added} collection day rows ---")
+    return added
+
+def collection_types_by_area(date_obj, municipality):
+    """Returns {area_name: [garbage type labels]} for every area of the municipality collected on the date."""
+    labels = dict(GARBAGE_TYPES)
+    types_by_area = {}
+    rows = db.session.execute(
+        select(CollectionDay.area_name, CollectionDay.garbage_type)
+        .where(CollectionDay.date == date_obj, CollectionDay.municipality == municipality)
+    )
+    for area_name, garbage_type in rows:
+        types_by_area.setdefault(area_name, []).append(labels[garbage_type])
+    return types_by_area
+
+def next_collection_dates(municipality, area_name, garbage_type, start, n):
+    """Returns the next n collection dates on or after start for one area and garbage type column."""
+    return list(db.session.scalars(
+        select(CollectionDay.date)
+        .where(
+            CollectionDay.municipality == municipality,
+            CollectionDay.area_name == area_name,
+            CollectionDay.garbage_type == garbage_type,
+            CollectionDay.date >= start,
+        )
+        .order_by(CollectionDay.date)
+        .limit(n)
+    ))
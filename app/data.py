@@ -1,43 +1,176 @@
+import hashlib
 import json
 import os
-from .models import db, Schedule
+from datetime import datetime, timezone
 
-def load_schedule_data():
+import click
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .models import db, CollectionDay, DatasetVersion, Schedule, User
+from .rules import validate_schedule_item
+from .area_index import invalidate_area_index
+from .calendar_feed import invalidate_calendar_feeds
+from .user_cache import user_cache
+from .collection_days import extend_collection_days, regenerate_collection_days
+
+# Columns compared and written by the loader, besides municipality and name
+SCHEDULE_COLUMNS = ('resources', 'burnable', 'ceramic_glass_metal')
+
+# One JSON file per municipality: {"municipality": "品川区", "areas": [...]}
+SCHEDULE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'schedules')
+
+def _upsert_schedules(municipality, rows):
+    """Inserts or updates one municipality's schedules by name in one bulk statement."""
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert_stmt = (postgresql if dialect == 'postgresql' else sqlite).insert(Schedule)
+        stmt = insert_stmt.on_conflict_do_update(
+            index_elements=['municipality', 'name'],
+            set_={column: insert_stmt.excluded[column] for column in SCHEDULE_COLUMNS},
+        )
+        db.session.execute(stmt, rows)
+        return
+    # Other databases: a bulk insert for new names and a bulk update by primary key
+    ids = dict(db.session.execute(
+        select(Schedule.name, Schedule.id).where(Schedule.municipality == municipality)
+    ).all())
+    new_rows = [row for row in rows if row['name'] not in ids]
+    updated_rows = [dict(row, id=ids[row['name']]) for row in rows if row['name'] in ids]
+    if new_rows:
+        db.session.execute(insert(Schedule), new_rows)
+    if updated_rows:
+        db.session.execute(update(Schedule), updated_rows)
+
+def _remove_schedules(municipality, names):
+    """Deletes one municipality's schedules, their calendar rows, and unregisters their users."""
+    detached = db.session.execute(
+        update(User)
+        .where(User.municipality == municipality, User.area_name.in_(names))
+        .values(municipality=None, area_name=None, area_changed_at=datetime.now(timezone.utc).replace(tzinfo=None))
+    ).rowcount
+    db.session.execute(
+        delete(CollectionDay)
+        .where(CollectionDay.municipality == municipality, CollectionDay.area_name.in_(names))
+    )
+    db.session.execute(
+        delete(Schedule)
+        .where(Schedule.municipality == municipality, Schedule.name.in_(names))
+    )
+    return detached
+
+def schedule_files(directory=None):
+    """Paths of every municipality's schedule file, in name order."""
+    directory = directory or SCHEDULE_DIR
+    return sorted(
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if filename.endswith('.json')
+    )
+
+def load_municipality(json_path, force=False):
     """
-    Loads garbage schedule data from schedule.json into the database.
-    This function is idempotent: it updates existing entries and adds new ones.
+    Loads one municipality's schedule file. Only that municipality's rows are
+    read, diffed and written, so the cost does not grow with other wards.
+    Skips the file when its content hash matches the last load (unless force=True).
+    Does not commit. Returns (municipality, counts).
     """
-    from flask import current_app
-    
-    json_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'schedule.json')
+    with open(json_path, 'rb') as f:
+        raw = f.read()
+    content_hash = hashlib.sha256(raw).hexdigest()
+    source = os.path.relpath(json_path, os.path.dirname(SCHEDULE_DIR))
+
+    version = db.session.get(DatasetVersion, source)
+    if version and version.content_hash == content_hash and not force:
+        print(f"{source} is unchanged since {version.loaded_at}. Skipping load.")
+        return None, {'skipped': True}
+
+    dataset = json.loads(raw.decode('utf-8'))
+    municipality = dataset['municipality']
+    areas = dataset['areas']
+
+    # Compile every rule up front so bad strings are reported once, here
+    errors = [error for item in areas for error in validate_schedule_item(item)]
+    for error in errors:
+        print(f"Invalid schedule rule in {source}: {error}")
 
-    with open(json_path, 'r', encoding='utf-8') as f:
-        schedules_from_json = json.load(f)
+    # Diff against this municipality's current rows, read in a single query
+    existing = {
+        name: values
+        for name, *values in db.session.execute(
+            select(Schedule.name, *(getattr(Schedule, column) for column in SCHEDULE_COLUMNS))
+            .where(Schedule.municipality == municipality)
+        )
+    }
+    rows = []
+    added, changed, unchanged = [], [], []
+    for item in areas:
+        row = {
+            'municipality': municipality,
+            'name': item['name'],
+            **{column: item[column] for column in SCHEDULE_COLUMNS},
+        }
+        current = existing.get(item['name'])
+        if current is None:
+            added.append(item['name'])
+        elif list(current) != [row[column] for column in SCHEDULE_COLUMNS]:
+            changed.append(item['name'])
+        else:
+            unchanged.append(item['name'])
+            continue
+        rows.append(row)
+    json_names = {item['name'] for item in areas}
+    removed = [name for name in existing if name not in json_names]
+
+    if rows:
+        _upsert_schedules(municipality, rows)
+    detached = _remove_schedules(municipality, removed) if removed else 0
+    regenerate_collection_days(added + changed, municipality=municipality)
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if version:
+        version.content_hash = content_hash
+        version.loaded_at = now
+    else:
+        db.session.add(DatasetVersion(source=source, content_hash=content_hash, loaded_at=now))
+
+    print(
+        f"Loaded {source} ({municipality}): {len(added)} added, {len(changed)} changed, "
+        f"{len(unchanged)} unchanged, {len(removed)} removed."
+    )
+    if detached:
+        print(f"Warning: {detached} users were registered to removed areas and must register again.")
+    return municipality, {
+        'skipped': False,
+        'added': len(added),
+        'changed': len(changed),
+        'unchanged': len(unchanged),
+        'removed': len(removed),
+    }
+
+def load_schedule_data(force=False):
+    """
+    Loads every municipality's schedule file from data/schedules into the database.
+    This function is idempotent: each file is diffed against the current rows
+    of its municipality and applied with bulk statements, and files whose
+    content hash matches the last load are skipped (unless force=True).
+    Returns {municipality: counts} for the files that were loaded.
+    """
+    from flask import current_app
 
     with current_app.app_context():
-        for item in schedules_from_json:
-            schedule = db.session.query(Schedule).filter_by(name=item['name']).first()
-            
-            if schedule:
-                # Update existing schedule if data differs
-                if (schedule.resources != item['resources'] or
-                    schedule.burnable != item['burnable'] or
-                    schedule.ceramic_glass_metal != item['ceramic_glass_metal']):
-                    schedule.resources = item['resources']
-                    schedule.burnable = item['burnable']
-                    schedule.ceramic_glass_metal = item['ceramic_glass_metal']
-            else:
-                # Add new schedule
-                schedule = Schedule(
-                    name=item['name'],
-                    resources=item['resources'],
-                    burnable=item['burnable'],
-                    ceramic_glass_metal=item['ceramic_glass_metal']
-                )
-                db.session.add(schedule)
-        
+        results = {}
+        for json_path in schedule_files():
+            municipality, counts = load_municipality(json_path, force=force)
+            if municipality is not None:
+                results[municipality] = counts
         db.session.commit()
-        print(f"Updated/loaded {len(schedules_from_json)} schedule records into the database.")
+
+        if any(counts['added'] or counts['changed'] or counts['removed'] for counts in results.values()):
+            invalidate_area_index()
+            invalidate_calendar_feeds()
+            user_cache.invalidate()
+        return results
 
 def register_cli_command(app):
     @app.cli.command('init-db')
@@ -48,3 +181,19 @@ def register_cli_command(app):
             db.create_all()
             print("Initialized the database.")
             load_schedule_data()
+
+    @app.cli.command('refresh-calendar')
+    def refresh_calendar_command():
+        """Fills the collection_days calendar up to the rolling horizon."""
+        with app.app_context():
+            added = extend_collection_days()
+            print(f"Added {added} collection day rows.")
+
+    @app.cli.command('send-notifications')
+    @click.option('--date', 'date_str', default=None, help='Collection date (YYYY-MM-DD). Defaults to tomorrow.')
+    @click.option('--workers', type=int, default=None, help='Worker threads claiming shards (default: DISPATCH_WORKERS).')
+    def send_notifications_command(date_str, workers):
+        """Runs the notification job now, or joins a run in progress, sending only what is still pending."""
+        from .scheduler import daily_notification_job
+        target_date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else None
+        daily_notification_job(app, target_date, workers=workers)
@@ -0,0 +1,327 @@
+"""
+Outbound notification dispatch.
+
+NotificationDispatcher groups recipients by message text and sends them with
+multicast (or one push per user) through the shared LineTransport, retrying
+rate-limited and server-side failures with exponential backoff that honours
+Retry-After. A circuit breaker per endpoint stops retrying once LINE keeps
+failing, so an outage costs a bounded wait rather than one backoff sequence
+per chunk; the undelivered rows stay pending in the outbox for the next run.
+Logging is aggregated: progress every PROGRESS_LOG_INTERVAL seconds, the
+first few errors verbatim (per ErrorSampler, which a nightly run shares
+between all of its dispatchers), and counts per error in the summary.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+import urllib3
+
+from .line_client import line_concurrency, load_line_sdk
+from .line_transport import get_transport
+from .metrics import NOTIFICATIONS, NOTIFICATION_RETRIES
+
+# The Messaging API accepts at most 500 recipients per multicast request
+MULTICAST_CHUNK_SIZE = 500
+
+# Retry policy for 429 and 5xx responses
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# Consecutive server-side failures of one endpoint that open its circuit
+CIRCUIT_BREAKER_THRESHOLD = 5
+# Seconds an open circuit fails calls without sending them
+CIRCUIT_BREAKER_COOLDOWN_SECONDS = 30
+
+# Seconds between progress log lines while sending
+PROGRESS_LOG_INTERVAL = 30
+# Occurrences of each (kind, error) logged individually per ErrorSampler; the rest are only counted
+LOG_SAMPLE_SIZE = 5
+
+def is_retryable(error):
+    """429s, 5xxs and connection errors are worth retrying; other errors are not."""
+    if isinstance(error, CircuitOpenError):
+        return True # Never sent; a later run tries again
+    status = getattr(error, 'status', None) # Set on linebot ApiException
+    if status is None:
+        return isinstance(error, (OSError, urllib3.exceptions.HTTPError))
+    return status == 429 or status >= 500
+
+def describe_error(error):
+    """A short, single-line description of a send error."""
+    if getattr(error, 'status', None) is not None:
+        return f"HTTP {error.status} {error.reason}"
+    return f"{error.__class__.__name__}: {error}"[:255]
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retry number `attempt` (0-based)."""
+    headers = getattr(error, 'headers', None) or {}
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_BACKOFF_SECONDS)
+        except ValueError:
+            pass
+    return min(BACKOFF_BASE_SECONDS * (2 ** attempt), MAX_BACKOFF_SECONDS)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit is open."""
+
+    def __init__(self, endpoint):
+        super().__init__(f"{endpoint} circuit open after repeated LINE API failures")
+        self.endpoint = endpoint
+
+class CircuitBreaker:
+    """
+    Counts consecutive 5xx and connection failures per endpoint. Once there
+    are `threshold` in a row, calls to that endpoint fail fast for `cooldown`
+    seconds; after that calls go through again, and the first success closes
+    the circuit. Shared by every dispatcher in the process.
+    """
+
+    def __init__(self, threshold=CIRCUIT_BREAKER_THRESHOLD, cooldown=CIRCUIT_BREAKER_COOLDOWN_SECONDS,
+                 clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._failures = Counter() # Key: endpoint, Value: consecutive failures
+        self._open_until = {} # Key: endpoint, Value: clock() when calls go through again
+        self._lock = threading.Lock()
+
+    def allow(self, endpoint):
+        with self._lock:
+            return self._open_until.get(endpoint, 0) <= self.clock()
+
+    def record_success(self, endpoint):
+        with self._lock:
+            self._failures[endpoint] = 0
+
+    def record_failure(self, endpoint):
+        """Returns True if this failure opened the circuit."""
+        with self._lock:
+            self._failures[endpoint] += 1
+            if self._failures[endpoint] < self.threshold or self._open_until.get(endpoint, 0) > self.clock():
+                return False
+            self._open_until[endpoint] = self.clock() + self.cooldown
+            return True
+
+circuit_breaker = CircuitBreaker()
+
+class ErrorSampler:
+    """
+    Counts errors by (kind, error description) so only the first `size` of
+    each are logged verbatim. Pass one sampler to every dispatcher of a run to
+    sample across the whole run rather than per dispatcher.
+    """
+
+    def __init__(self, size=LOG_SAMPLE_SIZE):
+        self.size = size
+        self.counts = Counter() # Key: (kind, error description), Value: occurrences
+        self._lock = threading.Lock()
+
+    def record(self, kind, error):
+        """Counts one occurrence and returns how many there have been so far."""
+        with self._lock:
+            self.counts[kind, error] += 1
+            return self.counts[kind, error]
+
+    def summary(self, top=5):
+        with self._lock:
+            return ', '.join(f"{kind} {error} x{count}" for (kind, error), count in self.counts.most_common(top))
+
+class NotificationDispatcher:
+    """
+    Collects (user_id, message) pairs and sends them to LINE.
+    In 'multicast' mode recipients with identical message text are grouped and
+    sent in chunks of up to MULTICAST_CHUNK_SIZE; a chunk rejected with a 4xx
+    falls back to one push per user, while one that failed with a retryable
+    error is reported as failed for every user, so the outbox retries it.
+    In 'push' mode every user gets an individual push.
+    Requests run concurrently on the shared LineTransport; results are handled
+    in the calling thread, and delivered user ids and failures are collected
+    for take_results().
+    """
+
+    def __init__(self, app, mode=None, chunk_size=MULTICAST_CHUNK_SIZE,
+                 max_retries=MAX_RETRIES, sleep=time.sleep, transport=None, breaker=None, sampler=None):
+        load_line_sdk()
+        self.app = app
+        self.mode = mode or os.getenv('NOTIFICATION_DISPATCH_MODE', 'multicast')
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.transport = transport or get_transport()
+        self.breaker = breaker or circuit_breaker
+        # A sampler shared by a run is summarised once by its owner, not by every dispatcher
+        self.owns_sampler = sampler is None
+        self.sampler = sampler or ErrorSampler()
+        # Bound the work queued ahead of the pool so memory stays flat. Each dispatcher
+        # (one per dispatch worker) keeps its LINE_MAX_CONCURRENCY share of the pool busy
+        self.max_inflight = min(self.transport.concurrency, line_concurrency()) * 4
+        self.pending = {} # Key: message text, Value: list of user_ids
+        self.inflight = deque() # (endpoint, future, message, user_ids, is_fallback)
+        self.delivered = [] # user_ids
+        self.failures = [] # (user_id, error message, retryable)
+        self._stats_lock = threading.Lock()
+        self._last_progress_log = time.monotonic()
+        self.stats = {
+            'chunks_ok': 0,
+            'chunks_failed': 0,
+            'sent': 0,
+            'failed': 0,
+            'fallback_sent': 0,
+            'retries': 0,
+        }
+
+    def add(self, user_id, message):
+        if self.mode != 'multicast':
+            self._submit_push(user_id, message)
+        else:
+            user_ids = self.pending.setdefault(message, [])
+            user_ids.append(user_id)
+            if len(user_ids) >= self.chunk_size:
+                self._submit_multicast(message, self.pending.pop(message))
+        while len(self.inflight) >= self.max_inflight:
+            self._collect_oldest()
+
+    def flush(self):
+        """Sends every partially filled group and waits for all requests in flight."""
+        for message, user_ids in list(self.pending.items()):
+            self._submit_multicast(message, user_ids)
+        self.pending.clear()
+        while self.inflight:
+            self._collect_oldest()
+        return self.stats
+
+    def take_results(self):
+        """Returns and clears (delivered user_ids, failures) collected so far."""
+        delivered, failures = self.delivered, self.failures
+        self.delivered, self.failures = [], []
+        return delivered, failures
+
+    def log_summary(self):
+        self.app.logger.info(
+            f"Notification dispatch finished ({self.mode}): "
+            f"{self.stats['sent']} sent, {self.stats['failed']} failed, "
+            f"{self.stats['chunks_ok']} chunks ok, {self.stats['chunks_failed']} chunks failed, "
+            f"{self.stats['fallback_sent']} sent via push fallback, {self.stats['retries']} retries."
+        )
+        if self.owns_sampler and self.sampler.counts:
+            self.app.logger.warning(f"Notification dispatch errors: {self.sampler.summary()}")
+
+    def _log_sampled(self, level, kind, error, message):
+        """Counts an error and logs only the first few of each kind and error seen by the sampler."""
+        seen = self.sampler.record(kind, error)
+        if seen <= self.sampler.size:
+            self.app.logger.log(level, message)
+        if seen == self.sampler.size:
+            self.app.logger.log(level, f"Further '{kind} {error}' errors are counted in the summary only.")
+
+    def _log_progress(self):
+        now = time.monotonic()
+        if now - self._last_progress_log >= PROGRESS_LOG_INTERVAL:
+            self._last_progress_log = now
+            self.app.logger.info(
+                f"Notification dispatch progress: {self.stats['sent']} sent, {self.stats['failed']} failed, "
+                f"{self.stats['retries']} retries, {len(self.inflight)} requests in flight."
+            )
+
+    def _send_with_retry(self, endpoint, request):
+        """
+        Runs on a transport thread. Retries retryable errors with backoff,
+        reusing one retry key so LINE drops duplicates of an accepted request.
+        """
+        retry_key = str(uuid.uuid4())
+        attempt = 0
+        while True:
+            if not self.breaker.allow(endpoint):
+                raise CircuitOpenError(endpoint)
+            try:
+                result = self.transport.call(endpoint, request, x_line_retry_key=retry_key)
+            except Exception as e:
+                if attempt > 0 and getattr(e, 'status', None) == 409:
+                    self.breaker.record_success(endpoint)
+                    return None # An earlier attempt with this retry key was accepted
+                # 429s are LINE pacing us, not an outage: they are retried but never open the circuit
+                if is_retryable(e) and getattr(e, 'status', None) != 429 and self.breaker.record_failure(endpoint):
+                    self.app.logger.error(
+                        f"LINE {endpoint} calls keep failing ({describe_error(e)}); not sending any for "
+                        f"{self.breaker.cooldown}s. Undelivered reminders stay pending for the next run."
+                    )
+                if attempt >= self.max_retries or not is_retryable(e) or not self.breaker.allow(endpoint):
+                    raise
+                delay = retry_delay(e, attempt)
+                with self._stats_lock:
+                    self.stats['retries'] += 1
+                NOTIFICATION_RETRIES.inc()
+                self._log_sampled(
+                    logging.WARNING, 'retry', describe_error(e),
+                    f"LINE API call failed ({describe_error(e)}), retrying in {delay:.1f}s.",
+                )
+                self.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.record_success(endpoint)
+                return result
+
+    def _submit_multicast(self, message, user_ids):
+        from linebot.v3.messaging import MulticastRequest, TextMessage
+
+        request = MulticastRequest(to=user_ids, messages=[TextMessage(text=message)])
+        future = self.transport.submit(self._send_with_retry, 'multicast', request)
+        self.inflight.append(('multicast', future, message, user_ids, False))
+
+    def _submit_push(self, user_id, message, is_fallback=False):
+        from linebot.v3.messaging import PushMessageRequest, TextMessage
+
+        request = PushMessageRequest(to=user_id, messages=[TextMessage(text=message)])
+        future = self.transport.submit(self._send_with_retry, 'push_message', request)
+        self.inflight.append(('push_message', future, message, [user_id], is_fallback))
+
+    def _collect_oldest(self):
+        endpoint, future, message, user_ids, is_fallback = self.inflight.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            if endpoint == 'multicast':
+                self.stats['chunks_failed'] += 1
+                if is_retryable(e):
+                    # Rate limits, outages and timeouts hit every push too; the rows stay pending instead
+                    self.stats['failed'] += len(user_ids)
+                    NOTIFICATIONS.labels('failed').inc(len(user_ids))
+                    self.failures.extend((user_id, describe_error(e), True) for user_id in user_ids)
+                    self._log_sampled(
+                        logging.ERROR, 'multicast', describe_error(e),
+                        f"Multicast chunk of {len(user_ids)} users failed, left for retry: {describe_error(e)}",
+                    )
+                    return
+                # A 4xx can be caused by one bad recipient; push to each so the rest still get it
+                self._log_sampled(
+                    logging.ERROR, 'multicast', describe_error(e),
+                    f"Multicast chunk of {len(user_ids)} users failed, falling back to push: {describe_error(e)}",
+                )
+                for user_id in user_ids:
+                    self._submit_push(user_id, message, is_fallback=True)
+                return
+            self.stats['failed'] += 1
+            NOTIFICATIONS.labels('failed').inc()
+            self.failures.append((user_ids[0], describe_error(e), is_retryable(e)))
+            self._log_sampled(
+                logging.ERROR, 'push', describe_error(e),
+                f"Failed to send notification to {user_ids[0]}: {describe_error(e)}",
+            )
+            return
+
+        self.stats['sent'] += len(user_ids)
+        NOTIFICATIONS.labels('sent').inc(len(user_ids))
+        self.delivered.extend(user_ids)
+        if endpoint == 'multicast':
+            self.stats['chunks_ok'] += 1
+        elif is_fallback:
+            self.stats['fallback_sent'] += 1
+            NOTIFICATIONS.labels('fallback_sent').inc()
+        self._log_progress()
@@ -0,0 +1,69 @@
+"""
+Fast path for the webhook events the bot receives most.
+
+Nearly every payload is a text message or a follow event, yet
+WebhookHandler.handle builds the SDK's generated model classes for the whole
+payload before a handler runs. decode_events reads the raw JSON into minimal
+slotted FastEvent structs instead; bot.process_webhook hands those straight
+to the command logic and gives any payload with another event type to the
+full SDK handler. Set WEBHOOK_FAST_PATH=0 to always use the SDK.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+class FastEvent:
+    """The fields of a text message or follow event that the handlers use."""
+    __slots__ = ('type', 'reply_token', 'user_id', 'text')
+
+    def __init__(self, type, reply_token, user_id, text=None):
+        self.type = type
+        self.reply_token = reply_token
+        self.user_id = user_id
+        self.text = text
+
+def fast_path_enabled():
+    return os.getenv('WEBHOOK_FAST_PATH', '1') != '0'
+
+def valid_signature(body, signature, channel_secret=None):
+    """Checks X-Line-Signature: base64 of the HMAC-SHA256 of the body keyed by the channel secret."""
+    channel_secret = channel_secret or os.getenv('LINE_CHANNEL_SECRET')
+    if not channel_secret or not signature:
+        return False
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest), signature.encode('utf-8'))
+
+def _decode_event(event):
+    kind = event.get('type')
+    source = event.get('source') or {}
+    if kind == 'message':
+        message = event.get('message') or {}
+        text = message.get('text')
+        if message.get('type') != 'text' or not isinstance(text, str):
+            return None
+        return FastEvent('message', event.get('replyToken'), source.get('userId'), text)
+    if kind == 'follow':
+        return FastEvent('follow', event.get('replyToken'), source.get('userId'))
+    return None
+
+def decode_events(body):
+    """
+    Decodes a webhook body into FastEvents, or returns None if it is not valid
+    JSON or holds any event the fast path does not cover.
+    """
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    events = payload.get('events') if isinstance(payload, dict) else None
+    if not isinstance(events, list):
+        return None
+    decoded = []
+    for event in events:
+        fast_event = _decode_event(event) if isinstance(event, dict) else None
+        if fast_event is None:
+            return None
+        decoded.append(fast_event)
+    return decoded
@@ -0,0 +1,184 @@
+"""
+Leader election for the in-process scheduler.
+
+Under gunicorn every worker, on every instance, may start the scheduler, but
+only the elected leader runs its jobs. On PostgreSQL leadership is a
+session-level advisory lock held on a dedicated connection, so it is released
+as soon as the leader's process or connection dies. On other databases it is
+a lease row that the leader renews on every heartbeat and that another
+process takes over once it has not been renewed for LEADER_LEASE_SECONDS.
+Either way the scheduler_leases row names the current leader and its last
+heartbeat, which /stats reports.
+"""
+import atexit
+import os
+import socket
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import case, insert, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, SchedulerLease
+from .metrics import SCHEDULER_LEADER
+
+# Name of the scheduler_leases row for the scheduled jobs
+SCHEDULER_LEASE = 'scheduler'
+# Seconds between heartbeats; followers try to take over at the same pace
+LEADER_HEARTBEAT_SECONDS = 10
+# A lease not renewed for this long is free to take (non-PostgreSQL databases)
+LEADER_LEASE_SECONDS = 30
+# pg_try_advisory_lock key; any constant shared by every process of the app works
+ADVISORY_LOCK_KEY = zlib.crc32(b'gomi-bot scheduler leader')
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def process_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class LeaderElector:
+    """
+    Keeps trying to become (and stay) leader from a background thread.
+    is_leader says whether this process currently holds leadership.
+    """
+
+    def __init__(self, engine, logger, name=SCHEDULER_LEASE,
+                 heartbeat_seconds=LEADER_HEARTBEAT_SECONDS, lease_seconds=LEADER_LEASE_SECONDS):
+        self.engine = engine
+        self.logger = logger
+        self.name = name
+        self.heartbeat_seconds = heartbeat_seconds
+        self.lease_seconds = lease_seconds
+        self.identity = process_name()
+        self.use_advisory_lock = engine.dialect.name == 'postgresql'
+        self.is_leader = False
+        self._lock_connection = None # Holds the advisory lock on PostgreSQL
+        self._lock = threading.Lock() # Serialises heartbeats from the thread and from confirm()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='scheduler-leader', daemon=True)
+        self._thread.start()
+        # Hand leadership over straight away on a clean shutdown instead of after the lease
+        atexit.register(self.stop)
+        return self
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.heartbeat()
+            self._stopped.wait(self.heartbeat_seconds)
+
+    def heartbeat(self):
+        """Acquires or renews leadership. Returns is_leader."""
+        with self._lock:
+            try:
+                if self.use_advisory_lock:
+                    leader = self._hold_advisory_lock()
+                    if leader:
+                        self._write_lease(force=True)
+                else:
+                    leader = self._write_lease(force=False)
+            except Exception as e:
+                self.logger.error(f"Scheduler leader heartbeat failed: {e}")
+                self._close_lock_connection()
+                leader = False
+            self._set_leader(leader)
+            return leader
+
+    def confirm(self):
+        """Renews leadership right before a job runs, so a stale leader does not run it."""
+        return self.heartbeat()
+
+    def stop(self):
+        """Stops the heartbeat and releases leadership if held."""
+        self._stopped.set()
+        with self._lock:
+            if self.is_leader:
+                try:
+                    with self.engine.begin() as conn:
+                        conn.execute(
+                            update(SchedulerLease)
+                            .where(SchedulerLease.name == self.name, SchedulerLease.holder == self.identity)
+                            .values(expires_at=_utcnow())
+                        )
+                except Exception as e:
+                    self.logger.warning(f"Could not release the scheduler lease: {e}")
+            self._close_lock_connection()
+            self._set_leader(False)
+
+    def _set_leader(self, leader):
+        if leader != self.is_leader:
+            if leader:
+                self.logger.info(f"{self.identity} is now the scheduler leader.")
+            else:
+                self.logger.warning(f"{self.identity} is no longer the scheduler leader.")
+        self.is_leader = leader
+        SCHEDULER_LEADER.set(1 if leader else 0)
+
+    def _hold_advisory_lock(self):
+        if self._lock_connection is None:
+            # Autocommit, so the connection never sits idle in a transaction
+            self._lock_connection = self.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        if self.is_leader:
+            # The lock lives as long as the session; fails if the connection was lost
+            self._lock_connection.execute(text('SELECT 1'))
+            return True
+        return bool(self._lock_connection.execute(
+            text('SELECT pg_try_advisory_lock(:key)'), {'key': ADVISORY_LOCK_KEY}
+        ).scalar())
+
+    def _close_lock_connection(self):
+        if self._lock_connection is not None:
+            try:
+                self._lock_connection.close() # Ends the session, which releases the lock
+            except Exception:
+                pass
+            self._lock_connection = None
+
+    def _write_lease(self, force):
+        """
+        Takes or renews the lease row. Unless force, only succeeds if this
+        process holds it or it has expired. Returns True on success.
+        """
+        now = _utcnow()
+        values = {
+            'holder': self.identity,
+            'heartbeat_at': now,
+            'expires_at': now + timedelta(seconds=self.lease_seconds),
+        }
+        with self.engine.begin() as conn:
+            query = update(SchedulerLease).where(SchedulerLease.name == self.name)
+            if not force:
+                query = query.where(or_(SchedulerLease.holder == self.identity, SchedulerLease.expires_at < now))
+            renewed = conn.execute(query.values(
+                acquired_at=case((SchedulerLease.holder == self.identity, SchedulerLease.acquired_at), else_=now),
+                **values,
+            )).rowcount
+        if renewed:
+            return True
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(insert(SchedulerLease).values(name=self.name, acquired_at=now, **values))
+        except IntegrityError:
+            # The row exists and another process holds an unexpired lease
+            return False
+        return True
+
+def leader_status(elector=None):
+    """The current lease holder for operators, plus this process's view if it takes part."""
+    lease = db.session.execute(
+        select(SchedulerLease).where(SchedulerLease.name == SCHEDULER_LEASE)
+    ).scalar_one_or_none()
+    status = {
+        'leader': lease.holder if lease else None,
+        'acquired_at': lease.acquired_at.isoformat() if lease else None,
+        'heartbeat_at': lease.heartbeat_at.isoformat() if lease else None,
+        'expired': lease.expires_at < _utcnow() if lease else None,
+    }
+    if elector is not None:
+        status['this_process'] = elector.identity
+        status['is_leader'] = elector.is_leader
+    return status
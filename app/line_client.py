@@ -0,0 +1,132 @@
+"""
+Lazily constructed LINE SDK objects.
+
+Importing the linebot SDK and building its ApiClient costs well over a second,
+which used to be paid by create_app before the first webhook could be served.
+line_bot_api and handler are proxies that import and build the real objects on
+first attribute access, so a woken instance is ready as soon as Flask is.
+"""
+import os
+import threading
+
+# Serialises every SDK import: importing linebot from two threads at once can
+# trip the interpreter's import deadlock detection
+_sdk_lock = threading.RLock()
+_sdk_loaded = False
+
+def load_line_sdk():
+    """Imports the linebot modules the app uses, once. Call before importing from linebot."""
+    global _sdk_loaded
+    if _sdk_loaded:
+        return
+    with _sdk_lock:
+        if not _sdk_loaded:
+            import linebot.v3.messaging
+            import linebot.v3.webhook
+            import linebot.v3.webhooks
+            _sdk_loaded = True
+
+class LazyProxy:
+    """Builds an object with factory() on first attribute access and delegates to it."""
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_target', None)
+        object.__setattr__(self, '_lock', _sdk_lock)
+
+    def _resolve(self):
+        target = self._target
+        if target is None:
+            with self._lock:
+                if self._target is None:
+                    object.__setattr__(self, '_target', self._factory())
+                target = self._target
+        return target
+
+    def _reset(self):
+        """Drops the built object so the next access builds a new one."""
+        with self._lock:
+            object.__setattr__(self, '_target', None)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+def line_concurrency():
+    """Maximum number of LINE API calls in flight per sender, e.g. per dispatch worker (LINE_MAX_CONCURRENCY)."""
+    return int(os.getenv('LINE_MAX_CONCURRENCY', '8'))
+
+def line_pool_size():
+    """
+    Threads and keep-alive connections for LINE API calls per process:
+    line_concurrency() for each of the DISPATCH_WORKERS threads that send a
+    nightly run side by side, so adding workers adds throughput.
+    """
+    return line_concurrency() * max(1, int(os.getenv('DISPATCH_WORKERS', '1')))
+
+def _create_messaging_api():
+    load_line_sdk()
+    from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+
+    # LINE_API_HOST can point the client at a local stub (see app/line_stub.py)
+    configuration = Configuration(
+        access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
+        host=os.getenv('LINE_API_HOST')
+    )
+    # One keep-alive connection per concurrent caller (see app/line_transport.py)
+    configuration.connection_pool_maxsize = line_pool_size()
+    return MessagingApi(ApiClient(configuration))
+
+def _create_blob_api():
+    load_line_sdk()
+    from linebot.v3.messaging import Configuration, ApiClient, MessagingApiBlob
+
+    class DataApiClient(ApiClient):
+        # MessagingApiBlob pins api-data.line.me on every call; use the configured host instead
+        def call_api(self, *args, _host=None, **kwargs):
+            return super().call_api(*args, _host=self.configuration.host, **kwargs)
+
+    # Uploads go to LINE_DATA_API_HOST, or to LINE_API_HOST when only a local stub is configured
+    configuration = Configuration(
+        access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
+        host=os.getenv('LINE_DATA_API_HOST') or os.getenv('LINE_API_HOST') or 'https://api-data.line.me'
+    )
+    return MessagingApiBlob(DataApiClient(configuration))
+
+def _create_webhook_handler():
+    load_line_sdk()
+    from linebot.v3.webhook import WebhookHandler
+    from . import bot
+    from .metrics import WEBHOOK_STAGE_SECONDS
+
+    # /callback checks the signature once, before a body reaches the handler or the queue
+    webhook_handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'), skip_signature_verification=lambda: True)
+    parse = webhook_handler.parser.parse
+
+    def timed_parse(*args, **kwargs):
+        with WEBHOOK_STAGE_SECONDS.labels('parse').time():
+            return parse(*args, **kwargs)
+
+    webhook_handler.parser.parse = timed_parse
+    bot.register_handlers(webhook_handler)
+    return webhook_handler
+
+line_bot_api = LazyProxy(_create_messaging_api)
+line_blob_api = LazyProxy(_create_blob_api) # Rich menu image uploads
+handler = LazyProxy(_create_webhook_handler)
+
+def warm_up_line_clients():
+    """Builds both SDK objects in a background thread so the first request finds them ready."""
+    def warm_up():
+        load_line_sdk()
+        line_bot_api._resolve()
+        handler._resolve()
+    threading.Thread(target=warm_up, name='line-sdk-warmup', daemon=True).start()
+
+def reset_line_clients():
+    """Forces the SDK objects to be rebuilt, e.g. after changing LINE_API_HOST."""
+    line_bot_api._reset()
+    line_blob_api._reset()
+    handler._reset()
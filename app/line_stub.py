@@ -0,0 +1,201 @@
+"""
+A minimal local stand-in for the LINE Messaging API.
+
+Start it and point the bot at it with LINE_API_HOST, e.g.:
+
+    python -m app.line_stub --port 8090
+    LINE_API_HOST=http://127.0.0.1:8090 python3 -m flask --app run ...
+
+Every request is recorded so a run can be checked without sending real pushes.
+Latency and 429 responses can be injected to mimic a loaded API. Rich menus
+are kept in memory: created menus, uploaded images, the default menu and
+bulk links, so a deployment can be checked too.
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class LineStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fail_multicast=False, latency=0.0,
+                 rate_limit_every=0, retry_after=None, record_bodies=True, fail_push=False, failure_status=500):
+        super().__init__(address, LineStubHandler)
+        self.fail_multicast = fail_multicast
+        self.fail_push = fail_push # Answer every push with failure_status too, e.g. a full outage
+        self.failure_status = failure_status # HTTP status of stubbed failures, e.g. 400 for rejected recipients
+        self.latency = latency # Seconds to wait before answering
+        self.rate_limit_every = rate_limit_every # Answer every Nth send with 429 (0: never)
+        self.retry_after = retry_after # Retry-After header sent with 429s
+        self.record_bodies = record_bodies
+        self.requests = [] # List of (path, parsed JSON body)
+        self.counts = Counter() # Key: path or 'rate_limited', Value: number of requests
+        self.rich_menus = {} # Key: richMenuId, Value: menu definition
+        self.rich_menu_images = {} # Key: richMenuId, Value: sha256 of the uploaded image
+        self.default_rich_menu = None
+        self.user_rich_menus = {} # Key: user id, Value: richMenuId
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, path, body):
+        """Records a request and returns True if it should be rate limited."""
+        with self.lock:
+            if self.record_bodies:
+                self.requests.append((path, body))
+            self.counts[path] += 1
+            sends = self.counts['/v2/bot/message/push'] + self.counts['/v2/bot/message/multicast']
+            limited = (
+                self.rate_limit_every > 0
+                and path in ('/v2/bot/message/push', '/v2/bot/message/multicast')
+                and sends % self.rate_limit_every == 0
+            )
+            if limited:
+                self.counts['rate_limited'] += 1
+            return limited
+
+    def start(self):
+        """Serves in a daemon thread and returns the server."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+RICH_MENU_CONTENT_PATH = re.compile(r'^/v2/bot/richmenu/([^/]+)/content$')
+RICH_MENU_PATH = re.compile(r'^/v2/bot/richmenu/([^/]+)$')
+DEFAULT_RICH_MENU_PATH = re.compile(r'^/v2/bot/user/all/richmenu/([^/]+)$')
+
+class LineStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real API
+    disable_nagle_algorithm = True # Headers and body are written separately
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            body = None # e.g. a rich menu image
+        if self.path.startswith(('/v2/bot/richmenu', '/v2/bot/user/all/richmenu')):
+            self.server.record(self.path, body)
+            self._rich_menu_post(body, raw)
+            return
+        limited = self.server.record(self.path, body)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if limited:
+            headers = {'Retry-After': str(self.server.retry_after)} if self.server.retry_after is not None else {}
+            self._respond(429, {'message': 'The API rate limit has been exceeded.'}, headers)
+            return
+        if self.path == '/v2/bot/message/multicast' and self.server.fail_multicast:
+            self._respond(self.server.failure_status, {'message': 'Stubbed multicast failure'})
+            return
+        if self.path == '/v2/bot/message/push' and self.server.fail_push:
+            self._respond(self.server.failure_status, {'message': 'Stubbed push failure'})
+            return
+        if self.path == '/v2/bot/message/multicast':
+            self._respond(200, {})
+            return
+        if self.path in ('/v2/bot/message/push', '/v2/bot/message/reply'):
+            messages = (body or {}).get('messages') or [{}]
+            sent = [{'id': str(i), 'quoteToken': 'stub'} for i in range(len(messages))]
+            self._respond(200, {'sentMessages': sent})
+            return
+        self._respond(404, {'message': 'Not found'})
+
+    def do_GET(self):
+        self.server.record(self.path, None)
+        if self.path == '/v2/bot/richmenu/list':
+            with self.server.lock:
+                menus = [dict(menu, richMenuId=menu_id) for menu_id, menu in self.server.rich_menus.items()]
+            self._respond(200, {'richmenus': menus})
+            return
+        self._respond(404, {'message': 'Not found'})
+
+    def do_DELETE(self):
+        self.server.record(self.path, None)
+        match = RICH_MENU_PATH.match(self.path)
+        with self.server.lock:
+            found = match and self.server.rich_menus.pop(match.group(1), None) is not None
+            if found:
+                self.server.rich_menu_images.pop(match.group(1), None)
+        self._respond(200 if found else 404, {} if found else {'message': 'Not found'})
+
+    def _rich_menu_post(self, body, raw):
+        server = self.server
+        with server.lock:
+            if self.path == '/v2/bot/richmenu':
+                menu_id = f"richmenu-{uuid.uuid4().hex}"
+                server.rich_menus[menu_id] = body
+                self._respond(200, {'richMenuId': menu_id})
+                return
+            if self.path in ('/v2/bot/richmenu/bulk/link', '/v2/bot/richmenu/bulk/unlink'):
+                for user_id in body['userIds']:
+                    if self.path.endswith('/link'):
+                        server.user_rich_menus[user_id] = body['richMenuId']
+                    else:
+                        server.user_rich_menus.pop(user_id, None)
+                self._respond(202, {})
+                return
+            content = RICH_MENU_CONTENT_PATH.match(self.path)
+            default = DEFAULT_RICH_MENU_PATH.match(self.path)
+            menu_id = (content or default).group(1) if (content or default) else None
+            if menu_id not in server.rich_menus:
+                self._respond(404, {'message': 'Not found'})
+                return
+            if content:
+                server.rich_menu_images[menu_id] = hashlib.sha256(raw).hexdigest()
+            else:
+                server.default_rich_menu = menu_id
+            self._respond(200, {})
+
+    def _respond(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stub of the LINE Messaging API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--fail-multicast', action='store_true', help='Answer every multicast with an error.')
+    parser.add_argument('--fail-push', action='store_true', help='Answer every push with an error.')
+    parser.add_argument('--failure-status', type=int, default=500, help='HTTP status of those errors (default 500).')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay every response by this many ms.')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='Answer every Nth push/multicast with HTTP 429.')
+    parser.add_argument('--retry-after', type=int, default=None, help='Retry-After seconds sent with 429s.')
+    args = parser.parse_args()
+
+    server = LineStubServer(
+        (args.host, args.port),
+        fail_multicast=args.fail_multicast,
+        fail_push=args.fail_push,
+        failure_status=args.failure_status,
+        latency=args.latency_ms / 1000,
+        rate_limit_every=args.rate_limit_every,
+        retry_after=args.retry_after,
+    )
+    print(f"LINE API stub listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
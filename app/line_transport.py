@@ -0,0 +1,100 @@
+"""
+Pooled, rate-limited transport for outbound LINE API calls.
+
+Every reply, push and multicast goes through one LineTransport. It runs calls
+on a bounded thread pool over the SDK's keep-alive connection pool, applies a
+client-side token bucket per endpoint, and sets a per-request timeout, so N
+pushes take roughly N / concurrency round-trips instead of N.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import line_bot_api
+from .line_client import line_pool_size
+from .metrics import LINE_API_CALLS, LINE_API_SECONDS, api_outcome
+
+# Requests per second allowed by the Messaging API for each endpoint
+RATE_LIMITS = {
+    'reply_message': 2000,
+    'push_message': 2000,
+    'multicast': 200,
+    # Rich menu bulk (un)linking has a much lower limit; see the Messaging API rate limit table
+    'link_rich_menu_id_to_users': 3,
+    'unlink_rich_menu_id_from_users': 3,
+}
+
+# (connect, read) timeout in seconds for every outbound call
+REQUEST_TIMEOUT = (3.05, 10)
+
+class TokenBucket:
+    """Blocks callers so that on average no more than `rate` calls per second go through."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class LineTransport:
+    """Sends MessagingApi calls with bounded concurrency, rate limits and timeouts."""
+
+    def __init__(self, concurrency=8, rate_limits=None, timeout=REQUEST_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.buckets = {
+            endpoint: TokenBucket(rate)
+            for endpoint, rate in (rate_limits or RATE_LIMITS).items()
+        }
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='line-transport')
+
+    def call(self, endpoint, *args, api=None, **kwargs):
+        """
+        Calls line_bot_api.<endpoint>(*args) (or api.<endpoint>) in the current
+        thread, rate-limited and with a timeout.
+        """
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None:
+            bucket.acquire()
+        error = None
+        start = time.perf_counter()
+        try:
+            return getattr(api or line_bot_api, endpoint)(*args, _request_timeout=self.timeout, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            LINE_API_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+            LINE_API_CALLS.labels(endpoint, api_outcome(error)).inc()
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the transport's pool and returns a Future."""
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def reply(self, request):
+        return self.call('reply_message', request)
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    """Returns the process-wide LineTransport shared by the webhook path and the nightly job."""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = LineTransport(concurrency=line_pool_size())
+    return _transport
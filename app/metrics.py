@@ -0,0 +1,100 @@
+"""
+Prometheus metrics for the webhook path, LINE API calls and the nightly job.
+
+Metrics live in this process's registry and are served by /metrics. Under
+gunicorn with several workers, set PROMETHEUS_MULTIPROC_DIR so every worker's
+samples are aggregated (see the prometheus_client multiprocess docs).
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+# Buckets in seconds for request-path work (sub-millisecond to a few seconds)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Buckets in seconds for nightly job phases (up to half an hour)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+
+# --- Webhook path ---
+
+WEBHOOK_STAGE_SECONDS = Histogram(
+    'gomibot_webhook_stage_seconds',
+    'Time spent in each webhook stage: signature, parse, handle (parse plus handlers).',
+    ['stage'], buckets=FAST_BUCKETS,
+)
+DB_QUERY_SECONDS = Histogram(
+    'gomibot_db_query_seconds',
+    'Time spent in database work done by message handlers.',
+    ['query'], buckets=FAST_BUCKETS,
+)
+WEBHOOK_EVENTS = Counter(
+    'gomibot_webhook_events_total',
+    'Webhook events handled, by kind: message, follow.',
+    ['kind'],
+)
+
+# --- LINE Messaging API ---
+
+LINE_API_SECONDS = Histogram(
+    'gomibot_line_api_seconds',
+    'Latency of LINE Messaging API calls, including failed ones.',
+    ['endpoint'], buckets=FAST_BUCKETS,
+)
+LINE_API_CALLS = Counter(
+    'gomibot_line_api_calls_total',
+    'LINE Messaging API calls by outcome: ok, rate_limited, server_error, client_error, error.',
+    ['endpoint', 'outcome'],
+)
+
+# --- Nightly job ---
+
+JOB_PHASE_SECONDS = Histogram(
+    'gomibot_notification_job_phase_seconds',
+    'Time spent in each phase of the nightly job: compute, select, dispatch.',
+    ['phase'], buckets=JOB_BUCKETS,
+)
+NOTIFICATIONS = Counter(
+    'gomibot_notifications_total',
+    'Reminder deliveries by result: sent, failed, fallback_sent.',
+    ['result'],
+)
+NOTIFICATION_RETRIES = Counter(
+    'gomibot_notification_retries_total',
+    'Retried LINE API calls made while sending reminders.',
+)
+
+# --- Scheduler ---
+
+SCHEDULER_LEADER = Gauge(
+    'gomibot_scheduler_leader',
+    '1 in the process currently elected to run scheduled jobs, 0 in the others.',
+    multiprocess_mode='liveall',
+)
+
+def api_outcome(error):
+    """Classifies a LINE API call result for LINE_API_CALLS."""
+    if error is None:
+        return 'ok'
+    status = getattr(error, 'status', None)
+    if status == 429:
+        return 'rate_limited'
+    if status is not None:
+        return 'server_error' if status >= 500 else 'client_error'
+    return 'error'
+
+def render_metrics():
+    """Returns (body, content type) for the /metrics endpoint."""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,25 +1,324 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import AddConstraint
+
 from . import db
+from .rules import get_rule
+
+# The ward every schedule and user belonged to before multi-municipality support
+DEFAULT_MUNICIPALITY = '品川区'
+# Reminder time (minutes after midnight JST) of users who have not picked one: 20:00
+DEFAULT_NOTIFY_MINUTE = 20 * 60
 
 class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     line_user_id = db.Column(db.String(100), unique=True, nullable=False)
-    area_name = db.Column(db.String(100), db.ForeignKey('schedules.name'), nullable=True)
+    municipality = db.Column(db.String(50), nullable=True)
+    area_name = db.Column(db.String(100), nullable=True)
+    notify_minute = db.Column(db.Integer, default=DEFAULT_NOTIFY_MINUTE) # Reminder time, minutes after midnight JST
+    rich_menu_id = db.Column(db.String(100), index=True) # Rich menu last linked by deploy-rich-menus
+    area_changed_at = db.Column(db.DateTime, index=True) # Last (un)registration, polled by every process's user cache
     
     schedule = db.relationship('Schedule', back_populates='users')
 
+    __table_args__ = (
+        db.ForeignKeyConstraint(['municipality', 'area_name'], ['schedules.municipality', 'schedules.name']),
+        db.Index('ix_users_municipality_area', 'municipality', 'area_name'),
+        # A notification bucket's users are one range of this index
+        db.Index('ix_users_notify_minute_municipality_area', 'notify_minute', 'municipality', 'area_name'),
+    )
+
     def __repr__(self):
         return f'<User {self.line_user_id}>'
 
 class Schedule(db.Model):
     __tablename__ = 'schedules'
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), unique=True, nullable=False)
+    municipality = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(100), nullable=False) # Unique within the municipality
     resources = db.Column(db.String(50))
     burnable = db.Column(db.String(50))
     ceramic_glass_metal = db.Column(db.String(50))
 
     users = db.relationship('User', back_populates='schedule')
 
+    __table_args__ = (
+        db.Index('uq_schedules_municipality_name', 'municipality', 'name', unique=True),
+    )
+
+    def rule_for(self, column):
+        """Returns the compiled CollectionRule for a garbage type column."""
+        return get_rule(getattr(self, column))
+
+    def __repr__(self):
+        return f'<Schedule {self.municipality} {self.name}>'
+
+
+class CollectionDay(db.Model):
+    """One row per (date, area, garbage type), materialized from the schedule rules."""
+    __tablename__ = 'collection_days'
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False, index=True)
+    municipality = db.Column(db.String(50), nullable=False)
+    area_name = db.Column(db.String(100), nullable=False)
+    garbage_type = db.Column(db.String(50), nullable=False) # Schedule column, e.g. 'burnable'
+
+    __table_args__ = (
+        db.ForeignKeyConstraint(['municipality', 'area_name'], ['schedules.municipality', 'schedules.name']),
+        # Also serves "areas of one municipality collected on D"
+        db.Index(
+            'uq_collection_days_date_municipality_area_type',
+            'date', 'municipality', 'area_name', 'garbage_type', unique=True,
+        ),
+        db.Index(
+            'ix_collection_days_municipality_area_type_date',
+            'municipality', 'area_name', 'garbage_type', 'date',
+        ),
+    )
+
+    def __repr__(self):
+        return f'<CollectionDay {self.date} {self.municipality} {self.area_name} {self.garbage_type}>'
+
+
+class NotificationOutbox(db.Model):
+    """A computed reminder for one user and collection date, kept until delivered."""
+    __tablename__ = 'notification_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False) # Collection date the reminder is for
+    line_user_id = db.Column(db.String(100), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String(255))
+    sent_at = db.Column(db.DateTime)
+    # DispatchShard.bucket and .shard that queued it; NULL for rows queued before sharding
+    bucket = db.Column(db.Integer)
+    shard = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.UniqueConstraint('date', 'line_user_id'),
+        db.Index('ix_notification_outbox_date_status', 'date', 'status'),
+        db.Index('ix_notification_outbox_date_bucket_shard_status', 'date', 'bucket', 'shard', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<NotificationOutbox {self.date} {self.line_user_id} {self.status}>'
+
+
+class DispatchShard(db.Model):
+    """
+    One slice of a nightly run: the users of one notification time bucket in
+    the areas that shards.shard_of assigns to it out of shard_count. Workers
+    claim pending shards, queue and send their reminders, and record the outcome.
+    """
+    __tablename__ = 'dispatch_shards'
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False) # Collection date of the run
+    bucket = db.Column(db.Integer, nullable=False) # First notify_minute of the bucket
+    shard = db.Column(db.Integer, nullable=False)
+    shard_count = db.Column(db.Integer, nullable=False) # Shards of the bucket
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending, running, done
+    claimed_by = db.Column(db.String(100))
+    claimed_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('date', 'bucket', 'shard'),
+        db.Index('ix_dispatch_shards_date_status', 'date', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<DispatchShard {self.date} {self.bucket // 60:02d}:{self.bucket % 60:02d} #{self.shard} {self.status}>'
+
+
+class RichMenu(db.Model):
+    """A rich menu created on LINE, keyed by the hash of its definition and image."""
+    __tablename__ = 'rich_menus'
+    content_hash = db.Column(db.String(64), primary_key=True)
+    rich_menu_id = db.Column(db.String(100), unique=True, nullable=False)
+    label = db.Column(db.String(200), nullable=False) # Area it was rendered for, or 'default'
+    image_uploaded = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<RichMenu {self.label} {self.rich_menu_id}>'
+
+
+class SchedulerLease(db.Model):
+    """The process that runs the scheduled jobs, renewed by its heartbeat (see app/leader.py)."""
+    __tablename__ = 'scheduler_leases'
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100), nullable=False) # host:pid
+    acquired_at = db.Column(db.DateTime, nullable=False)
+    heartbeat_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<SchedulerLease {self.name} {self.holder}>'
+
+
+class DatasetVersion(db.Model):
+    """Content hash of the last loaded source file, used to skip unchanged reloads."""
+    __tablename__ = 'dataset_versions'
+    source = db.Column(db.String(100), primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)
+    loaded_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<DatasetVersion {self.source} {self.content_hash[:8]}>'
+
+
+class SchemaVersion(db.Model):
+    """Fingerprint of a model schema this database was brought up to (see app/startup.py)."""
+    __tablename__ = 'schema_versions'
+    fingerprint = db.Column(db.String(12), primary_key=True)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
     def __repr__(self):
-        return f'<Schedule {self.name}>'
+        return f'<SchemaVersion {self.fingerprint}>'
+
+
+def dataset_version():
+    """(sources, last load time) of the schedule data; changes whenever load_schedule_data writes."""
+    return tuple(db.session.execute(select(func.count(), func.max(DatasetVersion.loaded_at))).one())
+
+def schema_is_current(fingerprint):
+    """Checks the database itself for a record of having been brought up to this schema."""
+    if not inspect(db.engine).has_table(SchemaVersion.__tablename__):
+        return False
+    return db.session.get(SchemaVersion, fingerprint) is not None
+
+def record_schema_version(fingerprint):
+    """Records that the database has this schema, so later startups skip the checks. Commits."""
+    db.session.add(SchemaVersion(fingerprint=fingerprint, applied_at=datetime.now(timezone.utc).replace(tzinfo=None)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Recorded by another worker starting at the same time
+        db.session.rollback()
+
+
+# Columns added to existing tables since they were first created:
+# (table, column, SQL type, backfill value, backfill condition)
+_ADDED_COLUMNS = (
+    ('schedules', 'municipality', 'VARCHAR(50)', DEFAULT_MUNICIPALITY, None),
+    ('collection_days', 'municipality', 'VARCHAR(50)', DEFAULT_MUNICIPALITY, None),
+    ('users', 'municipality', 'VARCHAR(50)', DEFAULT_MUNICIPALITY, 'area_name IS NOT NULL'),
+    ('notification_outbox', 'shard', 'INTEGER', None, None),
+    ('users', 'notify_minute', 'INTEGER', DEFAULT_NOTIFY_MINUTE, None),
+    ('notification_outbox', 'bucket', 'INTEGER', DEFAULT_NOTIFY_MINUTE, 'shard IS NOT NULL'),
+    ('users', 'rich_menu_id', 'VARCHAR(100)', None, None),
+    ('users', 'area_changed_at', 'TIMESTAMP', None, None),
+)
+# Indexes superseded by newer ones
+_DROPPED_INDEXES = (
+    'ix_collection_days_area_type_date',
+    'ix_notification_outbox_date_shard_status',
+)
+# Constraints of the single-ward schema that reject area names shared by two wards:
+# (table, 'unique' or 'foreign key', constrained columns)
+_DROPPED_CONSTRAINTS = (
+    ('users', 'foreign key', ('area_name',)),
+    ('collection_days', 'foreign key', ('area_name',)),
+    ('schedules', 'unique', ('name',)),
+    ('collection_days', 'unique', ('date', 'area_name', 'garbage_type')),
+)
+
+def _legacy_constraints(inspector, existing_tables):
+    """(table, constraint name) of each _DROPPED_CONSTRAINTS entry still in the database, foreign keys first."""
+    found = []
+    for table_name, kind, columns in _DROPPED_CONSTRAINTS:
+        if table_name not in existing_tables:
+            continue
+        if kind == 'unique':
+            constraints = [(c['name'], c['column_names']) for c in inspector.get_unique_constraints(table_name)]
+        else:
+            constraints = [(c['name'], c['constrained_columns']) for c in inspector.get_foreign_keys(table_name)]
+        found += [(table_name, name) for name, constrained in constraints if tuple(constrained) == columns]
+    return found
+
+def _rebuild_sqlite_table(conn, table):
+    """
+    Recreates a table from its model and copies its rows over, since SQLite
+    cannot drop a constraint. Columns the model does not define are dropped.
+    """
+    old_name = f"_old_{table.name}"
+    old_columns = {c['name'] for c in inspect(conn).get_columns(table.name)}
+    # Keep other tables' foreign keys pointing at the table name, not the renamed copy
+    conn.execute(text("PRAGMA legacy_alter_table = ON"))
+    conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+    conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+    # Its indexes keep their names, which the new table needs
+    for (index_name,) in conn.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"),
+        {'table': old_name},
+    ).all():
+        conn.execute(text(f"DROP INDEX {index_name}"))
+    table.create(conn)
+    columns = ', '.join(c.name for c in table.columns if c.name in old_columns)
+    conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}"))
+    conn.execute(text(f"DROP TABLE {old_name}"))
+
+def upgrade_schema():
+    """
+    Adds columns and indexes introduced since a database was created, e.g.
+    municipality (existing rows are assigned to DEFAULT_MUNICIPALITY), and
+    drops the single-ward constraints that multi-ward data would violate,
+    keeping every row. Safe to run repeatedly.
+    """
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        existing_tables = set(inspector.get_table_names())
+        if 'dispatch_shards' in existing_tables and \
+                {c['name'] for c in inspector.get_columns('dispatch_shards')} != set(DispatchShard.__table__.columns.keys()):
+            # Only run bookkeeping, and how it splits a run changed: rebuild it. A
+            # run in progress is planned again; the outbox keeps it from resending.
+            print("--- Rebuilding dispatch_shards ---")
+            DispatchShard.__table__.drop(conn)
+            DispatchShard.__table__.create(conn)
+        for table_name, column, sql_type, backfill_value, condition in _ADDED_COLUMNS:
+            if table_name not in existing_tables:
+                continue
+            if column not in {c['name'] for c in inspector.get_columns(table_name)}:
+                print(f"--- Adding {table_name}.{column} ---")
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column} {sql_type}"))
+                if backfill_value is not None:
+                    backfill = f"UPDATE {table_name} SET {column} = :value"
+                    if condition:
+                        backfill += f" WHERE {condition}"
+                    conn.execute(text(backfill), {'value': backfill_value})
+
+        legacy = _legacy_constraints(inspector, existing_tables)
+        if conn.dialect.name == 'sqlite':
+            for table_name in dict.fromkeys(table_name for table_name, _ in legacy):
+                print(f"--- Rebuilding {table_name} without its single-ward constraints ---")
+                _rebuild_sqlite_table(conn, db.metadata.tables[table_name])
+        else:
+            for table_name, constraint_name in legacy:
+                print(f"--- Dropping {table_name}.{constraint_name} ---")
+                conn.execute(text(f'ALTER TABLE {table_name} DROP CONSTRAINT "{constraint_name}"'))
+
+        for table in db.metadata.sorted_tables:
+            if table.name in existing_tables:
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+        for index_name in _DROPPED_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+
+        if conn.dialect.name != 'sqlite':
+            # The (municipality, name) foreign keys that replace the dropped ones;
+            # they need uq_schedules_municipality_name, created above
+            inspector = inspect(conn)
+            for table in db.metadata.sorted_tables:
+                if table.name not in existing_tables:
+                    continue
+                existing_keys = {tuple(fk['constrained_columns']) for fk in inspector.get_foreign_keys(table.name)}
+                for constraint in table.foreign_key_constraints:
+                    if tuple(constraint.column_keys) not in existing_keys:
+                        print(f"--- Adding {table.name} foreign key ({', '.join(constraint.column_keys)}) ---")
+                        conn.execute(AddConstraint(constraint))
@@ -0,0 +1,157 @@
+"""
+Persistent notification outbox.
+
+The nightly job writes every computed reminder to notification_outbox, keyed
+by (collection date, user), and a drainer sends the pending rows in batches
+and marks them delivered. Re-running the job for the same date only sends
+what is still pending, so recovering from a crash costs only the remainder.
+"""
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import case, delete, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .dispatch import NotificationDispatcher
+from .models import db, NotificationOutbox
+
+# Rows read from the outbox per drain round
+OUTBOX_BATCH_SIZE = 5000
+# A row is given up on after this many failed drain rounds
+MAX_ATTEMPTS = 5
+# Delivered and failed rows are kept this long for inspection
+OUTBOX_RETENTION_DAYS = 30
+
+def _insert_ignoring_duplicates(rows):
+    """Inserts outbox rows, skipping any (date, line_user_id) that already exists."""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(NotificationOutbox).on_conflict_do_nothing(index_elements=['date', 'line_user_id'])
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(NotificationOutbox).on_conflict_do_nothing(index_elements=['date', 'line_user_id'])
+    else:
+        existing = set(db.session.execute(
+            select(NotificationOutbox.date, NotificationOutbox.line_user_id)
+            .where(
+                NotificationOutbox.date == rows[0]['date'],
+                NotificationOutbox.line_user_id.in_([row['line_user_id'] for row in rows]),
+            )
+        ).all())
+        rows = [row for row in rows if (row['date'], row['line_user_id']) not in existing]
+        stmt = insert(NotificationOutbox)
+    if rows:
+        db.session.execute(stmt, rows)
+
+def enqueue_notifications(date_obj, pairs, shard=None, bucket=None):
+    """
+    Writes (line_user_id, message) pairs for a collection date to the outbox,
+    tagged with the bucket and dispatch shard that queued them.
+    Existing rows are left untouched, so delivered reminders are never reset.
+    pairs may be a streamed query result, so this only commits once at the end.
+    Returns the number of pairs seen.
+    """
+    count = 0
+    batch = []
+    for line_user_id, message in pairs:
+        batch.append({
+            'date': date_obj,
+            'line_user_id': line_user_id,
+            'message': message,
+            'status': 'pending',
+            'attempts': 0,
+            'bucket': bucket,
+            'shard': shard,
+        })
+        if len(batch) >= OUTBOX_BATCH_SIZE:
+            _insert_ignoring_duplicates(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        _insert_ignoring_duplicates(batch)
+        count += len(batch)
+    db.session.commit()
+    return count
+
+# Rows updated per statement when recording outcomes
+MARK_CHUNK_SIZE = 500
+
+def _mark_sent(date_obj, user_ids):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    for i in range(0, len(user_ids), MARK_CHUNK_SIZE):
+        db.session.execute(
+            update(NotificationOutbox)
+            .where(
+                NotificationOutbox.date == date_obj,
+                NotificationOutbox.line_user_id.in_(user_ids[i:i + MARK_CHUNK_SIZE]),
+            )
+            .values(status='sent', sent_at=now, attempts=NotificationOutbox.attempts + 1, last_error=None)
+        )
+
+def _mark_failed(date_obj, failures):
+    """
+    Records failed sends with one UPDATE per outcome (error, retryable) and
+    chunk of users. Retryable rows stay pending until their last attempt.
+    """
+    user_ids_by_outcome = {} # Key: (error, retryable), Value: list of user_ids
+    for user_id, error, retryable in failures:
+        user_ids_by_outcome.setdefault((error, retryable), []).append(user_id)
+    for (error, retryable), user_ids in user_ids_by_outcome.items():
+        if retryable:
+            status = case((NotificationOutbox.attempts + 1 >= MAX_ATTEMPTS, 'failed'), else_=NotificationOutbox.status)
+        else:
+            status = 'failed'
+        for i in range(0, len(user_ids), MARK_CHUNK_SIZE):
+            db.session.execute(
+                update(NotificationOutbox)
+                .where(
+                    NotificationOutbox.date == date_obj,
+                    NotificationOutbox.line_user_id.in_(user_ids[i:i + MARK_CHUNK_SIZE]),
+                )
+                .values(status=status, attempts=NotificationOutbox.attempts + 1, last_error=error)
+            )
+
+def drain_outbox(app, date_obj, shard, bucket=None, dispatcher=None):
+    """
+    Sends every pending outbox row of one bucket's shard for the date and
+    records the outcome. shard=None drains rows queued before dispatch was
+    sharded. Returns the dispatcher stats.
+    """
+    dispatcher = dispatcher or NotificationDispatcher(app)
+    if shard is None:
+        shard_filter = NotificationOutbox.shard.is_(None)
+    else:
+        shard_filter = (NotificationOutbox.bucket == bucket) & (NotificationOutbox.shard == shard)
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(NotificationOutbox.id, NotificationOutbox.line_user_id, NotificationOutbox.message)
+            .where(
+                NotificationOutbox.date == date_obj,
+                shard_filter,
+                NotificationOutbox.status == 'pending',
+                NotificationOutbox.id > last_id,
+            )
+            .order_by(NotificationOutbox.id)
+            .limit(OUTBOX_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        for row in rows:
+            dispatcher.add(row.line_user_id, row.message)
+        dispatcher.flush()
+
+        delivered, failures = dispatcher.take_results()
+        _mark_sent(date_obj, delivered)
+        _mark_failed(date_obj, failures)
+        db.session.commit()
+
+    dispatcher.log_summary()
+    return dispatcher.stats
+
+def purge_outbox(today, retention_days=OUTBOX_RETENTION_DAYS):
+    """Deletes outbox rows older than the retention period. Commits."""
+    db.session.execute(
+        delete(NotificationOutbox)
+        .where(NotificationOutbox.date < today - timedelta(days=retention_days))
+    )
+    db.session.commit()
@@ -0,0 +1,320 @@
+"""
+Rich menu deployment, run with `flask deploy-rich-menus`.
+
+Every area with registered users gets its own rich menu: richmenu.png with a
+band showing the area name and its next collection days. Users without an
+area see the plain default menu. Menus are keyed by a hash of their
+definition and image, so re-running the command reuses every menu whose
+content is unchanged instead of uploading it again. Users are linked in bulk,
+RICH_MENU_BULK_SIZE per call and grouped by area, and only when their menu
+changed; menus no user needs any more are deleted afterwards.
+"""
+import hashlib
+import io
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import click
+from sqlalchemy import func, or_, select, update
+
+from .models import db, RichMenu, Schedule, User
+from .rules import GARBAGE_TYPES, JST, get_rule
+
+# The Messaging API links or unlinks at most 500 users per bulk request
+RICH_MENU_BULK_SIZE = 500
+# The Messaging API rejects rich menu images larger than this
+MAX_IMAGE_BYTES = 1024 * 1024
+BASE_IMAGE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'richmenu.png')
+# Height in pixels of the caption band drawn across the top of area menus
+CAPTION_HEIGHT = 220
+
+# (x, y, width, height, action label, message text) of each tappable area
+MENU_AREAS = (
+    (0, 0, 1250, 843, 'Check Day', 'メニュー'),
+    (1251, 0, 1250, 843, 'Rules', 'ゴミのルール'),
+    (0, 844, 1250, 843, 'Register', '地域を登録'),
+    (1251, 844, 1250, 843, 'PDF', 'PDF'),
+)
+
+# --- Rendering ---
+
+def menu_definition(name):
+    """The rich menu object, in the Messaging API's JSON form."""
+    return {
+        'size': {'width': 2500, 'height': 1686},
+        'selected': False,
+        'name': name[:300],
+        'chatBarText': 'メニューを開く',
+        'areas': [
+            {
+                'bounds': {'x': x, 'y': y, 'width': width, 'height': height},
+                'action': {'type': 'message', 'label': label, 'text': text},
+            }
+            for x, y, width, height, label, text in MENU_AREAS
+        ],
+    }
+
+def area_caption(display_name, rules, today, with_dates=True):
+    """Caption lines for an area menu: its name and the next day of each garbage type."""
+    from .bot import format_date
+
+    lines = [display_name]
+    if with_dates:
+        upcoming = []
+        for column, label in GARBAGE_TYPES:
+            next_dates = get_rule(rules[column]).next_dates(today, 1)
+            if next_dates:
+                upcoming.append(f"{label} {format_date(next_dates[0])}")
+        if upcoming:
+            lines.append('次回 ' + '　'.join(upcoming))
+    return lines
+
+def render_menu_image(caption_lines, font_path):
+    """richmenu.png with the caption drawn across the top. Returns (image bytes, content type)."""
+    from PIL import Image, ImageDraw, ImageFont
+
+    image = Image.open(BASE_IMAGE).convert('RGB')
+    draw = ImageDraw.Draw(image, 'RGBA')
+    draw.rectangle((0, 0, image.width, CAPTION_HEIGHT), fill=(255, 255, 255, 230))
+    line_height = CAPTION_HEIGHT // len(caption_lines)
+    for i, line in enumerate(caption_lines):
+        # Shrink long lines until they fit the width
+        size = line_height * 3 // 4
+        font = ImageFont.truetype(font_path, size)
+        while size > 20 and draw.textlength(line, font=font) > image.width - 80:
+            size -= 4
+            font = ImageFont.truetype(font_path, size)
+        draw.text((40, i * line_height + (line_height - size) // 2), line, font=font, fill=(48, 48, 48))
+
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', optimize=True)
+    if buffer.tell() <= MAX_IMAGE_BYTES:
+        return buffer.getvalue(), 'image/png'
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue(), 'image/jpeg'
+
+def content_hash(definition, image):
+    digest = hashlib.sha256(json.dumps(definition, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    digest.update(image)
+    return digest.hexdigest()
+
+def plan_menus(today, font_path=None, with_dates=True):
+    """
+    Renders the default menu and one menu per area with registered users.
+    Returns (default hash, {hash: menu}, {(municipality, area_name): hash});
+    areas share a menu when theirs comes out identical. Without a font every
+    area gets the default menu.
+    """
+    from .area_index import get_municipalities
+
+    with open(BASE_IMAGE, 'rb') as f:
+        base_image = f.read()
+    default_definition = menu_definition('Gomi Bot Rich Menu')
+    default_hash = content_hash(default_definition, base_image)
+    menus = {default_hash: {
+        'label': 'default', 'definition': default_definition,
+        'image': base_image, 'content_type': 'image/png',
+    }}
+
+    areas = db.session.execute(
+        select(Schedule.municipality, Schedule.name, *(getattr(Schedule, column) for column, _ in GARBAGE_TYPES))
+        .where(select(User.id).where(
+            User.municipality == Schedule.municipality, User.area_name == Schedule.name
+        ).exists())
+        .order_by(Schedule.municipality, Schedule.name)
+    ).all()
+    multiple_wards = len(get_municipalities()) > 1
+    area_hashes = {}
+    for municipality, name, *rules in areas:
+        if font_path is None:
+            area_hashes[municipality, name] = default_hash
+            continue
+        display_name = f"{municipality} {name}" if multiple_wards else name
+        caption = area_caption(display_name, dict(zip((c for c, _ in GARBAGE_TYPES), rules)), today, with_dates)
+        image, content_type = render_menu_image(caption, font_path)
+        definition = menu_definition(f"Gomi Bot {municipality} {name}")
+        menu_hash = content_hash(definition, image)
+        menus.setdefault(menu_hash, {
+            'label': f"{municipality} {name}", 'definition': definition,
+            'image': image, 'content_type': content_type,
+        })
+        area_hashes[municipality, name] = menu_hash
+    return default_hash, menus, area_hashes
+
+# --- Deployment ---
+
+def _call(transport, endpoint, *args, **kwargs):
+    """transport.call with the nightly dispatch's retry policy for 429s and 5xxs."""
+    from .dispatch import MAX_RETRIES, is_retryable, retry_delay
+
+    attempt = 0
+    while True:
+        try:
+            return transport.call(endpoint, *args, **kwargs)
+        except Exception as e:
+            if attempt >= MAX_RETRIES or not is_retryable(e):
+                raise
+            time.sleep(retry_delay(e, attempt))
+            attempt += 1
+
+def ensure_menu(transport, menu_hash, menu, live_ids):
+    """
+    Returns the richMenuId for a planned menu, creating it and uploading its
+    image only if no live menu with the same hash exists. Returns (id, created).
+    """
+    from linebot.v3.messaging import RichMenuRequest
+    from .line_client import line_blob_api
+
+    row = db.session.get(RichMenu, menu_hash)
+    if row is not None and row.rich_menu_id not in live_ids:
+        # Deleted on LINE's side since it was deployed
+        db.session.delete(row)
+        db.session.commit()
+        row = None
+    created = row is None
+    if created:
+        response = _call(transport, 'create_rich_menu', RichMenuRequest.from_dict(menu['definition']))
+        row = RichMenu(
+            content_hash=menu_hash,
+            rich_menu_id=response.rich_menu_id,
+            label=menu['label'],
+            image_uploaded=False,
+            created_at=datetime.now(timezone.utc).replace(tzinfo=None),
+        )
+        # Recorded before the upload, so a failed upload is retried next time instead of creating another menu
+        db.session.add(row)
+        db.session.commit()
+    if not row.image_uploaded:
+        _call(
+            transport, 'set_rich_menu_image', row.rich_menu_id, menu['image'],
+            # The generated client ignores _content_type, so the header is set directly
+            api=line_blob_api, _headers={'Content-Type': menu['content_type']},
+        )
+        row.image_uploaded = True
+        db.session.commit()
+    return row.rich_menu_id, created
+
+def relink_users(transport, conditions, rich_menu_id):
+    """
+    Links the users matching conditions whose menu differs to rich_menu_id
+    (or unlinks them when it is None), RICH_MENU_BULK_SIZE per call.
+    A failed call leaves its users as they were for the next run. Returns (linked, failed).
+    """
+    from linebot.v3.messaging import RichMenuBulkLinkRequest, RichMenuBulkUnlinkRequest
+    from .dispatch import describe_error
+
+    if rich_menu_id is None:
+        differs = User.rich_menu_id.is_not(None)
+    else:
+        differs = or_(User.rich_menu_id.is_(None), User.rich_menu_id != rich_menu_id)
+    user_ids = db.session.scalars(select(User.line_user_id).where(*conditions, differs)).all()
+
+    linked = failed = 0
+    for i in range(0, len(user_ids), RICH_MENU_BULK_SIZE):
+        chunk = user_ids[i:i + RICH_MENU_BULK_SIZE]
+        try:
+            if rich_menu_id is None:
+                _call(transport, 'unlink_rich_menu_id_from_users', RichMenuBulkUnlinkRequest(userIds=chunk))
+            else:
+                _call(transport, 'link_rich_menu_id_to_users',
+                      RichMenuBulkLinkRequest(richMenuId=rich_menu_id, userIds=chunk))
+        except Exception as e:
+            print(f"  Bulk {'unlink' if rich_menu_id is None else 'link'} of {len(chunk)} users failed: {describe_error(e)}")
+            failed += len(chunk)
+            continue
+        db.session.execute(
+            update(User).where(User.line_user_id.in_(chunk)).values(rich_menu_id=rich_menu_id)
+        )
+        db.session.commit()
+        linked += len(chunk)
+    return linked, failed
+
+def delete_unused_menus(transport, in_use):
+    """Deletes the menus this command created that no area uses and no user is linked to."""
+    deleted = 0
+    for row in db.session.scalars(select(RichMenu)).all():
+        if row.rich_menu_id in in_use:
+            continue
+        if db.session.scalar(select(func.count()).where(User.rich_menu_id == row.rich_menu_id)):
+            continue # Users whose relink failed still use it; retried next run
+        try:
+            _call(transport, 'delete_rich_menu', row.rich_menu_id)
+        except Exception as e:
+            if getattr(e, 'status', None) != 404:
+                print(f"Could not delete rich menu {row.rich_menu_id} ({row.label}): {e}")
+                continue
+        db.session.delete(row)
+        db.session.commit()
+        deleted += 1
+    return deleted
+
+def deploy_rich_menus(font_path=None, with_dates=True, dry_run=False, today=None):
+    """Creates, uploads, links and cleans up the rich menus. Returns a summary dict."""
+    from .line_transport import get_transport
+
+    today = today or datetime.now(JST).date()
+    default_hash, menus, area_hashes = plan_menus(today, font_path, with_dates)
+    summary = {'menus': len(menus), 'areas': len(area_hashes), 'created': 0, 'reused': 0,
+               'linked': 0, 'failed': 0, 'deleted': 0}
+
+    if dry_run:
+        cached = set(db.session.scalars(select(RichMenu.content_hash).where(RichMenu.image_uploaded)))
+        summary['created'] = len(menus.keys() - cached)
+        summary['reused'] = len(menus.keys() & cached)
+        return summary
+
+    transport = get_transport()
+    live_ids = {menu.rich_menu_id for menu in _call(transport, 'get_rich_menu_list').richmenus}
+    menu_ids = {}
+    for menu_hash, menu in menus.items():
+        menu_ids[menu_hash], created = ensure_menu(transport, menu_hash, menu, live_ids)
+        summary['created' if created else 'reused'] += 1
+    default_id = menu_ids[default_hash]
+    _call(transport, 'set_default_rich_menu', default_id)
+    print(f"{summary['created']} rich menus created, {summary['reused']} unchanged; default is {default_id}.")
+
+    # Users linked to the default menu are unlinked instead, so it applies through the default
+    targets = [(conditions, menu_ids[menu_hash] if menu_hash != default_hash else None, f"{m} {a}")
+               for (m, a), menu_hash in area_hashes.items()
+               for conditions in [(User.municipality == m, User.area_name == a)]]
+    targets.append(((User.area_name.is_(None),), None, 'unregistered users'))
+    for i, (conditions, rich_menu_id, label) in enumerate(targets, 1):
+        linked, failed = relink_users(transport, conditions, rich_menu_id)
+        summary['linked'] += linked
+        summary['failed'] += failed
+        if linked or failed:
+            print(f"[{i}/{len(targets)}] {label}: {linked} users {'linked' if rich_menu_id else 'unlinked'}"
+                  + (f", {failed} failed" if failed else "") + ".")
+
+    summary['deleted'] = delete_unused_menus(transport, set(menu_ids.values()))
+    return summary
+
+# --- CLI ---
+
+def register_cli_command(app):
+    @app.cli.command('deploy-rich-menus')
+    @click.option('--font', 'font_path', default=lambda: os.getenv('RICH_MENU_FONT'),
+                  help='TrueType/OpenType font with Japanese glyphs for area captions (default: RICH_MENU_FONT).')
+    @click.option('--no-dates', is_flag=True, help='Show only the area name, not the next collection days.')
+    @click.option('--dry-run', is_flag=True, help='Render and compare the menus without calling LINE.')
+    def deploy_rich_menus_command(font_path, no_dates, dry_run):
+        """Deploys per-area rich menus and links users to them in bulk. Safe to re-run, e.g. daily."""
+        if font_path:
+            try:
+                import PIL # noqa: F401
+            except ImportError:
+                raise click.ClickException('Area captions need Pillow: pip install Pillow')
+        else:
+            print("No caption font given (--font or RICH_MENU_FONT); every user gets the default menu.")
+        with app.app_context():
+            summary = deploy_rich_menus(font_path, with_dates=not no_dates, dry_run=dry_run)
+        if dry_run:
+            print(f"Dry run: {summary['menus']} menus for {summary['areas']} areas, "
+                  f"{summary['created']} would be created, {summary['reused']} are unchanged.")
+            return
+        print(f"Rich menus deployed: {summary['menus']} menus for {summary['areas']} areas, "
+              f"{summary['linked']} users relinked, {summary['failed']} failed, "
+              f"{summary['deleted']} old menus deleted.")
@@ -0,0 +1,107 @@
+"""
+Compiled garbage collection rules.
+
+Schedule strings such as "月・木" or "第1・3土" are compiled once into a
+CollectionRule holding a weekday bitmask and an nth-week bitmask, so checking
+a date is a couple of bit tests instead of re-parsing the string.
+"""
+import re
+import unicodedata
+from datetime import timedelta, timezone
+from functools import lru_cache
+from typing import NamedTuple
+
+JST = timezone(timedelta(hours=+9), 'JST')
+WEEKDAYS = '月火水木金土日' # Index matches date.weekday()
+ALL_WEEKS = 0b11111 # 1st to 5th occurrence of a weekday in the month
+
+# (Schedule column, label shown to users)
+GARBAGE_TYPES = (
+    ('resources', '資源'),
+    ('burnable', '燃やすごみ'),
+    ('ceramic_glass_metal', '陶器・ガラス・金属ごみ'),
+)
+
+_WEEKLY_RE = re.compile(r'^[月火水木金土日](?:・[月火水木金土日])*$')
+_NTH_WEEK_RE = re.compile(r'^第([1-5](?:・[1-5])*)([月火水木金土日])$')
+
+class RuleParseError(ValueError):
+    """Raised when a schedule string cannot be compiled."""
+
+class CollectionRule(NamedTuple):
+    weekday_mask: int # Bit n set -> collected on date.weekday() == n
+    week_mask: int # Bit n set -> collected on the (n+1)th occurrence in the month
+    source: str = ''
+
+    def fires_on(self, date_obj):
+        """Returns True if garbage is collected on the given date."""
+        return bool(
+            (self.weekday_mask >> date_obj.weekday()) & 1
+            and (self.week_mask >> ((date_obj.day - 1) // 7)) & 1
+        )
+
+    def next_dates(self, start, n):
+        """Returns the next n collection dates on or after start."""
+        dates = []
+        if not self.weekday_mask or not self.week_mask:
+            return dates
+        date_obj = start
+        while len(dates) < n:
+            date_obj += timedelta(days=self._days_to_next_weekday(date_obj.weekday()))
+            if (self.week_mask >> ((date_obj.day - 1) // 7)) & 1:
+                dates.append(date_obj)
+            date_obj += timedelta(days=1)
+        return dates
+
+    def _days_to_next_weekday(self, weekday):
+        for offset in range(7):
+            if (self.weekday_mask >> ((weekday + offset) % 7)) & 1:
+                return offset
+        return 0
+
+# A rule that never fires, used for empty columns and unparseable strings
+NEVER = CollectionRule(0, 0)
+
+@lru_cache(maxsize=None)
+def compile_rule(schedule_str):
+    """
+    Compiles a schedule string into a CollectionRule.
+    e.g., "月・木" -> every Monday and Thursday
+    e.g., "第1・3火" -> the 1st and 3rd Tuesday of the month
+    Empty strings compile to NEVER. Raises RuleParseError for anything else.
+    """
+    if not schedule_str:
+        return NEVER
+    text = unicodedata.normalize('NFKC', schedule_str).replace(' ', '')
+
+    if _WEEKLY_RE.match(text):
+        weekday_mask = 0
+        for day in text.split('・'):
+            weekday_mask |= 1 << WEEKDAYS.index(day)
+        return CollectionRule(weekday_mask, ALL_WEEKS, schedule_str)
+
+    match = _NTH_WEEK_RE.match(text)
+    if match:
+        week_mask = 0
+        for week in match.group(1).split('・'):
+            week_mask |= 1 << (int(week) - 1)
+        return CollectionRule(1 << WEEKDAYS.index(match.group(2)), week_mask, schedule_str)
+
+    raise RuleParseError(f"Unrecognised schedule string '{schedule_str}'")
+
+def get_rule(schedule_str):
+    """Like compile_rule, but returns NEVER instead of raising."""
+    try:
+        return compile_rule(schedule_str)
+    except RuleParseError:
+        return NEVER
+
+def validate_schedule_item(item):
+    """Returns a list of error messages for one area entry of a schedule file."""
+    errors = []
+    for column, label in GARBAGE_TYPES:
+        try:
+            compile_rule(item.get(column))
+        except RuleParseError as e:
+            errors.append(f"{item.get('name')} ({label}): {e}")
+    return errors
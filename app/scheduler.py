@@ -1,123 +1,246 @@
-from datetime import datetime, timedelta, timezone
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-
-from .models import db, User, Schedule
-from app import line_bot_api
-from linebot.v3.messaging import (
-    PushMessageRequest,
-    TextMessage
+import re
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+from sqlalchemy import select
+
+from .models import db, User, DEFAULT_NOTIFY_MINUTE, Schedule
+from .collection_days import collection_types_by_area, extend_collection_days
+from .rules import JST
+from .dispatch import ErrorSampler, NotificationDispatcher
+from .outbox import OUTBOX_RETENTION_DAYS, drain_outbox, enqueue_notifications, purge_outbox
+from .metrics import JOB_PHASE_SECONDS
+from .shards import (
+    NOTIFY_BUCKET_MINUTES,
+    bucket_of,
+    claim_shard,
+    dispatch_workers,
+    due_buckets,
+    finish_shard,
+    in_bucket,
+    plan_shards,
+    planned_buckets,
+    purge_shards,
+    reopen_finished_shards,
+    run_summary,
+    shard_count,
+    shard_of,
+    worker_name,
 )
 
-# --- Date Calculation Helpers ---
-JST = timezone(timedelta(hours=+9), 'JST')
-DAY_MAP = {0: '月', 1: '火', 2: '水', 3: '木', 4: '金', 5: '土', 6: '日'}
+# --- Notification Time ---
 
-def get_nth_weekday_of_month(date_obj):
-    """Calculates if the date is the 1st, 2nd, 3rd, 4th, or 5th occurrence of its weekday in the month."""
-    return (date_obj.day - 1) // 7 + 1
+NOTIFY_TIME_PATTERN = re.compile(r'^(\d{1,2})\s*(?:[:時]\s*(?:(\d{1,2})\s*分?)?)?$')
 
-def check_schedule(schedule_str, tomorrow):
+def parse_notify_time(text):
     """
-    Checks if a given schedule string matches the given date (tomorrow).
-    e.g., schedule_str="月・木", tomorrow=datetime_object
-    e.g., schedule_str="第1・3火", tomorrow=datetime_object
+    Parses a reminder time like '19:00', '7:30' or '19時30分' into minutes after
+    midnight, rounded down to its bucket. Returns None if it is not a time.
     """
-    if not schedule_str:
-        return False
-    
-    tomorrow_weekday_jp = DAY_MAP[tomorrow.weekday()]
+    match = NOTIFY_TIME_PATTERN.match(unicodedata.normalize('NFKC', text).strip())
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2) or 0)
+    if hour > 23 or minute > 59:
+        return None
+    return bucket_of(hour * 60 + minute)
 
-    # Case 1: Weekly schedule (e.g., "月・木", "月・水・金")
-    if '第' not in schedule_str:
-        return tomorrow_weekday_jp in schedule_str
+def format_notify_time(minute):
+    """Formats minutes after midnight like '19:00'; None means the default time."""
+    if minute is None:
+        minute = DEFAULT_NOTIFY_MINUTE
+    return f"{minute // 60}:{minute % 60:02d}"
 
-    # Case 2: Bi-weekly schedule (e.g., "第1・3火")
-    try:
-        parts = schedule_str.replace('第', '').split('・') # "1・3火" -> ["1", "3火"]
-        target_day = parts[-1][-1] # "3火" -> "火"
-        
-        if tomorrow_weekday_jp != target_day:
-            return False
+# --- Scheduler Job ---
 
-        target_weeks_str = [p.replace(target_day, '') for p in parts] # ["1", "3"]
-        target_weeks = [int(w) for w in target_weeks_str]
-        nth_week = get_nth_weekday_of_month(tomorrow)
-        
-        return nth_week in target_weeks
-    except (ValueError, IndexError) as e:
-        # Log the error for debugging
-        print(f"Error parsing schedule string '{schedule_str}': {e}")
-        return False
+# Number of user rows fetched from the database at a time by the nightly job
+USER_BATCH_SIZE = 1000
 
-# --- Scheduler Job ---
+def build_notification_message(collection_types):
+    """Creates the reminder text for a list of garbage type labels."""
+    unique_types = sorted(set(collection_types))
+    return f"【ゴミ出し通知】\n明日は「{'、'.join(unique_types)}」の収集日です。"
+
+def build_area_messages(date_obj):
+    """Returns {municipality: {area_name: message text}} for the areas collected on the date."""
+    messages_by_municipality = {}
+    for municipality in db.session.scalars(select(Schedule.municipality).distinct()):
+        area_messages = {
+            area_name: build_notification_message(collection_types)
+            for area_name, collection_types in collection_types_by_area(date_obj, municipality).items()
+        } # Key: area_name, Value: message text
+        if area_messages:
+            messages_by_municipality[municipality] = area_messages
+    return messages_by_municipality
+
+def run_shard(app, shard, messages_by_municipality, sampler=None):
+    """
+    Queues and sends the reminders of one claimed shard, then records it as
+    done. Errors are logged through sampler, shared by the whole run.
+    """
+    with JOB_PHASE_SECONDS.labels('select').time():
+        count = 0
+        for municipality, area_messages in messages_by_municipality.items():
+            areas = [
+                area_name for area_name in area_messages
+                if shard_of(municipality, area_name, shard.shard_count) == shard.shard
+            ]
+            if not areas:
+                continue
+            # Stream (line_user_id, area_name) pairs of the bucket's users in the
+            # shard's collected areas in one indexed query, without building ORM
+            # objects, and write them to the outbox batch by batch
+            query = (
+                select(User.line_user_id, User.area_name)
+                .where(in_bucket(shard.bucket), User.municipality == municipality, User.area_name.in_(areas))
+            )
+            rows = db.session.execute(query.execution_options(yield_per=USER_BATCH_SIZE))
+            count += enqueue_notifications(
+                shard.date,
+                ((line_user_id, area_messages[area_name]) for line_user_id, area_name in rows),
+                shard=shard.shard,
+                bucket=shard.bucket,
+            )
+
+    with JOB_PHASE_SECONDS.labels('dispatch').time():
+        stats = drain_outbox(
+            app, shard.date, shard.shard, shard.bucket,
+            dispatcher=NotificationDispatcher(app, sampler=sampler),
+        )
+    finish_shard(shard, stats['sent'], stats['failed'])
+    app.logger.info(
+        f"Shard {shard.shard} of {format_notify_time(shard.bucket)} for {shard.date} done: {count} queued, "
+        f"{stats['sent']} sent, {stats['failed']} failed."
+    )
+
+def run_dispatch_worker(app, date_obj, messages_by_municipality, sampler=None):
+    """Claims and runs shards of the date until none are left. Returns the number run."""
+    worker = worker_name()
+    done = 0
+    with app.app_context():
+        while True:
+            shard = claim_shard(date_obj, worker)
+            if shard is None:
+                return done
+            try:
+                run_shard(app, shard, messages_by_municipality, sampler)
+            except Exception as e:
+                # The shard stays running and is picked up again once its lease expires
+                db.session.rollback()
+                app.logger.error(f"Shard {shard.shard} of {format_notify_time(shard.bucket)} for {date_obj} failed: {e}")
+                return done
+            done += 1
 
-def daily_notification_job(app):
+def daily_notification_job(app, target_date=None, workers=None, until=None):
     """
-    This job runs every day to check for tomorrow's garbage collection
-    and sends notifications to the relevant users.
+    This job checks for tomorrow's garbage collection and sends notifications
+    to the users whose notification time is before minute `until` after
+    midnight JST (default: every user).
     It runs within a dedicated app context.
+    The run is split into buckets of notification time and those into shards
+    of areas (see app/shards.py). The first caller plans each due bucket;
+    every caller, in any process or instance, then works through whichever
+    shards are still unclaimed with `workers` threads (default:
+    dispatch_workers()), so more workers finish sooner.
+    Reminders go through the outbox, so running it again for the same
+    target_date (default: tomorrow) only sends what is still pending.
     """
     with app.app_context():
         app.logger.info("Running daily notification job...")
         
-        tomorrow = datetime.now(JST).date() + timedelta(days=1)
-        
-        schedules = db.session.query(Schedule).all()
-        notifications_to_send = {} # Key: user_id, Value: list of garbage types
-
-        for schedule in schedules:
-            collection_types = []
-            if check_schedule(schedule.resources, tomorrow):
-                collection_types.append("資源")
-            if check_schedule(schedule.burnable, tomorrow):
-                collection_types.append("燃やすごみ")
-            if check_schedule(schedule.ceramic_glass_metal, tomorrow):
-                collection_types.append("陶器・ガラス・金属ごみ")
-
-            if not collection_types:
-                continue
+        today = datetime.now(JST).date()
+        tomorrow = target_date or today + timedelta(days=1)
 
-            # If there's a collection, find users for this schedule
-            users = db.session.query(User).filter_by(area_name=schedule.name).all()
-            for user in users:
-                # Use a consistent message format for each user
-                if user.line_user_id not in notifications_to_send:
-                    notifications_to_send[user.line_user_id] = []
-                notifications_to_send[user.line_user_id].extend(collection_types)
-
-        # Send notifications
-        for user_id, types in notifications_to_send.items():
-            # Remove duplicates and create message
-            unique_types = sorted(list(set(types)))
-            full_message = f"【ゴミ出し通知】\n明日は「{'、'.join(unique_types)}」の収集日です。"
-            try:
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=full_message)]
-                    )
-                )
-                app.logger.info(f"Sent notification to {user_id} for types: {unique_types}")
-            except Exception as e:
-                app.logger.error(f"Failed to send notification to {user_id}: {e}")
+        with JOB_PHASE_SECONDS.labels('compute').time():
+            # Buckets missed earlier (e.g. a skipped cron call) are planned along with the current one
+            planned = planned_buckets(tomorrow)
+            planner = False
+            for bucket in due_buckets(until):
+                if bucket not in planned:
+                    planner = plan_shards(tomorrow, bucket, shard_count()) or planner
+            if planner:
+                # Keep the materialized calendar rolling; tomorrow is long inside its horizon,
+                # so workers that start meanwhile read complete rows
+                extend_collection_days(today)
+            reopen_finished_shards(tomorrow)
+            messages_by_municipality = build_area_messages(tomorrow)
+        if not messages_by_municipality:
+            app.logger.info("No collections tomorrow. Nothing to queue.")
+
+        # The first few of each error are logged once per run, not once per shard
+        sampler = ErrorSampler()
+        if planner:
+            # Leftovers queued before dispatch was sharded
+            drain_outbox(app, tomorrow, None, dispatcher=NotificationDispatcher(app, sampler=sampler))
+
+        workers = workers or dispatch_workers()
+        threads = [
+            threading.Thread(target=run_dispatch_worker, args=(app, tomorrow, messages_by_municipality, sampler))
+            for _ in range(workers - 1)
+        ]
+        for thread in threads:
+            thread.start()
+        run_dispatch_worker(app, tomorrow, messages_by_municipality, sampler)
+        for thread in threads:
+            thread.join()
+
+        summary = run_summary(tomorrow)
+        app.logger.info(
+            f"Dispatch for {tomorrow}: shards {summary['shards']}, "
+            f"{summary['sent']} sent, {summary['failed']} failed."
+        )
+        if sampler.counts:
+            app.logger.warning(f"Dispatch errors for {tomorrow}: {sampler.summary()}")
+        if planner:
+            purge_outbox(today)
+            purge_shards(today - timedelta(days=OUTBOX_RETENTION_DAYS))
+
+def notification_bucket_job(app, now=None):
+    """
+    Sends tomorrow's reminders to the users whose notification time has come,
+    i.e. the current bucket and any earlier one not run yet today.
+    Meant to run at the start of every bucket.
+    """
+    now = now or datetime.now(JST)
+    until = bucket_of(now.hour * 60 + now.minute) + NOTIFY_BUCKET_MINUTES
+    daily_notification_job(app, now.date() + timedelta(days=1), until=until)
+
+def leader_bucket_job(app, elector):
+    """notification_bucket_job, run only in the elected leader process."""
+    if elector.confirm():
+        notification_bucket_job(app)
 
 def start_scheduler(app):
-    """Starts the background scheduler."""
+    """
+    Starts the background scheduler. Any number of processes may call this:
+    they elect one leader (see app/leader.py) and only the leader runs the
+    jobs; another process takes over if it dies.
+    """
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.triggers.cron import CronTrigger
+    from .leader import LeaderElector
+
+    with app.app_context():
+        elector = LeaderElector(db.engine, app.logger).start()
+    app.extensions['scheduler_leader'] = elector
+
     scheduler = BackgroundScheduler(timezone=JST)
     
-    # Schedule the job to run every day at 20:00 (8 PM) JST
+    # Schedule the job at the start of every notification time bucket
     scheduler.add_job(
-        daily_notification_job,
-        trigger=CronTrigger(hour=20, minute=0, timezone=JST),
-        id='daily_notification_job',
-        name='Send daily garbage collection reminders',
+        leader_bucket_job,
+        trigger=CronTrigger(minute=f'*/{NOTIFY_BUCKET_MINUTES}', timezone=JST),
+        id='notification_bucket_job',
+        name='Send garbage collection reminders due in this bucket',
         replace_existing=True,
-        args=[app] # Pass the app instance to the job
+        args=[app, elector] # Pass the app instance to the job
     )
     
     try:
         scheduler.start()
-        app.logger.info("Scheduler started successfully. Notifications will be sent daily at 8 PM JST.")
+        app.logger.info(
+            f"Scheduler started successfully. Notifications will be sent every {NOTIFY_BUCKET_MINUTES} minutes "
+            "to the users whose notification time has come."
+        )
     except Exception as e:
         app.logger.error(f"Scheduler failed to start: {e}")
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+Shard bookkeeping for the nightly dispatch.
+
+A run for one collection date is split by notification time into buckets of
+NOTIFY_BUCKET_MINUTES, each planned when it falls due, and every bucket into
+shards of areas, one dispatch_shards row each. An area's users all land in
+the same shard (see shard_of), so its reminders still go out in full
+multicast chunks. Any number of worker threads, processes or instances can
+work on the same run: each claims one pending shard at a time
+(SELECT ... FOR UPDATE SKIP LOCKED on PostgreSQL), processes it and marks it
+done with its counts. A shard left running by a crashed worker can be claimed
+again after SHARD_LEASE_SECONDS. SQLite serialises writers, so there a claim
+is a conditional UPDATE and each process runs a single worker.
+"""
+import os
+import socket
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, delete, exists, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, DispatchShard, NotificationOutbox, User
+
+# Shards per nightly run (DISPATCH_SHARDS); more shards spread better over more workers
+DEFAULT_SHARD_COUNT = 16
+# A running shard not finished within this many seconds is handed to another worker
+SHARD_LEASE_SECONDS = 15 * 60
+# Width of a notification time bucket; the scheduler runs once per bucket
+NOTIFY_BUCKET_MINUTES = 15
+
+def bucket_of(minute):
+    """The bucket (its first minute after midnight) that a notify_minute falls in."""
+    return minute - minute % NOTIFY_BUCKET_MINUTES
+
+def in_bucket(bucket):
+    """Filter for the users whose notification time falls in the bucket."""
+    return and_(User.notify_minute >= bucket, User.notify_minute < bucket + NOTIFY_BUCKET_MINUTES)
+
+def shard_count():
+    return int(os.getenv('DISPATCH_SHARDS', str(DEFAULT_SHARD_COUNT)))
+
+def shard_of(municipality, area_name, count):
+    """The shard, out of count, that sends the reminders of an area; stable across processes."""
+    return zlib.crc32(f"{municipality}/{area_name}".encode('utf-8')) % count
+
+def dispatch_workers():
+    """Worker threads per process for the nightly run (DISPATCH_WORKERS); always 1 on SQLite."""
+    if db.engine.dialect.name == 'sqlite':
+        return 1
+    return max(1, int(os.getenv('DISPATCH_WORKERS', '1')))
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def due_buckets(until=None):
+    """Buckets that have users with a notification time before minute `until` (default: all)."""
+    query = select(User.notify_minute).where(User.notify_minute.is_not(None)).distinct()
+    if until is not None:
+        query = query.where(User.notify_minute < until)
+    return sorted({bucket_of(minute) for minute in db.session.scalars(query)})
+
+def planned_buckets(date_obj):
+    return set(db.session.scalars(
+        select(DispatchShard.bucket).where(DispatchShard.date == date_obj).distinct()
+    ))
+
+def plan_shards(date_obj, bucket, count):
+    """
+    Creates the shards of a bucket for a date unless they already exist.
+    Each records the shard count, so every worker assigns areas to shards
+    the same way even if DISPATCH_SHARDS changes during the run.
+    Returns True if this call created them. Commits.
+    """
+    planned = db.session.scalar(
+        select(func.count()).select_from(DispatchShard)
+        .where(DispatchShard.date == date_obj, DispatchShard.bucket == bucket)
+    )
+    if planned:
+        return False
+
+    if not db.session.scalar(select(exists().where(in_bucket(bucket)))):
+        count = 1
+    rows = [
+        {
+            'date': date_obj,
+            'bucket': bucket,
+            'shard': shard,
+            'shard_count': count,
+            'status': 'pending',
+            'sent': 0,
+            'failed': 0,
+        }
+        for shard in range(count)
+    ]
+    try:
+        db.session.execute(insert(DispatchShard), rows)
+        db.session.commit()
+    except IntegrityError:
+        # Another worker planned the same run first
+        db.session.rollback()
+        return False
+    return True
+
+def reopen_finished_shards(date_obj):
+    """
+    Marks done shards that still have pending outbox rows (retryable failures)
+    as pending again, so re-running a date sends what is left. Commits.
+    """
+    leftover = exists().where(
+        NotificationOutbox.date == DispatchShard.date,
+        NotificationOutbox.bucket == DispatchShard.bucket,
+        NotificationOutbox.shard == DispatchShard.shard,
+        NotificationOutbox.status == 'pending',
+    )
+    reopened = db.session.execute(
+        update(DispatchShard)
+        .where(
+            DispatchShard.date == date_obj,
+            DispatchShard.status == 'done',
+            leftover,
+        )
+        .values(status='pending')
+    ).rowcount
+    db.session.commit()
+    return reopened
+
+def _claimable(date_obj):
+    stale = _utcnow() - timedelta(seconds=SHARD_LEASE_SECONDS)
+    return (
+        DispatchShard.date == date_obj,
+        or_(
+            DispatchShard.status == 'pending',
+            (DispatchShard.status == 'running') & (DispatchShard.claimed_at < stale),
+        ),
+    )
+
+def claim_shard(date_obj, worker):
+    """Claims the next pending (or abandoned) shard of the date for worker. Returns it, or None. Commits."""
+    query = (
+        select(DispatchShard)
+        .where(*_claimable(date_obj))
+        .order_by(DispatchShard.bucket, DispatchShard.shard)
+        .limit(1)
+    )
+    if db.engine.dialect.name == 'postgresql':
+        # Concurrent workers skip each other's locked rows instead of waiting
+        shard = db.session.scalars(query.with_for_update(skip_locked=True)).first()
+        if shard is not None:
+            shard.status = 'running'
+            shard.claimed_by = worker
+            shard.claimed_at = _utcnow()
+        db.session.commit()
+        return shard
+
+    while True:
+        shard = db.session.scalars(query).first()
+        if shard is None:
+            db.session.commit()
+            return None
+        # Only succeeds if nobody claimed the row since it was read
+        claimed = db.session.execute(
+            update(DispatchShard)
+            .where(DispatchShard.id == shard.id, *_claimable(date_obj))
+            .values(status='running', claimed_by=worker, claimed_at=_utcnow())
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            db.session.refresh(shard)
+            return shard
+
+def finish_shard(shard, sent, failed):
+    """Records a shard as done and adds to its delivery counts (a shard can be re-run). Commits."""
+    shard.status = 'done'
+    shard.finished_at = _utcnow()
+    shard.sent += sent
+    shard.failed += failed
+    db.session.commit()
+
+def run_summary(date_obj):
+    """Shard counts by status and delivery totals for one run, over every bucket planned so far."""
+    rows = db.session.execute(
+        select(DispatchShard.status, func.count(), func.sum(DispatchShard.sent), func.sum(DispatchShard.failed))
+        .where(DispatchShard.date == date_obj)
+        .group_by(DispatchShard.status)
+    ).all()
+    return {
+        'date': date_obj.isoformat(),
+        'buckets': len(planned_buckets(date_obj)),
+        'shards': {status: count for status, count, _, _ in rows},
+        'sent': sum(sent or 0 for _, _, sent, _ in rows),
+        'failed': sum(failed or 0 for _, _, _, failed in rows),
+    }
+
+def latest_run_summary():
+    """run_summary of the most recent run, or None if there has been none."""
+    latest = db.session.scalar(select(func.max(DispatchShard.date)))
+    return run_summary(latest) if latest else None
+
+def purge_shards(before):
+    """Deletes the shards of runs for dates before `before`. Commits."""
+    db.session.execute(delete(DispatchShard).where(DispatchShard.date < before))
+    db.session.commit()
@@ -0,0 +1,229 @@
+"""
+Dry run of the nightly notification computation, run with `flask simulate`.
+
+Each area's rules are evaluated once per day and the result is weighted by
+the number of users registered to the area, so nothing is sent and the cost
+does not grow with the user count. The candidate dataset (data/schedules by
+default) is compared with a previous one (by default the schedules loaded in
+the database), so a new schedule file can be checked before it is loaded.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import func, select
+
+from .models import db, Schedule, User
+from .rules import GARBAGE_TYPES, JST, get_rule, validate_schedule_item
+
+# Changed areas listed individually in the printed diff; the JSON output has them all
+DIFF_PRINT_LIMIT = 20
+
+# --- Datasets ---
+
+def read_dataset(path):
+    """
+    Reads a schedule file, or every file in a schedule directory, without
+    touching the database. Returns {(municipality, area_name): {column: rule string}}.
+    """
+    from .data import SCHEDULE_COLUMNS, schedule_files
+
+    paths = schedule_files(path) if os.path.isdir(path) else [path]
+    dataset = {}
+    for json_path in paths:
+        with open(json_path, encoding='utf-8') as f:
+            content = json.load(f)
+        for item in content['areas']:
+            dataset[content['municipality'], item['name']] = {column: item[column] for column in SCHEDULE_COLUMNS}
+    return dataset
+
+def database_dataset():
+    """The schedules currently loaded, in the same shape as read_dataset."""
+    columns = [column for column, _ in GARBAGE_TYPES]
+    rows = db.session.execute(
+        select(Schedule.municipality, Schedule.name, *(getattr(Schedule, column) for column in columns))
+    )
+    return {(municipality, name): dict(zip(columns, rules)) for municipality, name, *rules in rows}
+
+def registered_user_counts():
+    """{(municipality, area_name): number of registered users}, in one grouped query."""
+    rows = db.session.execute(
+        select(User.municipality, User.area_name, func.count())
+        .where(User.area_name.is_not(None))
+        .group_by(User.municipality, User.area_name)
+    )
+    return {(municipality, area_name): count for municipality, area_name, count in rows}
+
+# --- Simulation ---
+
+def collection_events(dataset, start, end):
+    """
+    {(municipality, area_name): set of (date, garbage type column)} between
+    start and end (inclusive). Unparseable rules never fire, as in the nightly job.
+    """
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    events = {}
+    for area, rules in dataset.items():
+        area_events = set()
+        for column, _ in GARBAGE_TYPES:
+            rule = get_rule(rules[column])
+            area_events.update((day, column) for day in days if rule.fires_on(day))
+        events[area] = area_events
+    return events
+
+def simulate(events, user_counts, start, end):
+    """
+    Per-day recipient counts and per-area totals of the reminders the nightly
+    job would send for collections between start and end.
+    """
+    days = {start + timedelta(days=i): {'recipients': 0, 'areas': 0} for i in range((end - start).days + 1)}
+    areas = {}
+    for area, area_events in events.items():
+        users = user_counts.get(area, 0)
+        collection_dates = {day for day, _ in area_events}
+        for day in collection_dates:
+            days[day]['recipients'] += users
+            days[day]['areas'] += 1
+        areas[area] = {
+            'users': users,
+            'collection_days': len(collection_dates),
+            'notifications': users * len(collection_dates),
+        }
+    return {
+        'days': days,
+        'areas': areas,
+        'total_notifications': sum(area['notifications'] for area in areas.values()),
+    }
+
+def compare(current_events, previous_events, current, previous, user_counts):
+    """What changes between the previous and the current dataset, over the same dates and users."""
+    changed = {}
+    for area in current_events.keys() & previous_events.keys():
+        added = current_events[area] - previous_events[area]
+        removed = previous_events[area] - current_events[area]
+        if added or removed:
+            changed[area] = {
+                'users': user_counts.get(area, 0),
+                'collections_added': len(added),
+                'collections_removed': len(removed),
+            }
+    removed_areas = previous_events.keys() - current_events.keys()
+    return {
+        'areas_added': sorted(current_events.keys() - previous_events.keys()),
+        'areas_removed': sorted(removed_areas),
+        # Users of removed areas are unregistered when the dataset is loaded
+        'users_unregistered': sum(user_counts.get(area, 0) for area in removed_areas),
+        'areas_changed': changed,
+        'days_changed': {
+            day: {'previous': previous['days'][day]['recipients'], 'current': stats['recipients']}
+            for day, stats in current['days'].items()
+            if stats['recipients'] != previous['days'][day]['recipients']
+        },
+        'total_notifications_delta': current['total_notifications'] - previous['total_notifications'],
+    }
+
+def run_simulation(start, end, dataset_path=None, previous_path=None):
+    """
+    Simulates the candidate dataset (dataset_path, default data/schedules)
+    and the previous one (previous_path, default the loaded schedules) for
+    the registered users. Returns a JSON-serialisable dict.
+    """
+    from .data import SCHEDULE_DIR
+
+    user_counts = registered_user_counts()
+    dataset = read_dataset(dataset_path or SCHEDULE_DIR)
+    invalid_rules = [
+        f"{municipality} {error}"
+        for (municipality, name), rules in dataset.items()
+        for error in validate_schedule_item(dict(rules, name=name))
+    ]
+    current_events = collection_events(dataset, start, end)
+    previous_dataset = read_dataset(previous_path) if previous_path else database_dataset()
+    previous_events = collection_events(previous_dataset, start, end)
+    current = simulate(current_events, user_counts, start, end)
+    previous = simulate(previous_events, user_counts, start, end)
+    diff = compare(current_events, previous_events, current, previous, user_counts)
+
+    def area_key(area):
+        return f"{area[0]} {area[1]}"
+
+    return {
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'registered_users': sum(user_counts.values()),
+        'invalid_rules': invalid_rules,
+        'days': {day.isoformat(): stats for day, stats in current['days'].items()},
+        'areas': {area_key(area): stats for area, stats in sorted(current['areas'].items())},
+        'total_notifications': current['total_notifications'],
+        'diff': {
+            'previous': previous_path or 'database',
+            'areas_added': [area_key(area) for area in diff['areas_added']],
+            'areas_removed': [area_key(area) for area in diff['areas_removed']],
+            'users_unregistered': diff['users_unregistered'],
+            'areas_changed': {area_key(area): stats for area, stats in sorted(diff['areas_changed'].items())},
+            'days_changed': {day.isoformat(): stats for day, stats in sorted(diff['days_changed'].items())},
+            'total_notifications_delta': diff['total_notifications_delta'],
+        },
+    }
+
+# --- CLI ---
+
+def register_cli_command(app):
+    @app.cli.command('simulate')
+    @click.option('--from', 'from_str', default=None, help='First collection date (YYYY-MM-DD). Defaults to tomorrow.')
+    @click.option('--to', 'to_str', default=None, help='Last collection date (YYYY-MM-DD). Defaults to a year after --from.')
+    @click.option('--dataset', 'dataset_path', default=None, help='Schedule file or directory to simulate (default: data/schedules).')
+    @click.option('--previous', 'previous_path', default=None, help='Schedule file or directory to diff against (default: the loaded schedules).')
+    @click.option('--output', default=None, help='Also write the full results as JSON to this file.')
+    def simulate_command(from_str, to_str, dataset_path, previous_path, output):
+        """Computes the reminders that would be sent over a date range, without sending anything."""
+        start = (
+            datetime.strptime(from_str, '%Y-%m-%d').date() if from_str
+            else datetime.now(JST).date() + timedelta(days=1)
+        )
+        end = datetime.strptime(to_str, '%Y-%m-%d').date() if to_str else start + timedelta(days=364)
+        if end < start:
+            raise click.BadParameter('--to is before --from.')
+
+        with app.app_context():
+            results = run_simulation(start, end, dataset_path, previous_path)
+
+        print(f"Simulated {start} to {end} for {results['registered_users']} registered users.")
+        for error in results['invalid_rules']:
+            print(f"Invalid schedule rule (never fires): {error}")
+        print("Recipients per collection date:")
+        for day, stats in results['days'].items():
+            print(f"  {day}  {stats['recipients']:>8} users  {stats['areas']:>4} areas")
+        print("Reminders per area:")
+        for area, stats in results['areas'].items():
+            print(
+                f"  {area}: {stats['collection_days']} collection days x {stats['users']} users "
+                f"= {stats['notifications']}"
+            )
+        print(f"Total reminders: {results['total_notifications']}")
+
+        diff = results['diff']
+        print(f"Compared with {diff['previous']}:")
+        print(f"  {len(diff['areas_added'])} areas added, {len(diff['areas_removed'])} removed, "
+              f"{len(diff['areas_changed'])} with different collection dates.")
+        for area in diff['areas_added']:
+            print(f"  + {area}")
+        for area in diff['areas_removed']:
+            print(f"  - {area}")
+        for area, stats in list(diff['areas_changed'].items())[:DIFF_PRINT_LIMIT]:
+            print(
+                f"  ~ {area}: {stats['collections_added']} collections added, "
+                f"{stats['collections_removed']} removed, {stats['users']} users"
+            )
+        if len(diff['areas_changed']) > DIFF_PRINT_LIMIT:
+            print(f"  ... and {len(diff['areas_changed']) - DIFF_PRINT_LIMIT} more changed areas.")
+        if diff['users_unregistered']:
+            print(f"  Warning: {diff['users_unregistered']} users are registered to removed areas.")
+        print(f"  {len(diff['days_changed'])} dates with a different recipient count, "
+              f"{diff['total_notifications_delta']:+d} reminders in total.")
+
+        if output:
+            with open(output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            print(f"Results written to {output}.")
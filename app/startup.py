@@ -0,0 +1,93 @@
+"""
+Startup timing for create_app and the `flask startup-profile` command.
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import click
+
+class StartupTimer:
+    """Records how long each named startup phase takes, in milliseconds."""
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, round((time.perf_counter() - start) * 1000, 1)))
+
+def schema_fingerprint(metadata):
+    """A short hash of every table, column, index and foreign key the models define."""
+    names = sorted(
+        f"{table.name}.{column.name}"
+        for table in metadata.tables.values()
+        for column in table.columns
+    ) + sorted(
+        f"{table.name}:{index.name}"
+        for table in metadata.tables.values()
+        for index in table.indexes
+    ) + sorted(
+        f"{table.name}->{','.join(constraint.column_keys)}"
+        for table in metadata.tables.values()
+        for constraint in table.foreign_key_constraints
+    )
+    return hashlib.sha1('\n'.join(names).encode('utf-8')).hexdigest()[:12]
+
+# Run in a fresh interpreter so module imports are measured cold
+_PROFILE_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import app as app_package
+imported = time.perf_counter()
+flask_app = app_package.create_app()
+created = time.perf_counter()
+app_package.line_bot_api._resolve()
+api_built = time.perf_counter()
+app_package.handler._resolve()
+handler_built = time.perf_counter()
+print(json.dumps({
+    'import app': round((imported - start) * 1000, 1),
+    'create_app': round((created - imported) * 1000, 1),
+    'create_app phases': flask_app.config['STARTUP_TIMINGS'],
+    'first use: MessagingApi': round((api_built - created) * 1000, 1),
+    'first use: WebhookHandler': round((handler_built - api_built) * 1000, 1),
+}))
+"""
+
+def register_cli_command(app):
+    @app.cli.command('startup-profile')
+    @click.option('--budget', type=float, default=None, help='Fail if import + create_app exceeds this many ms.')
+    def startup_profile_command(budget):
+        """Breaks down cold start time in a fresh interpreter."""
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, LINE_SDK_WARMUP='0')
+        result = subprocess.run(
+            [sys.executable, '-c', _PROFILE_SCRIPT],
+            cwd=project_root, env=env, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            print(result.stderr)
+            sys.exit(result.returncode)
+        profile = json.loads(result.stdout.strip().splitlines()[-1])
+
+        print(f"{'import app':<32}{profile['import app']:>10.1f} ms")
+        print(f"{'create_app':<32}{profile['create_app']:>10.1f} ms")
+        for name, ms in profile['create_app phases']:
+            print(f"  {name:<30}{ms:>10.1f} ms")
+        print(f"{'first use: MessagingApi':<32}{profile['first use: MessagingApi']:>10.1f} ms")
+        print(f"{'first use: WebhookHandler':<32}{profile['first use: WebhookHandler']:>10.1f} ms")
+
+        ready = profile['import app'] + profile['create_app']
+        print(f"{'ready to serve':<32}{ready:>10.1f} ms")
+        if budget is not None and ready > budget:
+            print(f"Startup took {ready:.1f} ms, over the {budget:.1f} ms budget.")
+            sys.exit(1)
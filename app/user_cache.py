@@ -0,0 +1,153 @@
+"""
+Read-through cache of line_user_id -> registered area for the webhook path.
+
+Entries hold the user's area name and schedule strings, so answering a
+collection-day query on a hit only reads the dates from the collection_days
+table. Unregistered users are cached too (negative entries) with a shorter TTL.
+
+A registration drops the entry in the process that handled it. Every other
+process polls users.area_changed_at (and the dataset version, for schedule
+reloads) at most every USER_CACHE_SYNC_SECONDS and drops what changed, so
+a gunicorn worker does not keep serving a user's old area until the TTL.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+from .models import db, User, Schedule, dataset_version
+
+# Seconds between polls for registrations made by other processes
+USER_CACHE_SYNC_SECONDS = float(os.getenv('USER_CACHE_SYNC_SECONDS', '2'))
+# Changes stamped this long before the previous poll are read again, covering
+# commit delays and clock skew between instances
+USER_CACHE_SYNC_MARGIN = timedelta(seconds=10)
+
+class CachedUser(NamedTuple):
+    municipality: str
+    area_name: str
+    resources: str
+    burnable: str
+    ceramic_glass_metal: str
+
+# Stored for users who have no registered area
+_MISSING = object()
+
+class UserCache:
+    """A thread-safe LRU cache with per-entry expiry and hit/miss counters."""
+
+    def __init__(self, maxsize=10000, ttl=300, negative_ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict() # Key: line_user_id, Value: (expires_at, CachedUser or _MISSING)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, line_user_id):
+        """Returns (found, CachedUser or None)."""
+        with self._lock:
+            entry = self._entries.get(line_user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(line_user_id)
+            if entry[1] is _MISSING:
+                self.negative_hits += 1
+                return True, None
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, line_user_id, cached_user):
+        """Stores a CachedUser, or None for an unregistered user."""
+        ttl = self.ttl if cached_user is not None else self.negative_ttl
+        value = cached_user if cached_user is not None else _MISSING
+        with self._lock:
+            self._entries[line_user_id] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(line_user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, line_user_id=None):
+        """Drops one entry, or every entry when line_user_id is None."""
+        with self._lock:
+            if line_user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(line_user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+user_cache = UserCache(
+    maxsize=int(os.getenv('USER_CACHE_SIZE', '10000')),
+    ttl=int(os.getenv('USER_CACHE_TTL', '300')),
+)
+
+def load_cached_user(line_user_id):
+    """Fetches a user's area and schedule strings in a single query."""
+    row = db.session.execute(
+        db.select(
+            Schedule.municipality, Schedule.name,
+            Schedule.resources, Schedule.burnable, Schedule.ceramic_glass_metal,
+        )
+        .join(User, db.and_(User.municipality == Schedule.municipality, User.area_name == Schedule.name))
+        .where(User.line_user_id == line_user_id)
+    ).first()
+    return CachedUser(*row) if row else None
+
+_sync_lock = threading.Lock()
+_synced_at = 0.0 # time.monotonic() of the last poll
+_synced_since = None # UTC time the last poll started; the next one reads changes from then on
+_synced_version = None # dataset_version() at the last poll
+
+def sync_user_cache():
+    """
+    Drops the entries of users whose area changed in another process since
+    the last poll, or every entry if the schedules were reloaded. Polls at
+    most every USER_CACHE_SYNC_SECONDS, from one thread at a time.
+    """
+    global _synced_at, _synced_since, _synced_version
+    if time.monotonic() - _synced_at < USER_CACHE_SYNC_SECONDS or not _sync_lock.acquire(blocking=False):
+        return
+    try:
+        started = datetime.now(timezone.utc).replace(tzinfo=None)
+        version = dataset_version()
+        if version != _synced_version:
+            if _synced_version is not None:
+                user_cache.invalidate()
+            _synced_version = version
+        elif _synced_since is not None:
+            changed = db.session.scalars(
+                db.select(User.line_user_id)
+                .where(User.area_changed_at >= _synced_since - USER_CACHE_SYNC_MARGIN)
+            )
+            for line_user_id in changed:
+                user_cache.invalidate(line_user_id)
+        _synced_since = started
+        _synced_at = time.monotonic()
+    finally:
+        _sync_lock.release()
+
+def get_cached_user(line_user_id):
+    """Returns the user's CachedUser (None if unregistered), reading through the cache."""
+    sync_user_cache()
+    found, cached_user = user_cache.get(line_user_id)
+    if not found:
+        cached_user = load_cached_user(line_user_id)
+        user_cache.set(line_user_id, cached_user)
+    return cached_user
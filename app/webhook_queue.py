@@ -0,0 +1,111 @@
+"""
+Asynchronous webhook processing.
+
+In async mode /callback only checks the signature, puts the raw body on a
+bounded queue and returns 200 straight away. A pool of worker threads then
+parses the payload (every event in it) and runs the handlers, including the
+outbound reply call, each inside its own app context.
+"""
+import os
+import queue
+import threading
+
+from .metrics import WEBHOOK_STAGE_SECONDS
+
+class WebhookQueue:
+    """A bounded queue of raw webhook bodies drained by worker threads."""
+
+    def __init__(self, app, process, workers=4, maxsize=1000):
+        self.app = app
+        self.process = process # Called with (body, signature) for each payload
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._started_pid = None
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.inline = 0 # Payloads handled in the request thread because the queue was full
+        self.max_depth = 0
+
+    def _ensure_started(self):
+        # Threads do not survive a fork (e.g. gunicorn --preload), so start per process
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f'webhook-worker-{i}', daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def submit(self, body, signature):
+        """
+        Queues a verified payload. When the queue is full the payload is
+        processed in the calling thread, which slows the caller down instead
+        of dropping events.
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((body, signature))
+        except queue.Full:
+            with self._stats_lock:
+                self.inline += 1
+            self.app.logger.warning("Webhook queue full, processing payload inline.")
+            self._process(body, signature)
+            return False
+        with self._stats_lock:
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def _run(self):
+        while True:
+            body, signature = self._queue.get()
+            try:
+                self._process(body, signature)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, body, signature):
+        with self.app.app_context():
+            try:
+                with WEBHOOK_STAGE_SECONDS.labels('handle').time():
+                    self.process(body, signature)
+            except Exception as e:
+                with self._stats_lock:
+                    self.failed += 1
+                self.app.logger.error(f"Error processing webhook payload: {e}")
+                return
+            with self._stats_lock:
+                self.processed += 1
+
+    def join(self):
+        """Blocks until every queued payload has been processed."""
+        self._queue.join()
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'depth': self._queue.qsize(),
+            'maxsize': self._queue.maxsize,
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'inline': self.inline,
+        }
+
+def init_webhook_queue(app, process):
+    """Attaches a WebhookQueue to the app when WEBHOOK_MODE=async."""
+    if os.getenv('WEBHOOK_MODE', 'sync') != 'async':
+        return None
+    webhook_queue = WebhookQueue(
+        app,
+        process,
+        workers=int(os.getenv('WEBHOOK_WORKERS', '4')),
+        maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000')),
+    )
+    app.extensions['webhook_queue'] = webhook_queue
+    return webhook_queue
@@ -0,0 +1,150 @@
+"""
+Shared fixtures: a LINE API stub and the app on a throwaway SQLite database.
+
+The stub's address goes into LINE_API_HOST before the app package is
+imported, because the LINE client reads it when it is created.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import socket
+
+import pytest
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+_port = _free_port()
+os.environ['LINE_API_HOST'] = f"http://127.0.0.1:{_port}"
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test-token')
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test-secret')
+
+from app.line_stub import LineStubServer # noqa: E402
+
+_stub = LineStubServer(('127.0.0.1', _port)).start()
+
+@pytest.fixture
+def line_stub():
+    """The LINE API stub, with an empty request log and no injected failures."""
+    _stub.fail_multicast = False
+    _stub.fail_push = False
+    _stub.failure_status = 500
+    _stub.latency = 0.0
+    _stub.rate_limit_every = 0
+    _stub.retry_after = None
+    _stub.record_bodies = True
+    with _stub.lock:
+        _stub.requests.clear()
+        _stub.counts.clear()
+        _stub.rich_menus.clear()
+        _stub.rich_menu_images.clear()
+        _stub.default_rich_menu = None
+        _stub.user_rich_menus.clear()
+    return _stub
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, line_stub):
+    """The app on a fresh SQLite database holding the schedule data."""
+    database_url = f"sqlite:///{tmp_path / 'test.sqlite'}"
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    monkeypatch.setenv('LINE_SDK_WARMUP', '0')
+
+    from app import create_app, db
+    from app import dispatch
+    from app.area_index import invalidate_area_index
+    from app.calendar_feed import invalidate_calendar_feeds
+    from app import user_cache as user_cache_module
+    from app.user_cache import user_cache
+
+    # Process-wide caches would otherwise carry over from the previous test's database
+    invalidate_area_index()
+    user_cache.invalidate()
+    monkeypatch.setattr(user_cache_module, '_synced_at', 0.0)
+    monkeypatch.setattr(user_cache_module, '_synced_since', None)
+    monkeypatch.setattr(user_cache_module, '_synced_version', None)
+    invalidate_calendar_feeds()
+    monkeypatch.setattr(dispatch, 'BACKOFF_BASE_SECONDS', 0.0)
+    monkeypatch.setattr(dispatch, 'circuit_breaker', dispatch.CircuitBreaker())
+
+    app = create_app()
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+@pytest.fixture
+def collection_date(app):
+    """The first date from tomorrow on with at least four areas of 品川区 collected."""
+    from datetime import datetime, timedelta
+    from app.collection_days import collection_types_by_area
+    from app.rules import JST
+
+    day = datetime.now(JST).date() + timedelta(days=1)
+    with app.app_context():
+        while len(collection_types_by_area(day, '品川区')) < 4:
+            day += timedelta(days=1)
+    return day
+
+@pytest.fixture
+def add_users(app, collection_date):
+    """Registers users round-robin in the first areas collected on collection_date; returns their ids."""
+    from app import db
+    from app.collection_days import collection_types_by_area
+    from app.models import User
+
+    def add_users(count, areas=4, notify_minute=None):
+        with app.app_context():
+            names = sorted(collection_types_by_area(collection_date, '品川区'))[:areas]
+            users = [
+                User(line_user_id=f'U{i:05d}', municipality='品川区', area_name=names[i % areas],
+                     notify_minute=notify_minute)
+                for i in range(count)
+            ]
+            db.session.add_all(users)
+            db.session.commit()
+            return [user.line_user_id for user in users]
+    return add_users
+
+def sent_to(stub, path):
+    """Recipients of every request the stub received on path, in order."""
+    recipients = []
+    for request_path, body in stub.requests:
+        if request_path == path:
+            recipients.extend(body['to'] if isinstance(body['to'], list) else [body['to']])
+    return recipients
+
+def replies(stub):
+    """Text of every reply message the stub received, in order."""
+    return [
+        message['text']
+        for request_path, body in stub.requests if request_path == '/v2/bot/message/reply'
+        for message in body['messages']
+    ]
+
+def webhook(user_id, *texts):
+    """A signed /callback payload with one text message event per text, as (body, headers)."""
+    events = [
+        {
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': 1700000000000 + i,
+            'webhookEventId': f"EV{user_id}{i}",
+            'deliveryContext': {'isRedelivery': False},
+            'source': {'type': 'user', 'userId': user_id},
+            'replyToken': f"token-{user_id}-{i}",
+            'message': {'type': 'text', 'id': str(i), 'quoteToken': 'q', 'text': text},
+        }
+        for i, text in enumerate(texts)
+    ]
+    body = json.dumps({'destination': 'Ubot', 'events': events}, ensure_ascii=False)
+    return body, webhook_headers(body)
+
+def webhook_headers(body):
+    """Request headers for body, signed with the channel secret."""
+    digest = hmac.new(os.environ['LINE_CHANNEL_SECRET'].encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return {'X-Line-Signature': base64.b64encode(digest).decode('utf-8'), 'Content-Type': 'application/json'}
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from app.area_index import AreaIndex, get_area_index, invalidate_area_index, lookup_area
+from app.models import db, Schedule
+
+NAMES = ['荏原 1丁目', '荏原 2-4丁目', '大井 1・2・4丁目', '大井 3・5丁目', '東大井 1-4丁目', '東大井 5丁目 上記以外']
+
+@pytest.fixture
+def index():
+    return AreaIndex(NAMES)
+
+@pytest.mark.parametrize('text, expected', [
+    ('荏原 1丁目', '荏原 1丁目'),
+    ('荏原３丁目', '荏原 2-4丁目'),
+    ('荏原三丁目', '荏原 2-4丁目'),
+    ('大井4', '大井 1・2・4丁目'),
+    ('品川区東大井2丁目', '東大井 1-4丁目'),
+])
+def test_lookup_resolves_chome(index, text, expected):
+    assert index.lookup(text) == (expected, [])
+
+def test_lookup_offers_nearest_chome(index):
+    schedule_name, candidates = index.lookup('大井6丁目')
+    assert schedule_name is None
+    assert candidates == ['大井 3・5丁目', '大井 1・2・4丁目']
+
+def test_lookup_only_suggests_near_misses(index):
+    # A typo is never resolved outright, only offered
+    schedule_name, candidates = index.lookup('東大位2丁目')
+    assert schedule_name is None
+    assert candidates == ['東大井 1-4丁目']
+
+def test_lookup_unknown_town(index):
+    assert index.lookup('札幌') == (None, [])
+
+def test_index_is_built_from_the_schedules(app):
+    with app.app_context():
+        assert get_area_index('品川区').lookup('東大井２丁目') == ('東大井 1-4丁目', [])
+
+def test_invalidated_index_sees_new_areas(app):
+    with app.app_context():
+        assert get_area_index('品川区').lookup('天王洲2丁目') == (None, [])
+        db.session.add(Schedule(municipality='品川区', name='天王洲 2丁目', resources='水', burnable='月・木', ceramic_glass_metal='第1・3土'))
+        db.session.commit()
+        invalidate_area_index()
+        assert get_area_index('品川区').lookup('天王洲2丁目') == ('天王洲 2丁目', [])
+
+def write_ward(tmp_path, municipality, names):
+    path = tmp_path / 'ward.json'
+    areas = [{'name': name, 'resources': '水', 'burnable': '月・木', 'ceramic_glass_metal': '第1・3土'} for name in names]
+    path.write_text(json.dumps({'municipality': municipality, 'areas': areas}, ensure_ascii=False), encoding='utf-8')
+    return str(path)
+
+def test_lookup_area_across_wards(app, tmp_path):
+    from app.data import load_municipality
+
+    with app.app_context():
+        assert lookup_area('東大井2丁目') == ('品川区', '東大井 1-4丁目', [])
+
+        # A second ward sharing an area name with the first
+        load_municipality(write_ward(tmp_path, '目黒区', ['荏原 1丁目', '目黒本町 1-6丁目']))
+        db.session.commit()
+        invalidate_area_index()
+
+        assert lookup_area('目黒区荏原1丁目') == ('目黒区', '荏原 1丁目', [])
+        assert lookup_area('荏原1丁目', default_municipality='品川区') == ('品川区', '荏原 1丁目', [])
+        # Only one ward has it, so no ward needs to be named
+        assert lookup_area('目黒本町3丁目', default_municipality='品川区') == ('目黒区', '目黒本町 1-6丁目', [])
+        municipality, schedule_name, candidates = lookup_area('荏原1丁目')
+        assert (municipality, schedule_name) == (None, None)
+        assert sorted(candidates) == [('品川区', '荏原 1丁目'), ('目黒区', '荏原 1丁目')]
+
+def test_index_follows_reloaded_schedules(app, tmp_path, monkeypatch):
+    from app import area_index
+    from app.data import load_municipality
+
+    with app.app_context():
+        assert get_area_index('目黒区').lookup('目黒本町1丁目') == (None, [])
+
+        # Another process loads the ward: this one only sees a new dataset version
+        load_municipality(write_ward(tmp_path, '目黒区', ['目黒本町 1-6丁目']))
+        db.session.commit()
+        monkeypatch.setattr(area_index, '_checked_at', 0.0)
+
+        assert get_area_index('目黒区').lookup('目黒本町1丁目') == ('目黒本町 1-6丁目', [])
+
+def test_registration_to_an_area_removed_meanwhile_is_refused(app, line_stub):
+    from sqlalchemy import delete, event
+
+    from app.models import CollectionDay, User
+    from conftest import replies, webhook
+
+    with app.app_context():
+        assert lookup_area('荏原1丁目') == ('品川区', '荏原 1丁目', [])
+        # Another process removes the area; this one's index still has it
+        db.session.execute(delete(CollectionDay).where(CollectionDay.area_name == '荏原 1丁目'))
+        db.session.execute(delete(Schedule).where(Schedule.name == '荏原 1丁目'))
+        db.session.commit()
+        # SQLite only enforces the users -> schedules foreign key when asked to
+        db.session.remove()
+        db.engine.dispose()
+        event.listen(db.engine, 'connect', lambda connection, _: connection.execute('PRAGMA foreign_keys = ON'))
+
+    body, headers = webhook('U1', '登録 荏原1丁目')
+    app.test_client().post('/callback', data=body, headers=headers)
+
+    assert '現在登録できません' in replies(line_stub)[0]
+    with app.app_context():
+        assert db.session.query(User).filter(User.area_name.is_not(None)).count() == 0
+        assert lookup_area('荏原1丁目')[1] != '荏原 1丁目'
@@ -0,0 +1,76 @@
+from datetime import datetime
+from urllib.parse import quote
+
+from app.calendar_feed import feed_cache
+from app.collection_days import next_collection_dates, regenerate_collection_days
+from app.data import load_schedule_data
+from app.models import db, Schedule
+from app.rules import JST
+
+AREA = '東大井 1-4丁目'
+
+def feed_url(fmt, area_name=AREA, municipality='品川区'):
+    return f"/calendar/{quote(municipality)}/{quote(area_name)}.{fmt}"
+
+def test_json_feed_lists_the_calendar(app):
+    response = app.test_client().get(feed_url('json'))
+
+    assert response.status_code == 200
+    feed = response.get_json()
+    assert (feed['municipality'], feed['area']) == ('品川区', AREA)
+    today = datetime.now(JST).date()
+    with app.app_context():
+        burnable = [d.isoformat() for d in next_collection_dates('品川区', AREA, 'burnable', today, 3)]
+    assert [c['date'] for c in feed['collections'] if '燃やすごみ' in c['types']][:3] == burnable
+
+def test_ics_feed_is_folded(app):
+    response = app.test_client().get(feed_url('ics'))
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/calendar')
+    lines = response.get_data().split(b'\r\n')
+    assert lines[0] == b'BEGIN:VCALENDAR'
+    assert b'BEGIN:VEVENT' in lines
+    assert all(len(line) <= 75 for line in lines)
+
+def test_matching_etag_gets_304(app):
+    client = app.test_client()
+    first = client.get(feed_url('json'))
+    etag = first.headers['ETag']
+    assert first.headers['Cache-Control'] in ('public, max-age=3600', 'max-age=3600, public')
+
+    again = client.get(feed_url('json'), headers={'If-None-Match': etag})
+
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    assert feed_cache.stats()['hits'] == 1
+
+def test_reload_changes_the_etag(app):
+    client = app.test_client()
+    with app.app_context():
+        # Drift from the file, so the forced reload below changes the area back
+        db.session.query(Schedule).filter_by(name=AREA).one().burnable = '日'
+        regenerate_collection_days([AREA], municipality='品川区')
+        db.session.commit()
+    etag = client.get(feed_url('json')).headers['ETag']
+    with app.app_context():
+        load_schedule_data(force=True)
+
+    response = client.get(feed_url('json'), headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+def test_legacy_url_serves_shinagawa(app):
+    client = app.test_client()
+    legacy = client.get(f"/calendar/{quote(AREA)}.json")
+
+    assert legacy.status_code == 200
+    assert legacy.get_data() == client.get(feed_url('json')).get_data()
+
+def test_unknown_area_or_format_is_404(app):
+    client = app.test_client()
+
+    assert client.get(feed_url('json', '存在しない町')).status_code == 404
+    assert client.get(feed_url('json', municipality='目黒区')).status_code == 404
+    assert client.get(feed_url('xml')).status_code == 404
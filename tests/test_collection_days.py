@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+
+from app.collection_days import (
+    CALENDAR_HORIZON_DAYS,
+    collection_types_by_area,
+    extend_collection_days,
+    next_collection_dates,
+    regenerate_collection_days,
+)
+from app.bot import format_date
+from app.models import db, CollectionDay, Schedule, User
+from app.rules import GARBAGE_TYPES, JST
+
+from conftest import replies, webhook
+
+def calendar_dates(area_name, column):
+    return list(db.session.scalars(
+        select(CollectionDay.date)
+        .where(CollectionDay.area_name == area_name, CollectionDay.garbage_type == column)
+        .order_by(CollectionDay.date)
+    ))
+
+def covers(start):
+    """True if the calendar starts in the week from start and reaches the last week of its horizon."""
+    first, last = db.session.execute(select(func.min(CollectionDay.date), func.max(CollectionDay.date))).one()
+    end = start + timedelta(days=CALENDAR_HORIZON_DAYS)
+    return start <= first < start + timedelta(days=7) and end - timedelta(days=7) < last <= end
+
+def test_loaded_calendar_matches_the_rules(app):
+    today = datetime.now(JST).date()
+    days = [today + timedelta(days=i) for i in range(CALENDAR_HORIZON_DAYS + 1)]
+    with app.app_context():
+        for schedule in db.session.query(Schedule):
+            for column, _ in GARBAGE_TYPES:
+                rule = schedule.rule_for(column)
+                assert calendar_dates(schedule.name, column) == [day for day in days if rule.fires_on(day)]
+
+def test_collection_types_by_area(app):
+    day = datetime.now(JST).date() + timedelta(days=1)
+    labels = dict(GARBAGE_TYPES)
+    with app.app_context():
+        expected = {}
+        for schedule in db.session.query(Schedule):
+            types = [labels[column] for column, _ in GARBAGE_TYPES if schedule.rule_for(column).fires_on(day)]
+            if types:
+                expected[schedule.name] = types
+        assert {name: sorted(types) for name, types in collection_types_by_area(day, '品川区').items()} == \
+            {name: sorted(types) for name, types in expected.items()}
+
+def test_next_collection_dates_reads_the_calendar(app):
+    today = datetime.now(JST).date()
+    with app.app_context():
+        schedule = db.session.query(Schedule).first()
+        assert next_collection_dates(schedule.municipality, schedule.name, 'burnable', today, 3) == \
+            schedule.rule_for('burnable').next_dates(today, 3)
+
+def test_reply_lists_the_calendar_dates(app, line_stub):
+    area_name = '荏原 1丁目'
+    today = datetime.now(JST).date()
+    with app.app_context():
+        db.session.add(User(line_user_id='U1', municipality='品川区', area_name=area_name))
+        # A cancelled collection, e.g. over the new year, is dropped from the calendar only
+        skipped = calendar_dates(area_name, 'burnable')[0]
+        db.session.execute(delete(CollectionDay).where(
+            CollectionDay.area_name == area_name, CollectionDay.garbage_type == 'burnable', CollectionDay.date == skipped,
+        ))
+        db.session.commit()
+        expected = next_collection_dates('品川区', area_name, 'burnable', today, 3)
+
+    body, headers = webhook('U1', '燃やすごみ')
+    app.test_client().post('/callback', data=body, headers=headers)
+
+    assert replies(line_stub) == [
+        f"【燃やすごみ】\n収集日は「月・木」です。\n次回: {'、'.join(format_date(d) for d in expected)}"
+    ]
+    assert format_date(skipped) not in replies(line_stub)[0]
+
+def test_extend_rolls_the_horizon_forward(app):
+    today = datetime.now(JST).date()
+    later = today + timedelta(days=30)
+    with app.app_context():
+        assert covers(today)
+        assert extend_collection_days(later) > 0
+        assert covers(later)
+        # Already up to date: nothing to add
+        assert extend_collection_days(later) == 0
+
+def test_regenerate_follows_a_changed_rule(app):
+    today = datetime.now(JST).date()
+    with app.app_context():
+        schedule = db.session.query(Schedule).first()
+        schedule.burnable = '日'
+        regenerate_collection_days([schedule.name], municipality=schedule.municipality)
+        db.session.commit()
+        assert {day.weekday() for day in calendar_dates(schedule.name, 'burnable')} == {6}
+        assert calendar_dates(schedule.name, 'burnable')[0] < today + timedelta(days=7)
+
+def test_startup_fills_an_empty_calendar(app):
+    from app import create_app
+    from app.models import SchemaVersion
+
+    # An existing database without calendar rows, e.g. one created before collection_days.
+    # Its schema changed with the upgrade, so it has no schema version recorded yet.
+    with app.app_context():
+        db.session.execute(delete(CollectionDay))
+        db.session.execute(delete(SchemaVersion))
+        db.session.commit()
+
+    restarted = create_app()
+    with restarted.app_context():
+        assert covers(datetime.now(JST).date())
+        db.session.remove()
+        db.engine.dispose()
@@ -0,0 +1,52 @@
+import json
+
+from sqlalchemy import select
+
+from app.data import load_municipality, load_schedule_data
+from app.models import db, CollectionDay, Schedule, User
+
+def test_unchanged_file_is_skipped(app):
+    with app.app_context():
+        assert load_schedule_data() == {}
+
+def test_forced_load_applies_only_the_differences(app):
+    with app.app_context():
+        schedules = db.session.query(Schedule).order_by(Schedule.id).all()
+        total = len(schedules)
+        changed_name, deleted_name = schedules[0].name, schedules[1].name
+        schedules[0].burnable = '日'
+        db.session.delete(schedules[1])
+        db.session.add(Schedule(municipality='品川区', name='廃止 1丁目', resources='水', burnable='月・木', ceramic_glass_metal='第1・3土'))
+        db.session.add(User(line_user_id='U1', municipality='品川区', area_name='廃止 1丁目'))
+        db.session.commit()
+
+        counts = load_schedule_data(force=True)
+
+        assert counts == {'品川区': {'skipped': False, 'added': 1, 'changed': 1, 'unchanged': total - 2, 'removed': 1}}
+        assert db.session.query(Schedule).count() == total
+        assert db.session.get(User, 1).area_name is None
+        restored = db.session.query(Schedule).filter_by(name=changed_name).one()
+        assert restored.burnable != '日'
+        calendar_dates = db.session.scalars(
+            select(CollectionDay.date)
+            .where(CollectionDay.area_name == changed_name, CollectionDay.garbage_type == 'burnable')
+        ).all()
+        assert calendar_dates and all(restored.rule_for('burnable').fires_on(day) for day in calendar_dates)
+        assert db.session.query(CollectionDay).filter_by(area_name=deleted_name).count() > 0
+
+def test_a_ward_is_loaded_on_its_own(app, tmp_path):
+    path = tmp_path / 'meguro.json'
+    areas = [{'name': '荏原 1丁目', 'resources': '水', 'burnable': '月・木', 'ceramic_glass_metal': '第1・3土'}]
+    path.write_text(json.dumps({'municipality': '目黒区', 'areas': areas}, ensure_ascii=False), encoding='utf-8')
+
+    with app.app_context():
+        shinagawa = db.session.query(Schedule).filter_by(municipality='品川区').count()
+        municipality, counts = load_municipality(str(path))
+        db.session.commit()
+
+        assert (municipality, counts['added'], counts['removed']) == ('目黒区', 1, 0)
+        # The same area name in another ward is a separate schedule with its own calendar
+        assert db.session.query(Schedule).filter_by(name='荏原 1丁目').count() == 2
+        assert db.session.query(Schedule).filter_by(municipality='品川区').count() == shinagawa
+        assert db.session.query(CollectionDay).filter_by(municipality='目黒区').count() > 0
+        assert load_municipality(str(path)) == (None, {'skipped': True})
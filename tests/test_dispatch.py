@@ -0,0 +1,186 @@
+from datetime import datetime, timedelta
+
+from linebot.v3.messaging import ApiException
+
+from app.dispatch import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ErrorSampler,
+    NotificationDispatcher,
+    is_retryable,
+    retry_delay,
+)
+from app.models import db, Schedule, User
+from app.rules import get_rule
+from app.scheduler import JST, daily_notification_job
+
+from conftest import sent_to
+
+MULTICAST = '/v2/bot/message/multicast'
+PUSH = '/v2/bot/message/push'
+
+def make_dispatcher(app, **kwargs):
+    # A breaker of its own that a test's injected failures do not open unless it asks to
+    kwargs.setdefault('breaker', CircuitBreaker(threshold=100))
+    return NotificationDispatcher(app, sleep=lambda seconds: None, **kwargs)
+
+def test_multicast_groups_by_message(app, line_stub):
+    dispatcher = make_dispatcher(app, chunk_size=2)
+    for i in range(5):
+        dispatcher.add(f'U{i}', 'a' if i % 2 else 'b')
+    stats = dispatcher.flush()
+
+    assert stats['sent'] == 5
+    assert stats['chunks_ok'] == 3 # b: 2 + 1, a: 2
+    assert sorted(sent_to(line_stub, MULTICAST)) == [f'U{i}' for i in range(5)]
+    assert sent_to(line_stub, PUSH) == []
+    delivered, failures = dispatcher.take_results()
+    assert sorted(delivered) == [f'U{i}' for i in range(5)]
+    assert failures == []
+
+def test_rejected_multicast_falls_back_to_push(app, line_stub):
+    line_stub.fail_multicast = True
+    line_stub.failure_status = 400
+    dispatcher = make_dispatcher(app, max_retries=2)
+    for i in range(3):
+        dispatcher.add(f'U{i}', 'reminder')
+    stats = dispatcher.flush()
+
+    assert len(sent_to(line_stub, MULTICAST)) == 3 # One request; 4xxs are not retried
+    assert stats['retries'] == 0
+    assert stats['chunks_failed'] == 1
+    assert stats['fallback_sent'] == 3
+    assert stats['sent'] == 3
+    assert sorted(sent_to(line_stub, PUSH)) == ['U0', 'U1', 'U2']
+
+def test_retryable_multicast_failure_is_left_for_retry(app, line_stub):
+    line_stub.fail_multicast = True
+    dispatcher = make_dispatcher(app, max_retries=2)
+    for i in range(3):
+        dispatcher.add(f'U{i}', 'reminder')
+    stats = dispatcher.flush()
+
+    assert len(sent_to(line_stub, MULTICAST)) == 9 # The first try and two retries
+    assert stats['retries'] == 2
+    assert (stats['chunks_failed'], stats['failed'], stats['sent']) == (1, 3, 0)
+    assert sent_to(line_stub, PUSH) == []
+    delivered, failures = dispatcher.take_results()
+    assert delivered == []
+    assert sorted(failures) == [(f'U{i}', 'HTTP 500 Internal Server Error', True) for i in range(3)]
+
+def test_push_mode_sends_one_request_per_user(app, line_stub):
+    dispatcher = make_dispatcher(app, mode='push')
+    for i in range(3):
+        dispatcher.add(f'U{i}', 'reminder')
+    stats = dispatcher.flush()
+
+    assert stats['sent'] == 3
+    assert sorted(sent_to(line_stub, PUSH)) == ['U0', 'U1', 'U2']
+    assert sent_to(line_stub, MULTICAST) == []
+
+def test_rate_limited_sends_are_retried(app, line_stub):
+    line_stub.rate_limit_every = 2
+    line_stub.retry_after = 0
+    dispatcher = make_dispatcher(app, mode='push')
+    for i in range(6):
+        dispatcher.add(f'U{i}', 'reminder')
+    stats = dispatcher.flush()
+
+    assert stats['sent'] == 6
+    assert stats['failed'] == 0
+    assert stats['retries'] == line_stub.counts['rate_limited'] > 0
+    assert line_stub.counts[PUSH] == 6 + stats['retries']
+
+def test_only_rate_limits_server_and_connection_errors_are_retried():
+    assert is_retryable(ApiException(status=429))
+    assert is_retryable(ApiException(status=503))
+    assert is_retryable(ConnectionError('reset'))
+    assert not is_retryable(ApiException(status=400))
+    # Never sent, so a later run tries again
+    assert is_retryable(CircuitOpenError('multicast'))
+
+def test_retry_delay_honours_retry_after(monkeypatch):
+    from app import dispatch
+
+    monkeypatch.setattr(dispatch, 'BACKOFF_BASE_SECONDS', 1.0)
+    rate_limited = ApiException(status=429)
+    rate_limited.headers = {'Retry-After': '7'}
+
+    assert retry_delay(rate_limited, 0) == 7.0
+    assert retry_delay(ApiException(status=500), 3) == 8.0
+    assert retry_delay(ApiException(status=500), 10) == dispatch.MAX_BACKOFF_SECONDS
+
+def test_error_sampler_is_shared_between_dispatchers(app, line_stub, caplog):
+    line_stub.fail_multicast = True
+    sampler = ErrorSampler(size=2)
+    for _ in range(3):
+        dispatcher = make_dispatcher(app, max_retries=0, sampler=sampler)
+        dispatcher.add('U0', 'reminder')
+        dispatcher.flush()
+
+    assert sampler.counts['multicast', 'HTTP 500 Internal Server Error'] == 3
+    logged = [r for r in caplog.records if 'left for retry' in r.getMessage()]
+    assert len(logged) == 2
+
+def test_rate_limits_never_open_the_circuit(app, line_stub):
+    line_stub.rate_limit_every = 1
+    line_stub.retry_after = 0
+    breaker = CircuitBreaker(threshold=1)
+    dispatcher = make_dispatcher(app, mode='push', max_retries=2, breaker=breaker)
+    dispatcher.add('U0', 'reminder')
+    dispatcher.flush()
+
+    assert line_stub.counts[PUSH] == 3
+    assert breaker.allow('push_message')
+    delivered, failures = dispatcher.take_results()
+    assert delivered == []
+    assert failures == [('U0', 'HTTP 429 Too Many Requests', True)]
+
+def test_outage_opens_the_circuit(app, line_stub):
+    line_stub.fail_multicast = True
+    line_stub.fail_push = True
+    breaker = CircuitBreaker(threshold=3, cooldown=60)
+    dispatcher = make_dispatcher(app, mode='push', breaker=breaker)
+    for i in range(20):
+        dispatcher.add(f'U{i}', 'reminder')
+    stats = dispatcher.flush()
+
+    assert not breaker.allow('push_message')
+    assert line_stub.counts[PUSH] < 20
+    assert stats['failed'] == 20
+    _, failures = dispatcher.take_results()
+    # Every failure stays retryable, so the outbox keeps the rows pending
+    assert all(retryable for _, _, retryable in failures)
+
+def test_circuit_breaker_closes_after_cooldown():
+    now = [0.0]
+    breaker = CircuitBreaker(threshold=2, cooldown=30, clock=lambda: now[0])
+
+    assert not breaker.record_failure('push_message')
+    assert breaker.record_failure('push_message')
+    assert not breaker.allow('push_message')
+    assert breaker.allow('multicast')
+
+    now[0] = 31.0
+    assert breaker.allow('push_message')
+    breaker.record_success('push_message')
+    assert not breaker.record_failure('push_message')
+    assert breaker.allow('push_message')
+
+def test_job_notifies_the_areas_collected_tomorrow(app, line_stub):
+    tomorrow = datetime.now(JST).date() + timedelta(days=1)
+    with app.app_context():
+        schedules = db.session.query(Schedule).order_by(Schedule.id).all()
+        db.session.add_all([
+            User(line_user_id=f'U{i}', municipality=schedule.municipality, area_name=schedule.name) for i, schedule in enumerate(schedules)
+        ])
+        db.session.commit()
+        expected = sorted(
+            f'U{i}' for i, schedule in enumerate(schedules)
+            if any(get_rule(getattr(schedule, column)).fires_on(tomorrow)
+                   for column in ('resources', 'burnable', 'ceramic_glass_metal'))
+        )
+
+    daily_notification_job(app)
+
+    assert sorted(sent_to(line_stub, MULTICAST)) == expected
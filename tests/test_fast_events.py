@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from app import bot
+from app.fast_events import decode_events, valid_signature
+from conftest import replies, webhook, webhook_headers
+
+def payload(*events):
+    return json.dumps({'destination': 'Ubot', 'events': list(events)}, ensure_ascii=False)
+
+TEXT = {'type': 'message', 'replyToken': 'r1', 'source': {'type': 'user', 'userId': 'U1'},
+        'message': {'type': 'text', 'id': '1', 'text': '資源'}}
+FOLLOW = {'type': 'follow', 'replyToken': 'r2', 'source': {'type': 'user', 'userId': 'U2'}}
+STICKER = {'type': 'message', 'replyToken': 'r3', 'source': {'type': 'user', 'userId': 'U3'},
+           'message': {'type': 'sticker', 'id': '3', 'packageId': '1', 'stickerId': '1'}}
+UNFOLLOW = {'type': 'unfollow', 'source': {'type': 'user', 'userId': 'U4'}}
+
+def test_decodes_text_messages_and_follows():
+    text, follow = decode_events(payload(TEXT, FOLLOW))
+
+    assert (text.type, text.user_id, text.reply_token, text.text) == ('message', 'U1', 'r1', '資源')
+    assert (follow.type, follow.user_id, follow.reply_token, follow.text) == ('follow', 'U2', 'r2', None)
+
+@pytest.mark.parametrize('body', [
+    payload(TEXT, STICKER),
+    payload(UNFOLLOW),
+    '{"events": "none"}',
+    'not json',
+])
+def test_other_payloads_are_left_to_the_sdk(body):
+    assert decode_events(body) is None
+
+def test_valid_signature():
+    body, headers = webhook('U1', 'PDF')
+
+    assert valid_signature(body, headers['X-Line-Signature'])
+    assert not valid_signature(body + ' ', headers['X-Line-Signature'])
+    assert not valid_signature(body, None)
+
+@pytest.fixture
+def sdk_calls(monkeypatch):
+    """Records payloads handed to the SDK handler, which still processes them."""
+    calls = []
+    real_handler = bot.handler
+
+    class RecordingHandler:
+        def handle(self, body, signature):
+            calls.append(body)
+            real_handler.handle(body, signature)
+
+    monkeypatch.setattr(bot, 'handler', RecordingHandler())
+    return calls
+
+def test_fast_path_replies_without_the_sdk(app, line_stub, sdk_calls):
+    body, headers = webhook('U1', '登録 東大井２丁目', 'PDF')
+
+    assert app.test_client().post('/callback', data=body, headers=headers).status_code == 200
+    assert sdk_calls == []
+    assert len(replies(line_stub)) == 2
+
+@pytest.mark.parametrize('fast_path', ['1', '0'])
+def test_both_paths_answer_the_same(app, line_stub, sdk_calls, monkeypatch, fast_path):
+    monkeypatch.setenv('WEBHOOK_FAST_PATH', fast_path)
+    body, headers = webhook('U1', 'メニュー', 'ゴミのルール', 'PDF')
+
+    app.test_client().post('/callback', data=body, headers=headers)
+
+    assert len(sdk_calls) == (fast_path == '0')
+    answers = replies(line_stub)
+    assert answers[0] == 'どのごみの日を確認しますか？'
+    assert answers[1].startswith('【主なゴミのルール】')
+    assert 'sigengomi2024.pdf' in answers[2]
+
+def test_mixed_payload_goes_to_the_sdk(app, line_stub, sdk_calls):
+    body, headers = webhook('U1', 'PDF')
+    events = json.loads(body)['events'] + [dict(UNFOLLOW, timestamp=1, mode='active', webhookEventId='E',
+                                                 deliveryContext={'isRedelivery': False})]
+    body = payload(*events)
+    headers = webhook_headers(body)
+
+    assert app.test_client().post('/callback', data=body, headers=headers).status_code == 200
+    assert sdk_calls == [body]
+    assert len(replies(line_stub)) == 1
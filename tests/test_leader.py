@@ -0,0 +1,68 @@
+from datetime import timedelta
+
+from sqlalchemy import update
+
+from app import scheduler
+from app.leader import LeaderElector, _utcnow, leader_status
+from app.models import db, SchedulerLease
+
+def elector(app, identity):
+    with app.app_context():
+        candidate = LeaderElector(db.engine, app.logger)
+    candidate.identity = identity
+    return candidate
+
+def expire_lease(app):
+    with app.app_context():
+        db.session.execute(update(SchedulerLease).values(expires_at=_utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+
+def test_only_one_process_leads(app):
+    first, second = elector(app, 'host:1'), elector(app, 'host:2')
+
+    assert first.heartbeat()
+    assert not second.heartbeat()
+    assert first.heartbeat() # Renewing its own lease
+    with app.app_context():
+        status = leader_status(second)
+    assert status['leader'] == 'host:1'
+    assert not status['expired']
+    assert (status['this_process'], status['is_leader']) == ('host:2', False)
+
+def test_follower_takes_over_an_expired_lease(app):
+    first, second = elector(app, 'host:1'), elector(app, 'host:2')
+    first.heartbeat()
+    expire_lease(app)
+
+    assert second.heartbeat()
+    assert not first.heartbeat()
+    with app.app_context():
+        assert leader_status()['leader'] == 'host:2'
+
+def test_stop_hands_over_straight_away(app):
+    first, second = elector(app, 'host:1'), elector(app, 'host:2')
+    first.heartbeat()
+
+    first.stop()
+
+    assert not first.is_leader
+    assert second.heartbeat()
+
+def test_only_the_leader_runs_the_job(app, monkeypatch):
+    runs = []
+    monkeypatch.setattr(scheduler, 'notification_bucket_job', lambda app: runs.append(app))
+    first, second = elector(app, 'host:1'), elector(app, 'host:2')
+    first.heartbeat()
+
+    scheduler.leader_bucket_job(app, second)
+    assert runs == []
+    scheduler.leader_bucket_job(app, first)
+    assert runs == [app]
+
+def test_stats_report_the_leader(app, monkeypatch):
+    monkeypatch.setenv('CRON_SECRET_KEY', 'cron-secret')
+    elector(app, 'host:1').heartbeat()
+
+    response = app.test_client().get('/stats/cron-secret')
+
+    assert response.get_json()['scheduler']['leader'] == 'host:1'
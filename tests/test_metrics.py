@@ -0,0 +1,33 @@
+from app.dispatch import LOG_SAMPLE_SIZE, CircuitBreaker, NotificationDispatcher
+
+def test_metrics_endpoint_reports_dispatches(app, line_stub, monkeypatch):
+    monkeypatch.setenv('CRON_SECRET_KEY', 'cron-secret')
+    dispatcher = NotificationDispatcher(app, sleep=lambda seconds: None)
+    dispatcher.add('U0', 'reminder')
+    dispatcher.flush()
+
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics/wrong').status_code == 403
+    response = client.get('/metrics/cron-secret')
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    body = response.get_data(as_text=True)
+    assert 'gomibot_notifications_total{result="sent"}' in body
+    assert 'gomibot_line_api_calls_total{endpoint="multicast",outcome="ok"}' in body
+
+def test_repeated_errors_are_logged_once_per_sample(app, line_stub, caplog):
+    line_stub.fail_multicast = True
+    # A breaker that stays closed, so every failure is the same HTTP 500
+    breaker = CircuitBreaker(threshold=LOG_SAMPLE_SIZE + 4)
+    dispatcher = NotificationDispatcher(app, max_retries=0, chunk_size=1, breaker=breaker, sleep=lambda seconds: None)
+    for i in range(LOG_SAMPLE_SIZE + 3):
+        dispatcher.add(f'U{i}', 'reminder')
+    dispatcher.flush()
+    dispatcher.log_summary()
+
+    assert dispatcher.stats['chunks_failed'] == LOG_SAMPLE_SIZE + 3
+    logged = [r for r in caplog.records if 'left for retry' in r.getMessage()]
+    assert len(logged) == LOG_SAMPLE_SIZE
+    assert any(f"x{LOG_SAMPLE_SIZE + 3}" in r.getMessage() for r in caplog.records)
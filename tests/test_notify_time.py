@@ -0,0 +1,84 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import bot
+from app.models import db, User, DEFAULT_NOTIFY_MINUTE
+from app.rules import JST
+from app.scheduler import format_notify_time, notification_bucket_job, parse_notify_time
+from app.shards import bucket_of, due_buckets
+
+from conftest import replies, sent_to, webhook
+
+@pytest.mark.parametrize('text, minute', [
+    ('19:00', 19 * 60),
+    (' 7:30', 7 * 60 + 30),
+    ('19時30分', 19 * 60 + 30),
+    ('19時', 19 * 60),
+    ('１９：４５', 19 * 60 + 45),
+    ('19:07', 19 * 60), # Rounded down to its bucket
+    ('6', 6 * 60),
+])
+def test_parse_notify_time(text, minute):
+    assert parse_notify_time(text) == minute
+
+@pytest.mark.parametrize('text', ['', '夜', '24:00', '19:60', '19:00:00', '-1'])
+def test_parse_notify_time_rejects_non_times(text):
+    assert parse_notify_time(text) is None
+
+def test_format_notify_time():
+    assert format_notify_time(7 * 60 + 5) == '7:05'
+    assert format_notify_time(None) == format_notify_time(DEFAULT_NOTIFY_MINUTE) == '20:00'
+
+def test_bucket_of():
+    assert [bucket_of(m) for m in (0, 14, 15, 29, 1199, 1200)] == [0, 0, 15, 15, 1185, 1200]
+
+def test_due_buckets(app, add_users):
+    add_users(2, notify_minute=7 * 60)
+    with app.app_context():
+        db.session.add(User(line_user_id='Ulate', municipality='品川区', area_name='荏原 1丁目', notify_minute=21 * 60 + 30))
+        db.session.commit()
+
+        assert due_buckets() == [7 * 60, 21 * 60 + 30]
+        assert due_buckets(21 * 60 + 30) == [7 * 60]
+        assert due_buckets(7 * 60) == []
+
+def test_bucket_job_sends_only_to_due_buckets(app, add_users, collection_date, line_stub):
+    morning = add_users(4, notify_minute=7 * 60)
+    with app.app_context():
+        db.session.query(User).filter(User.line_user_id.in_(morning[2:])).update({'notify_minute': 21 * 60})
+        db.session.commit()
+    evening_of = datetime.combine(collection_date - timedelta(days=1), datetime.min.time(), JST)
+
+    notification_bucket_job(app, now=evening_of.replace(hour=7, minute=5))
+    assert sorted(sent_to(line_stub, '/v2/bot/message/multicast')) == morning[:2]
+
+    # A missed 20:00 run is caught up on by the next one; nobody is sent twice
+    notification_bucket_job(app, now=evening_of.replace(hour=21, minute=14))
+    assert sorted(sent_to(line_stub, '/v2/bot/message/multicast')) == morning
+
+def test_notify_command_changes_the_time(app, add_users, line_stub):
+    user_id = add_users(1)[0]
+    client = app.test_client()
+
+    body, headers = webhook(user_id, '通知 6時40分', '通知', '通知 夜')
+    assert client.post('/callback', data=body, headers=headers).status_code == 200
+
+    changed, current, again = replies(line_stub)
+    assert '6:30に変更しました' in changed
+    assert '現在の通知時刻は6:30です' in current
+    assert '現在の通知時刻は6:30です' in again
+    with app.app_context():
+        assert db.session.query(User).filter_by(line_user_id=user_id).one().notify_minute == 6 * 60 + 30
+
+def test_trigger_runs_the_bucket_job(app, monkeypatch):
+    runs, done = [], threading.Event()
+    monkeypatch.setenv('CRON_SECRET_KEY', 'cron-secret')
+    monkeypatch.setattr(bot, 'notification_bucket_job', lambda app: (runs.append(app), done.set()))
+    client = app.test_client()
+
+    assert client.post('/trigger/wrong').status_code == 403
+    assert client.post('/trigger/cron-secret').status_code == 200
+    assert done.wait(5)
+    assert runs == [app]
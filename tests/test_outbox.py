@@ -0,0 +1,93 @@
+from sqlalchemy import func, select, update
+
+from app.models import NotificationOutbox
+from app.outbox import drain_outbox, enqueue_notifications
+from app.scheduler import daily_notification_job
+
+from conftest import sent_to
+
+MULTICAST = '/v2/bot/message/multicast'
+
+def outbox_counts(app):
+    from app import db
+
+    with app.app_context():
+        return dict(db.session.execute(
+            select(NotificationOutbox.status, func.count()).group_by(NotificationOutbox.status)
+        ).all())
+
+def test_enqueue_ignores_rows_already_queued(app, line_stub, collection_date):
+    with app.app_context():
+        assert enqueue_notifications(collection_date, [('U1', 'a'), ('U2', 'a')]) == 2
+        drain_outbox(app, collection_date, None)
+        enqueue_notifications(collection_date, [('U1', 'changed'), ('U3', 'a')])
+
+    assert outbox_counts(app) == {'sent': 2, 'pending': 1}
+
+def test_rerunning_a_date_sends_nothing_twice(app, line_stub, add_users, collection_date):
+    user_ids = add_users(1200)
+
+    daily_notification_job(app, collection_date)
+    assert sorted(sent_to(line_stub, MULTICAST)) == user_ids
+    assert outbox_counts(app) == {'sent': 1200}
+
+    daily_notification_job(app, collection_date)
+    assert len(sent_to(line_stub, MULTICAST)) == 1200
+    assert outbox_counts(app) == {'sent': 1200}
+
+def test_rerun_sends_what_an_outage_left_pending(app, line_stub, add_users, collection_date, monkeypatch):
+    from app import dispatch
+
+    add_users(40)
+    line_stub.fail_multicast = True
+    line_stub.fail_push = True
+
+    daily_notification_job(app, collection_date)
+    assert outbox_counts(app) == {'pending': 40}
+
+    # LINE is back and the circuit's cooldown is over
+    monkeypatch.setattr(dispatch, 'circuit_breaker', dispatch.CircuitBreaker())
+    line_stub.fail_multicast = False
+    line_stub.fail_push = False
+    line_stub.requests.clear()
+
+    daily_notification_job(app, collection_date)
+    assert outbox_counts(app) == {'sent': 40}
+    assert len(sent_to(line_stub, MULTICAST)) == 40
+    assert len([path for path, _ in line_stub.requests if path == MULTICAST]) == 4 # One multicast per area
+
+def test_failures_are_recorded_by_outcome(app, collection_date):
+    from app import db
+    from app.outbox import MAX_ATTEMPTS, _mark_failed
+
+    with app.app_context():
+        enqueue_notifications(collection_date, [(f'U{i}', 'a') for i in range(4)])
+        db.session.execute(
+            update(NotificationOutbox).where(NotificationOutbox.line_user_id == 'U2').values(attempts=MAX_ATTEMPTS - 1)
+        )
+        _mark_failed(collection_date, [
+            ('U0', 'HTTP 500 Internal Server Error', True),
+            ('U1', 'HTTP 400 Bad Request', False),
+            ('U2', 'HTTP 500 Internal Server Error', True),
+        ])
+        db.session.commit()
+        rows = {
+            row.line_user_id: (row.status, row.attempts, row.last_error)
+            for row in db.session.scalars(select(NotificationOutbox))
+        }
+
+    assert rows == {
+        'U0': ('pending', 1, 'HTTP 500 Internal Server Error'),
+        'U1': ('failed', 1, 'HTTP 400 Bad Request'),
+        'U2': ('failed', MAX_ATTEMPTS, 'HTTP 500 Internal Server Error'),
+        'U3': ('pending', 0, None),
+    }
+
+def test_server_errors_leave_rows_pending(app, line_stub, add_users, collection_date):
+    add_users(8)
+    line_stub.fail_multicast = True
+
+    daily_notification_job(app, collection_date)
+
+    assert outbox_counts(app) == {'pending': 8}
+    assert sent_to(line_stub, '/v2/bot/message/push') == []
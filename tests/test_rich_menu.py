@@ -0,0 +1,88 @@
+import pytest
+
+from app import rich_menu
+from app.models import db, RichMenu, User
+from app.rich_menu import deploy_rich_menus
+
+@pytest.fixture
+def fake_render(monkeypatch):
+    """Renders each caption as its own text, so menus differ per area without a Japanese font."""
+    monkeypatch.setattr(
+        rich_menu, 'render_menu_image',
+        lambda caption_lines, font_path: ('\n'.join(caption_lines).encode('utf-8'), 'image/png'),
+    )
+
+def deploy(app, **kwargs):
+    with app.app_context():
+        return deploy_rich_menus('font.ttf', **kwargs)
+
+def area_of(app, user_id):
+    with app.app_context():
+        user = db.session.query(User).filter_by(line_user_id=user_id).one()
+        return user.municipality, user.area_name
+
+def test_each_area_gets_its_menu(app, add_users, line_stub, fake_render):
+    user_ids = add_users(8, areas=4)
+
+    summary = deploy(app)
+
+    assert summary == {'menus': 5, 'areas': 4, 'created': 5, 'reused': 0, 'linked': 8, 'failed': 0, 'deleted': 0}
+    assert len(line_stub.rich_menus) == 5
+    assert line_stub.rich_menu_images.keys() == line_stub.rich_menus.keys()
+    assert line_stub.default_rich_menu in line_stub.rich_menus
+    assert set(line_stub.user_rich_menus) == set(user_ids)
+    # Users of the same area share a menu, and no user is linked to the default
+    menus_by_area = {}
+    for user_id, menu_id in line_stub.user_rich_menus.items():
+        menus_by_area.setdefault(area_of(app, user_id), set()).add(menu_id)
+    assert all(len(menu_ids) == 1 for menu_ids in menus_by_area.values())
+    assert len(set.union(*menus_by_area.values())) == 4
+    assert line_stub.default_rich_menu not in line_stub.user_rich_menus.values()
+
+def test_rerun_reuses_menus_and_links(app, add_users, line_stub, fake_render):
+    add_users(8, areas=4)
+    deploy(app)
+    line_stub.counts.clear()
+
+    summary = deploy(app)
+
+    assert (summary['created'], summary['reused'], summary['linked']) == (0, 5, 0)
+    assert line_stub.counts['/v2/bot/richmenu'] == 0
+    assert line_stub.counts['/v2/bot/richmenu/bulk/link'] == 0
+
+def test_moved_user_is_relinked_and_unused_menus_deleted(app, add_users, line_stub, fake_render):
+    user_ids = add_users(4, areas=4)
+    deploy(app)
+    moved, target = user_ids[0], user_ids[1]
+    with app.app_context():
+        db.session.query(User).filter_by(line_user_id=moved).update({'area_name': area_of(app, target)[1]})
+        db.session.commit()
+
+    summary = deploy(app)
+
+    assert (summary['created'], summary['linked'], summary['deleted']) == (0, 1, 1)
+    assert line_stub.user_rich_menus[moved] == line_stub.user_rich_menus[target]
+    assert len(line_stub.rich_menus) == 4
+    with app.app_context():
+        assert db.session.query(RichMenu).count() == 4
+
+def test_without_a_font_everyone_gets_the_default(app, add_users, line_stub, fake_render):
+    add_users(4, areas=2)
+    deploy(app)
+
+    with app.app_context():
+        summary = deploy_rich_menus(None)
+
+    assert summary['menus'] == 1
+    assert summary['linked'] == 4 # Unlinked back to the default
+    assert line_stub.user_rich_menus == {}
+    with app.app_context():
+        assert db.session.query(User).filter(User.rich_menu_id.is_not(None)).count() == 0
+
+def test_dry_run_calls_nothing(app, add_users, line_stub, fake_render):
+    add_users(4, areas=2)
+
+    summary = deploy(app, dry_run=True)
+
+    assert (summary['menus'], summary['created'], summary['reused']) == (3, 3, 0)
+    assert sum(line_stub.counts.values()) == 0
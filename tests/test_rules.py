@@ -0,0 +1,79 @@
+import json
+import os
+from datetime import date, timedelta
+
+import pytest
+
+from app.rules import NEVER, RuleParseError, compile_rule, get_rule
+
+SCHEDULE_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'schedules', 'shinagawa.json')
+
+# --- Baseline matcher ---
+# check_schedule as it was before rules were compiled, kept as the reference
+# the compiled rules must agree with.
+DAY_MAP = {0: '月', 1: '火', 2: '水', 3: '木', 4: '金', 5: '土', 6: '日'}
+
+def get_nth_weekday_of_month(date_obj):
+    return (date_obj.day - 1) // 7 + 1
+
+def check_schedule(schedule_str, tomorrow):
+    if not schedule_str:
+        return False
+
+    tomorrow_weekday_jp = DAY_MAP[tomorrow.weekday()]
+
+    if '第' not in schedule_str:
+        return tomorrow_weekday_jp in schedule_str
+
+    try:
+        parts = schedule_str.replace('第', '').split('・')
+        target_day = parts[-1][-1]
+
+        if tomorrow_weekday_jp != target_day:
+            return False
+
+        target_weeks_str = [p.replace(target_day, '') for p in parts]
+        target_weeks = [int(w) for w in target_weeks_str]
+        nth_week = get_nth_weekday_of_month(tomorrow)
+
+        return nth_week in target_weeks
+    except (ValueError, IndexError):
+        return False
+
+def schedule_strings():
+    with open(SCHEDULE_FILE, encoding='utf-8') as f:
+        areas = json.load(f)['areas']
+    strings = {area[column] for area in areas for column in ('resources', 'burnable', 'ceramic_glass_metal')}
+    return sorted(strings | {'', '日', '月・水・金', '第5土', '第1・2・3・4・5月'})
+
+def days(start, count):
+    return [start + timedelta(days=i) for i in range(count)]
+
+# --- Tests ---
+
+@pytest.mark.parametrize('schedule_str', schedule_strings())
+def test_compiled_rule_matches_baseline(schedule_str):
+    rule = compile_rule(schedule_str)
+    for day in days(date(2024, 1, 1), 2 * 366):
+        assert rule.fires_on(day) == check_schedule(schedule_str, day), (schedule_str, day)
+
+@pytest.mark.parametrize('schedule_str', schedule_strings())
+def test_next_dates_lists_the_days_the_rule_fires(schedule_str):
+    rule = compile_rule(schedule_str)
+    start = date(2024, 2, 27) # Crosses a leap day and a month end
+    expected = [day for day in days(start, 120) if rule.fires_on(day)][:6]
+    assert rule.next_dates(start, len(expected)) == expected
+
+def test_next_dates_includes_start():
+    assert compile_rule('月・木').next_dates(date(2024, 1, 4), 2) == [date(2024, 1, 4), date(2024, 1, 8)]
+
+def test_next_dates_of_never_is_empty():
+    assert NEVER.next_dates(date(2024, 1, 1), 3) == []
+
+def test_fullwidth_and_spaced_strings_compile():
+    assert compile_rule('第１・３ 土') == compile_rule('第1・3土')._replace(source='第１・３ 土')
+
+def test_unparseable_string():
+    with pytest.raises(RuleParseError):
+        compile_rule('隔週月')
+    assert get_rule('隔週月') is NEVER
@@ -0,0 +1,115 @@
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import func, select, update
+
+from app.models import DispatchShard, NotificationOutbox, User
+from app.scheduler import daily_notification_job
+from app.shards import (
+    SHARD_LEASE_SECONDS,
+    claim_shard,
+    finish_shard,
+    plan_shards,
+    reopen_finished_shards,
+    shard_of,
+)
+
+RUN_DATE = date(2030, 1, 7)
+
+def test_shard_of_is_stable_and_in_range():
+    shards = [shard_of('品川区', f'荏原 {i}丁目', 16) for i in range(1, 8)]
+    assert shards == [shard_of('品川区', f'荏原 {i}丁目', 16) for i in range(1, 8)]
+    assert all(0 <= shard < 16 for shard in shards)
+    assert shard_of('品川区', '荏原 1丁目', 1) == 0
+
+def test_plan_shards_once(app, add_users):
+    add_users(10, notify_minute=19 * 60)
+    with app.app_context():
+        assert plan_shards(RUN_DATE, 19 * 60, 4)
+        assert not plan_shards(RUN_DATE, 19 * 60, 8)
+        shards = [(shard.shard, shard.shard_count, shard.status)
+                  for shard in DispatchShard.query.order_by(DispatchShard.shard)]
+    assert shards == [(i, 4, 'pending') for i in range(4)]
+
+def test_empty_bucket_gets_one_shard(app):
+    with app.app_context():
+        assert plan_shards(RUN_DATE, 19 * 60, 4)
+        assert DispatchShard.query.count() == 1
+
+def test_claims_are_exclusive(app, add_users):
+    add_users(10, notify_minute=0)
+    with app.app_context():
+        plan_shards(RUN_DATE, 0, 3)
+        claimed = [claim_shard(RUN_DATE, f'worker-{i}') for i in range(4)]
+
+        assert [shard.shard for shard in claimed[:3]] == [0, 1, 2]
+        assert [shard.claimed_by for shard in claimed[:3]] == ['worker-0', 'worker-1', 'worker-2']
+        assert claimed[3] is None
+
+def test_abandoned_shard_is_claimed_after_its_lease(app, add_users):
+    add_users(10, notify_minute=0)
+    from app import db
+
+    with app.app_context():
+        plan_shards(RUN_DATE, 0, 1)
+        shard = claim_shard(RUN_DATE, 'crashed')
+        assert claim_shard(RUN_DATE, 'other') is None
+
+        db.session.execute(
+            update(DispatchShard)
+            .where(DispatchShard.id == shard.id)
+            .values(claimed_at=shard.claimed_at - timedelta(seconds=SHARD_LEASE_SECONDS + 1))
+        )
+        db.session.commit()
+
+        reclaimed = claim_shard(RUN_DATE, 'other')
+        assert reclaimed.id == shard.id
+        assert reclaimed.claimed_by == 'other'
+
+def test_done_shard_with_pending_rows_is_reopened(app, add_users):
+    add_users(10, notify_minute=0)
+    from app.outbox import enqueue_notifications
+
+    with app.app_context():
+        plan_shards(RUN_DATE, 0, 2)
+        first = claim_shard(RUN_DATE, 'worker')
+        second = claim_shard(RUN_DATE, 'worker')
+        enqueue_notifications(RUN_DATE, [('U1', 'reminder')], shard=first.shard, bucket=0)
+        finish_shard(first, 0, 1)
+        finish_shard(second, 0, 0)
+
+        assert reopen_finished_shards(RUN_DATE) == 1
+        assert claim_shard(RUN_DATE, 'worker').shard == first.shard
+
+@pytest.mark.parametrize('shards', [1, 4, 16])
+def test_each_area_is_sent_by_one_shard(app, line_stub, add_users, collection_date, monkeypatch, shards):
+    from app import db
+
+    monkeypatch.setenv('DISPATCH_SHARDS', str(shards))
+    add_users(1200)
+
+    daily_notification_job(app, collection_date)
+
+    with app.app_context():
+        area_shards = db.session.scalars(
+            select(func.count(func.distinct(NotificationOutbox.shard)))
+            .join(User, User.line_user_id == NotificationOutbox.line_user_id)
+            .where(NotificationOutbox.date == collection_date, NotificationOutbox.status == 'sent')
+            .group_by(User.area_name)
+        ).all()
+        assert db.session.scalar(select(func.count()).select_from(DispatchShard)) == shards
+    assert area_shards == [1, 1, 1, 1]
+    # 300 users in each of 4 areas: at most one multicast per area, however many shards
+    assert line_stub.counts['/v2/bot/message/multicast'] <= 4
+
+def test_transport_is_sized_for_every_dispatch_worker(app, monkeypatch):
+    from app import line_transport
+    from app.dispatch import NotificationDispatcher
+
+    monkeypatch.setenv('LINE_MAX_CONCURRENCY', '2')
+    monkeypatch.setenv('DISPATCH_WORKERS', '3')
+    monkeypatch.setattr(line_transport, '_transport', None)
+
+    assert line_transport.get_transport().concurrency == 6
+    # Each worker's dispatcher keeps its own share of the pool busy
+    assert NotificationDispatcher(app).max_inflight == 2 * 4
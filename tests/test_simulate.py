@@ -0,0 +1,81 @@
+import json
+import os
+from datetime import date
+
+from app.data import SCHEDULE_DIR
+from app.models import db, User
+from app.simulate import run_simulation
+
+START, END = date(2026, 6, 1), date(2026, 6, 30) # June 2026 starts on a Monday
+AREA = '荏原 1丁目' # 水 / 月・木 / 第1・3土
+
+def write_candidate(tmp_path, edit):
+    """Writes a copy of the 品川区 schedule file after edit(areas) to a candidate directory."""
+    with open(os.path.join(SCHEDULE_DIR, 'shinagawa.json'), encoding='utf-8') as f:
+        content = json.load(f)
+    edit(content['areas'])
+    directory = tmp_path / 'candidate'
+    directory.mkdir()
+    (directory / 'shinagawa.json').write_text(json.dumps(content, ensure_ascii=False), encoding='utf-8')
+    return str(directory)
+
+def register(app, count):
+    with app.app_context():
+        db.session.add_all(
+            User(line_user_id=f'U{i}', municipality='品川区', area_name=AREA) for i in range(count)
+        )
+        db.session.commit()
+
+def test_reminders_are_weighted_by_registered_users(app):
+    register(app, 3)
+    with app.app_context():
+        results = run_simulation(START, END)
+
+    area = results['areas'][f"品川区 {AREA}"]
+    # 4 Wednesdays, 9 Mondays and Thursdays and 2 first/third Saturdays in June 2026
+    assert area == {'users': 3, 'collection_days': 15, 'notifications': 45}
+    assert results['registered_users'] == 3
+    assert results['total_notifications'] == 45
+    assert results['days']['2026-06-01']['recipients'] == 3 # A Monday
+    assert results['days']['2026-06-02']['recipients'] == 0
+    assert results['diff']['areas_changed'] == {}
+    assert results['diff']['total_notifications_delta'] == 0
+
+def test_candidate_dataset_is_diffed_against_the_database(app, tmp_path):
+    register(app, 1)
+
+    def edit(areas):
+        area = next(item for item in areas if item['name'] == AREA)
+        area['burnable'] = '月'
+        area['resources'] = '毎週金曜' # Not a rule; reported and never fires
+        areas.append(dict(area, name='新しい町'))
+        areas.remove(next(item for item in areas if item['name'] != AREA and item['name'] != '新しい町'))
+
+    with app.app_context():
+        results = run_simulation(START, END, write_candidate(tmp_path, edit))
+
+    diff = results['diff']
+    assert diff['previous'] == 'database'
+    assert diff['areas_added'] == ['品川区 新しい町']
+    assert len(diff['areas_removed']) == 1
+    assert diff['areas_changed'] == {
+        f"品川区 {AREA}": {'users': 1, 'collections_added': 0, 'collections_removed': 8},
+    }
+    assert diff['total_notifications_delta'] == -8 # 4 Thursdays and 4 Wednesdays no longer on a collection day
+    assert any(AREA in error for error in results['invalid_rules'])
+
+def test_cli_writes_the_results(app, tmp_path):
+    output = tmp_path / 'results.json'
+
+    result = app.test_cli_runner().invoke(
+        args=['simulate', '--from', '2026-06-01', '--to', '2026-06-07', '--output', str(output)],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert 'Simulated 2026-06-01 to 2026-06-07 for 0 registered users.' in result.output
+    assert json.loads(output.read_text(encoding='utf-8'))['to'] == '2026-06-07'
+
+def test_cli_rejects_a_reversed_range(app):
+    result = app.test_cli_runner().invoke(args=['simulate', '--from', '2026-06-07', '--to', '2026-06-01'])
+
+    assert result.exit_code != 0
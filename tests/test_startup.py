@@ -0,0 +1,29 @@
+from app import create_app
+from app.models import db, SchemaVersion
+from app.startup import schema_fingerprint
+
+def test_restart_skips_the_schema_check(app, capsys):
+    with app.app_context():
+        assert db.session.get(SchemaVersion, schema_fingerprint(db.metadata)) is not None
+    capsys.readouterr()
+
+    restarted = create_app()
+
+    assert 'Database schema already verified' in capsys.readouterr().out
+    with restarted.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+def test_changed_schema_is_checked_again(app, capsys):
+    with app.app_context():
+        db.session.query(SchemaVersion).update({'fingerprint': 'old'})
+        db.session.commit()
+    capsys.readouterr()
+
+    restarted = create_app()
+
+    assert 'Database already initialized' in capsys.readouterr().out
+    with restarted.app_context():
+        assert {row.fingerprint for row in db.session.query(SchemaVersion)} == {'old', schema_fingerprint(db.metadata)}
+        db.session.remove()
+        db.engine.dispose()
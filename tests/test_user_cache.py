@@ -0,0 +1,100 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import app.user_cache as user_cache_module
+from app.data import load_municipality
+from app.models import db, User
+from app.user_cache import CachedUser, UserCache, get_cached_user, user_cache
+
+from test_area_index import write_ward
+
+ENTRY = CachedUser('品川区', '荏原 1丁目', '水', '月・木', '第1・3土')
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the cache's monotonic clock with a settable one."""
+    now = [1000.0]
+    monkeypatch.setattr(user_cache_module, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+def test_hits_misses_and_negative_entries():
+    cache = UserCache()
+    assert cache.get('U1') == (False, None)
+    cache.set('U1', ENTRY)
+    cache.set('U2', None)
+
+    assert cache.get('U1') == (True, ENTRY)
+    assert cache.get('U2') == (True, None)
+    stats = cache.stats()
+    assert (stats['hits'], stats['negative_hits'], stats['misses']) == (1, 1, 1)
+
+def test_entries_expire(clock):
+    cache = UserCache(ttl=300, negative_ttl=30)
+    cache.set('U1', ENTRY)
+    cache.set('U2', None)
+
+    clock[0] += 31
+    assert cache.get('U1') == (True, ENTRY)
+    assert cache.get('U2') == (False, None)
+    clock[0] += 300
+    assert cache.get('U1') == (False, None)
+
+def test_least_recently_used_entry_is_evicted():
+    cache = UserCache(maxsize=2)
+    cache.set('U1', ENTRY)
+    cache.set('U2', ENTRY)
+    cache.get('U1')
+    cache.set('U3', ENTRY)
+
+    assert cache.get('U2') == (False, None)
+    assert cache.get('U1') == (True, ENTRY)
+    assert cache.stats()['evictions'] == 1
+
+def test_get_cached_user_reads_through(app):
+    with app.app_context():
+        assert get_cached_user('U1') is None
+        db.session.add(User(line_user_id='U1', municipality='品川区', area_name='荏原 1丁目'))
+        db.session.commit()
+
+        # The negative entry is served until the registration invalidates it
+        assert get_cached_user('U1') is None
+        user_cache.invalidate('U1')
+        cached_user = get_cached_user('U1')
+        assert cached_user.area_name == '荏原 1丁目'
+        assert cached_user.burnable == '月・木'
+
+        # A hit needs no database row any more
+        db.session.query(User).delete()
+        db.session.commit()
+        assert get_cached_user('U1') == cached_user
+
+def test_registration_in_another_process_is_picked_up(app, monkeypatch):
+    with app.app_context():
+        db.session.add(User(line_user_id='U1', municipality='品川区', area_name='荏原 1丁目'))
+        db.session.commit()
+        assert get_cached_user('U1').area_name == '荏原 1丁目'
+
+        # Another worker re-registers the user; this process's cache is not told
+        db.session.query(User).filter_by(line_user_id='U1').update({
+            'area_name': '東大井 1-4丁目',
+            'area_changed_at': datetime.now(timezone.utc).replace(tzinfo=None),
+        })
+        db.session.commit()
+        assert get_cached_user('U1').area_name == '荏原 1丁目' # Until the next poll
+
+        monkeypatch.setattr(user_cache_module, '_synced_at', 0.0)
+        assert get_cached_user('U1').area_name == '東大井 1-4丁目'
+
+def test_schedule_reload_drops_every_entry(app, monkeypatch, tmp_path):
+    with app.app_context():
+        get_cached_user('U1')
+        assert user_cache.stats()['size'] == 1
+
+        load_municipality(write_ward(tmp_path, '目黒区', ['目黒本町 1-6丁目']))
+        db.session.commit()
+        monkeypatch.setattr(user_cache_module, '_synced_at', 0.0)
+        get_cached_user('U2')
+
+        assert user_cache.stats()['size'] == 1 # Only U2, read after the reload
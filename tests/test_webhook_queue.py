@@ -0,0 +1,50 @@
+from app.bot import process_webhook
+from app.models import db, User
+from app.webhook_queue import WebhookQueue
+from conftest import replies, webhook
+
+def test_sync_webhook_registers_and_replies(app, line_stub):
+    body, headers = webhook('U1', '登録 東大井２丁目', '燃やすごみ')
+    response = app.test_client().post('/callback', data=body, headers=headers)
+
+    assert response.status_code == 200
+    registered, answer = replies(line_stub)
+    assert registered.startswith('「東大井 1-4丁目」を登録しました。')
+    assert answer.startswith('【燃やすごみ】')
+    with app.app_context():
+        assert db.session.query(User).filter_by(line_user_id='U1').one().area_name == '東大井 1-4丁目'
+
+def test_async_webhook_is_processed_by_the_workers(app, line_stub, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_MODE', 'async')
+    from app import create_app
+
+    async_app = create_app()
+    webhook_queue = async_app.extensions['webhook_queue']
+    body, headers = webhook('U1', '登録 東大井２丁目', 'PDF')
+
+    assert async_app.test_client().post('/callback', data=body, headers=headers).status_code == 200
+    webhook_queue.join()
+    assert len(replies(line_stub)) == 2
+    assert webhook_queue.stats()['processed'] == 1
+
+def test_async_webhook_rejects_a_bad_signature(app, line_stub, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_MODE', 'async')
+    from app import create_app
+
+    async_app = create_app()
+    body, headers = webhook('U1', 'PDF')
+    headers['X-Line-Signature'] = 'bad'
+
+    assert async_app.test_client().post('/callback', data=body, headers=headers).status_code == 400
+    assert async_app.extensions['webhook_queue'].stats()['enqueued'] == 0
+
+def test_full_queue_processes_inline(app, line_stub):
+    # No workers, so the first payload stays queued and the second finds the queue full
+    webhook_queue = WebhookQueue(app, process_webhook, workers=0, maxsize=1)
+    first, first_headers = webhook('U1', 'PDF')
+    second, second_headers = webhook('U2', 'PDF')
+
+    assert webhook_queue.submit(first, first_headers['X-Line-Signature']) is True
+    assert webhook_queue.submit(second, second_headers['X-Line-Signature']) is False
+    assert len(replies(line_stub)) == 1
+    assert webhook_queue.stats()['inline'] == 1